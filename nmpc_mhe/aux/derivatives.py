@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""In-process derivatives of Pyomo models.
+
+The Jacobian and the Hessian of the Lagrangian are evaluated at the current values of the variables by reverse mode
+automatic differentiation of the expression trees, no .nl files or k_aug runs are involved. The results are scipy
+sparse matrices, the rows and the columns are labeled with (component name, index) tuples, as the suffix
+dictionaries of the framework (e.g. tp_cons_suffix, tp_vars_suffix).
+
+Example:
+    jac, rows, cols = evaluate_jacobian(m)
+    lbl = dict(zip(cols, range(0, len(cols))))
+    dcdT = jac[:, lbl[("T", (1, 0))]]"""
+
+from __future__ import print_function
+from __future__ import division
+
+from pyomo.core.base import Var, Constraint, Objective
+from pyomo.core.base.numvalue import value
+from pyomo.core.expr.numvalue import is_potentially_variable
+from pyomo.core.expr.current import identify_variables, identify_mutable_parameters
+from pyomo.core.expr.calculus import diff_with_pyomo
+from pyomo.core.expr.calculus.diff_with_pyomo import reverse_ad, reverse_sd
+from pyomo.core.kernel.component_map import ComponentMap
+from scipy.sparse import coo_matrix
+import numpy as np
+
+__author__ = "agent"  #: October 2026
+
+
+def _register_subclasses():
+    """The differentiation rules are looked up by exact class, the NPV_* variants (e.g. a division of mutable Params)
+    are subclasses of the regular expressions and take the same rule."""
+    rules = diff_with_pyomo._diff_map
+    pending = list(rules.keys())
+    while pending:
+        base = pending.pop()
+        for sub in base.__subclasses__():
+            if sub not in rules:
+                rules[sub] = rules[base]
+            pending.append(sub)
+
+
+_register_subclasses()
+
+
+def component_label(cd):
+    """(component name, index) of a component data, the index is always a tuple."""
+    index = cd.index()
+    if index is None:
+        index = ()
+    elif not isinstance(index, tuple):
+        index = (index,)
+    return cd.parent_component().getname(), index
+
+
+def active_constraints(m):
+    """Active constraint data of the model in declaration order."""
+    return [c for c in m.component_data_objects(Constraint, active=True, descend_into=True)]
+
+
+def free_variables(m, constraints=None):
+    """Variables that are not fixed and appear in the constraints, in the declaration order of the model."""
+    if constraints is None:
+        constraints = active_constraints(m)
+    seen = ComponentMap()
+    for c in constraints:
+        for v in identify_variables(c.body, include_fixed=False):
+            seen[v] = True
+    return [v for v in m.component_data_objects(Var, descend_into=True) if v in seen]
+
+
+def _as_data(m, items, ctype):
+    """Accepts component data or (name, index) labels."""
+    out = []
+    for i in items:
+        if isinstance(i, tuple):
+            comp = m.find_component(i[0])
+            if comp is None or comp.ctype is not ctype:
+                raise ValueError("{} is not a {} of the model".format(i[0], ctype.__name__))
+            out.append(comp[i[1]] if comp.is_indexed() else comp)
+        else:
+            out.append(i)
+    return out
+
+
+def evaluate_jacobian(m, variables=None, constraints=None):
+    """Jacobian of the constraint bodies at the current point.
+
+    Args:
+        m (pyomo.core.base.PyomoModel.ConcreteModel): The model.
+        variables (list): Columns, component data or labels. Defaults to free_variables.
+        constraints (list): Rows, component data or labels. Defaults to the active constraints.
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix, row labels, column labels)
+    """
+    constraints = active_constraints(m) if constraints is None else _as_data(m, constraints, Constraint)
+    variables = free_variables(m, constraints) if variables is None else _as_data(m, variables, Var)
+    col = ComponentMap((v, j) for (j, v) in enumerate(variables))
+    rows, cols, vals = [], [], []
+    for (i, c) in enumerate(constraints):
+        ders = reverse_ad(c.body)
+        for v in identify_variables(c.body, include_fixed=True):
+            if v in col:
+                rows.append(i)
+                cols.append(col[v])
+                vals.append(ders[v])
+    jac = coo_matrix((np.array(vals, dtype=float), (rows, cols)), shape=(len(constraints), len(variables)))
+    return jac.tocsr(), [component_label(c) for c in constraints], [component_label(v) for v in variables]
+
+
+def evaluate_gradient(m, variables=None):
+    """Gradient of the active objective at the current point.
+
+    Args:
+        m (pyomo.core.base.PyomoModel.ConcreteModel): The model.
+        variables (list): Component data or labels. Defaults to free_variables.
+
+    Returns:
+        tuple: (numpy.ndarray, labels)
+    """
+    variables = free_variables(m) if variables is None else _as_data(m, variables, Var)
+    col = ComponentMap((v, j) for (j, v) in enumerate(variables))
+    grad = np.zeros(len(variables))
+    for o in m.component_data_objects(Objective, active=True, descend_into=True):
+        ders = reverse_ad(o.expr)
+        sign = 1. if o.is_minimizing() else -1.
+        for v in identify_variables(o.expr, include_fixed=False):
+            if v in col:
+                grad[col[v]] += sign * ders[v]
+    return grad, [component_label(v) for v in variables]
+
+
+def evaluate_param_jacobian(m, params, constraints=None):
+    """Jacobian of the constraint residuals with respect to mutable Params (e.g. initial conditions or controls).
+
+    Args:
+        m (pyomo.core.base.PyomoModel.ConcreteModel): The model.
+        params (list): Columns, mutable Param data.
+        constraints (list): Rows, component data or labels. Defaults to the active constraints.
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix, row labels, column labels)
+    """
+    constraints = active_constraints(m) if constraints is None else _as_data(m, constraints, Constraint)
+    col = ComponentMap((p, j) for (j, p) in enumerate(params))
+    rows, cols, vals = [], [], []
+    for (i, c) in enumerate(constraints):
+        #: residual body - upper, pyomo moves the Params of e.g. x == p to the bounds of equalities
+        parts = [(1., c.body)] + ([(-1., c.upper)] if c.equality else [])
+        for (sign, expr) in parts:
+            found = [p for p in identify_mutable_parameters(expr) if p in col]
+            if not found:
+                continue
+            ders = reverse_ad(expr)
+            for p in found:
+                rows.append(i)
+                cols.append(col[p])
+                vals.append(sign * ders[p])
+    jac = coo_matrix((np.array(vals, dtype=float), (rows, cols)), shape=(len(constraints), len(params)))
+    return jac.tocsr(), [component_label(c) for c in constraints], [component_label(p) for p in params]
+
+
+def evaluate_hessian(m, variables=None, constraints=None, multipliers=None, objective=True):
+    """Hessian of the Lagrangian f(x) + sum_i y_i c_i(x) at the current point.
+
+    Args:
+        m (pyomo.core.base.PyomoModel.ConcreteModel): The model.
+        variables (list): Rows and columns, component data or labels. Defaults to free_variables.
+        constraints (list): Constraints of the Lagrangian. Defaults to the active constraints.
+        multipliers (dict): Label -> y_i, labels that are missing are taken as zero. If None all the multipliers
+            are one (useful to get the structure).
+        objective (bool): Include the active objective.
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix, labels)
+    """
+    constraints = active_constraints(m) if constraints is None else _as_data(m, constraints, Constraint)
+    variables = free_variables(m, constraints) if variables is None else _as_data(m, variables, Var)
+    col = ComponentMap((v, j) for (j, v) in enumerate(variables))
+    terms = []
+    for c in constraints:
+        y = 1. if multipliers is None else multipliers.get(component_label(c), 0.)
+        if y != 0.:
+            terms.append((y, c.body))
+    if objective:
+        for o in m.component_data_objects(Objective, active=True, descend_into=True):
+            terms.append((1. if o.is_minimizing() else -1., o.expr))
+    hess = {}
+    for (y, expr) in terms:
+        first = reverse_sd(expr)
+        vs = [v for v in identify_variables(expr, include_fixed=False) if v in col]
+        for v in vs:
+            dv = first[v]
+            if not is_potentially_variable(dv):
+                continue  #: linear in v
+            second = reverse_ad(dv)
+            for w in identify_variables(dv, include_fixed=False):
+                if w in col:
+                    key = (col[v], col[w])
+                    hess[key] = hess.get(key, 0.) + y * second[w]
+    n = len(variables)
+    if hess:
+        rc = np.array(list(hess.keys()), dtype=int)
+        vals = np.array(list(hess.values()), dtype=float)
+        h = coo_matrix((vals, (rc[:, 0], rc[:, 1])), shape=(n, n)).tocsr()
+    else:
+        h = coo_matrix((n, n)).tocsr()
+    return h, [component_label(v) for v in variables]
+
+
+def evaluate_residuals(m, constraints=None):
+    """Residuals of the constraints, body - bound (the violated bound for inequalities, zero if satisfied)."""
+    constraints = active_constraints(m) if constraints is None else _as_data(m, constraints, Constraint)
+    res = np.zeros(len(constraints))
+    for (i, c) in enumerate(constraints):
+        body = value(c.body)
+        if c.equality:
+            res[i] = body - value(c.upper)
+        elif c.has_ub() and body > value(c.upper):
+            res[i] = body - value(c.upper)
+        elif c.has_lb() and body < value(c.lower):
+            res[i] = body - value(c.lower)
+    return res, [component_label(c) for c in constraints]
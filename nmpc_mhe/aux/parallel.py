@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Helpers to run parts of the framework in separate processes.
+
+The framework writes ipopt.opt, the ipopt logs, the k_aug/dot_sens files and the results into the current working
+directory, thus every worker process has to own its working directory."""
+
+from __future__ import print_function
+from __future__ import division
+
+from contextlib import contextmanager
+import multiprocessing
+import multiprocessing.connection
+import tempfile
+import shutil
+import signal
+import time
+import os
+
+__author__ = "agent"  #: October 2026
+
+
+@contextmanager
+def isolated_workdir(path=None, prefix="cappresse_", remove=False):
+    """Changes the working directory for the duration of the block.
+
+    Args:
+        path (str): Directory to use, it is created if it does not exist. If None a temporary directory is created.
+        prefix (str): Prefix of the temporary directory.
+        remove (bool): Remove the directory afterwards.
+
+    Yields:
+        str: The absolute path of the working directory.
+    """
+    if path is None:
+        path = tempfile.mkdtemp(prefix=prefix)
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+        if remove:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def get_context():
+    """Returns the multiprocessing context. Fork is preferred as the models are inherited by the workers instead of
+    being pickled."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def get_pool(processes=None, initializer=None, initargs=(), maxtasksperchild=None):
+    # type: (int, callable, tuple, int) -> multiprocessing.pool.Pool
+    """Creates a process pool with the preferred context.
+
+    Args:
+        processes (int): Number of workers, defaults to the number of cpus.
+        initializer (callable): Called once in every worker.
+        initargs (tuple): Arguments of the initializer.
+        maxtasksperchild (int): Tasks before a worker is replaced.
+
+    Returns:
+        multiprocessing.pool.Pool: The pool.
+    """
+    return get_context().Pool(processes=processes,
+                              initializer=initializer,
+                              initargs=initargs,
+                              maxtasksperchild=maxtasksperchild)
+
+
+def _run_task(f, conn, workdir, remove):
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()  #: ipopt/k_aug started by f() are in the group, cancel() reaches them too
+    with isolated_workdir(workdir, remove=remove):
+        try:
+            out = ("ok", f())
+        except BaseException as exc:  #: Everything is reported to the parent, including sys.exit()
+            out = ("error", repr(exc))
+    conn.send(out)
+    conn.close()
+
+
+class BackgroundTask(object):
+    """Runs f() in a forked process, in its own working directory. The function is inherited by the child (it does not
+    need to be picklable), its return value is sent back through a pipe.
+
+    Args:
+        f (callable): The task, without arguments.
+        workdir (str): Working directory of the child. If None a temporary directory is created and removed.
+
+    The child leads its own process group, cancel() terminates the whole group.
+    """
+    def __init__(self, f, workdir=None):
+        ctx = get_context()
+        self._remove = workdir is None
+        self.workdir = tempfile.mkdtemp(prefix="cappresse_bg_") if workdir is None else os.path.abspath(workdir)
+        self._recv, send = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=_run_task, args=(f, send, self.workdir, self._remove))
+        self.process.daemon = True
+        self.start = time.time()
+        self.process.start()
+        send.close()
+        self.status = None  #: "ok" or "error" once finished
+        self.value = None
+
+    def wait(self, timeout=None):
+        """Waits at most timeout seconds (None blocks), returns True if the task finished"""
+        if self.status is not None:
+            return True
+        ready = self._recv.poll(timeout)
+        if not ready:
+            if self.process.is_alive():
+                return False
+            ready = self._recv.poll(0)  #: it may have answered right before exiting
+        try:
+            if not ready:
+                raise EOFError
+            self.status, self.value = self._recv.recv()
+        except EOFError:  #: The child died without an answer
+            self.process.join()
+            self.status, self.value = "error", "exitcode {}".format(self.process.exitcode)
+            self._cleanup()
+        self.process.join()
+        self._recv.close()
+        return True
+
+    def cancel(self):
+        """Terminates the child and the processes it started, its temporary directory is removed"""
+        if self.status is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except (AttributeError, OSError):  #: No process groups, or the child has not called setpgrp yet
+                self.process.terminate()
+            self.process.join()
+            self._recv.close()
+            self._cleanup()
+            self.status, self.value = "error", "cancelled"
+
+    def _cleanup(self):
+        """The child does not get to run its finally blocks if it is killed"""
+        if self._remove:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def wait_any(tasks, timeout=None):
+    """Waits until at least one of the tasks finishes (at most timeout seconds).
+
+    Returns:
+        list: The finished tasks, in the order given.
+    """
+    pending = [t for t in tasks if t.status is None]
+    if len(pending) == len(tasks):
+        multiprocessing.connection.wait([t._recv for t in pending] + [t.process.sentinel for t in pending], timeout)
+    return [t for t in tasks if t.wait(0)]
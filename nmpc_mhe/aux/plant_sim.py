@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Plant simulation by numerical integration instead of optimization.
+
+The one-element plant model (PlantSample) is integrated over its time set with an implicit adaptive-step method
+(scipy.integrate.solve_ivp, Radau or BDF). The model is treated as a semi-explicit index-1 DAE: at a template time
+point the model equations (every active constraint indexed by that time, except the collocation equations of the
+derivatives) are solved by Newton for the derivatives and the algebraic variables given the states. The Jacobians
+come from nmpc_mhe.aux.derivatives, nothing is written to the filesystem.
+
+After the integration the states, derivatives and algebraic variables are loaded at every point of the time set, so
+the model looks as if it had been solved by ipopt (the collocation equations are satisfied up to the accuracy of the
+integrator relative to the collocation scheme)."""
+
+from __future__ import print_function
+from __future__ import division
+
+from pyomo.core.base import Constraint, Param, Var
+from pyomo.core.base.numvalue import value
+from pyomo.core.expr.current import identify_variables
+from pyomo.core.kernel.component_map import ComponentMap
+from pyomo.dae import ContinuousSet, DerivativeVar
+from nmpc_mhe.aux.derivatives import evaluate_jacobian, evaluate_residuals
+from scipy.integrate import solve_ivp
+from scipy.sparse.linalg import splu
+from scipy.sparse import csc_matrix
+import numpy as np
+import time
+
+__author__ = "agent"  #: October 2026
+
+
+class PlantSimError(RuntimeError):
+    pass
+
+
+def _first_index(index):
+    return index[0] if isinstance(index, tuple) else index
+
+
+def _factorize(jac, t):
+    """LU of dg/dz, singular if the equations do not determine the unknowns given the states (not index 1)"""
+    try:
+        return splu(csc_matrix(jac))
+    except RuntimeError as exc:
+        raise PlantSimError("dg/dz is singular at t={} ({}), the DAE is not index 1".format(t, exc))
+
+
+class _TimeSlice(object):
+    """Model equations, states and unknowns (derivatives and algebraic variables) at one time point.
+
+    With derivatives=False (first time point) the equations that only involve states (initial conditions) are left
+    out and the derivatives are not required to appear."""
+    def __init__(self, mod, t, state_keys, disc_eqs, derivatives=True):
+        self.t = t
+        self.x = [getattr(mod, x)[(t,) + j] for (x, j) in state_keys]
+        is_state = ComponentMap((v, True) for v in self.x)
+        seen = ComponentMap()
+        self.eqs = []
+        self.z = []
+        for c in mod.component_data_objects(Constraint, active=True):
+            if _first_index(c.index()) != t or c.parent_component() in disc_eqs:
+                continue
+            unknowns = [v for v in identify_variables(c.body, include_fixed=False) if v not in is_state]
+            if not unknowns and not derivatives:
+                continue
+            self.eqs.append(c)
+            for v in unknowns:
+                if v not in seen:
+                    seen[v] = True
+                    self.z.append(v)
+        if len(self.z) != len(self.eqs):
+            raise PlantSimError("The model equations at t={} are not square: {} equations, {} unknowns"
+                                .format(t, len(self.eqs), len(self.z)))
+        self._lu = None  #: factorization of dg/dz, reused while Newton converges fast (chord iterations)
+        position = ComponentMap((v, i) for (i, v) in enumerate(self.z))
+        self.dx = []
+        if not derivatives:
+            return
+        for (x, j) in state_keys:
+            for dv in mod.component_objects(Var):  #: the ctype is reset to Var by the discretization
+                if isinstance(dv, DerivativeVar) and dv.get_state_var().getname() == x:
+                    self.dx.append(position[dv[(t,) + j]])
+                    break
+            else:
+                raise PlantSimError("No derivative for {}".format(x))
+
+    def set_states(self, x):
+        for (v, val) in zip(self.x, x):
+            v.set_value(float(val))
+
+    def solve(self, mod, tol=1e-10, max_iter=30):
+        """Newton on the unknowns for the current states, returns the number of iterations"""
+        r, _ = evaluate_residuals(mod, constraints=self.eqs)
+        for it in range(0, max_iter):
+            norm = np.linalg.norm(r, np.inf)
+            if norm < tol:
+                return it
+            fresh = self._lu is None
+            if fresh:
+                jac, _, _ = evaluate_jacobian(mod, variables=self.z, constraints=self.eqs)
+                self._lu = _factorize(jac, self.t)
+            dz = self._lu.solve(-r)
+            for (v, d) in zip(self.z, dz):
+                v.set_value(value(v) + d)
+            r, _ = evaluate_residuals(mod, constraints=self.eqs)
+            if not fresh and np.linalg.norm(r, np.inf) > 0.1 * norm:
+                self._lu = None  #: slow contraction, refactorize
+        if np.linalg.norm(r, np.inf) < max(tol, 1e-06):
+            return max_iter
+        raise PlantSimError("Newton did not converge at t={}, |r|={}".format(self.t, np.linalg.norm(r, np.inf)))
+
+    def derivatives(self):
+        return np.array([value(self.z[i]) for i in self.dx])
+
+    def state_jacobian(self, mod):
+        """d(dx/dt)/dx = -(dg/dz)^-1 dg/dx, rows of the derivatives"""
+        jac, _, _ = evaluate_jacobian(mod, variables=self.x + self.z, constraints=self.eqs)
+        nx = len(self.x)
+        jac = jac.tocsc()
+        self._lu = _factorize(jac[:, nx:], self.t)
+        dzdx = self._lu.solve(-jac[:, :nx].toarray())
+        return dzdx[self.dx, :]
+
+
+class PlantSim(object):
+    """Integrates a one-element dynamic model over its ContinuousSet.
+
+    Args:
+        mod (pyomo.core.base.PyomoModel.ConcreteModel): The plant model (e.g. PlantSample), discretized.
+        states (list): Names of the differential states.
+        state_vars (dict): State name -> list of indices without time (as DynGen_DAE.state_vars).
+        method (str): "Radau" or "BDF".
+        rtol (float): Relative tolerance of the integrator.
+        atol (float): Absolute tolerance of the integrator.
+    """
+    def __init__(self, mod, states, state_vars, method="Radau", rtol=1e-08, atol=1e-10):
+        self.mod = mod
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.state_keys = [(x, tuple(j)) for x in states for j in state_vars[x]]
+        t_set = [s for s in mod.component_objects(ContinuousSet)][0]
+        self.times = sorted(t_set)
+        disc_eqs = ComponentMap()
+        for c in mod.component_objects(Constraint):
+            if c.getname().endswith("_disc_eq"):  #: collocation equations added by pyomo.dae
+                disc_eqs[c] = True
+        self.initial = _TimeSlice(mod, self.times[0], self.state_keys, disc_eqs, derivatives=False)
+        self.slices = [_TimeSlice(mod, t, self.state_keys, disc_eqs) for t in self.times[1:]]
+        self.stats = {}
+
+    def initial_state(self):
+        """From the <state>_ic Params (the initial-condition constraints), or the value at the first time point"""
+        t0 = self.times[0]
+        x0 = []
+        for (x, j) in self.state_keys:
+            ic = getattr(self.mod, x + "_ic", None)
+            if isinstance(ic, Param):
+                key = j[0] if len(j) == 1 else j
+                x0.append(value(ic[key] if ic.is_indexed() else ic))
+            else:
+                x0.append(value(getattr(self.mod, x)[(t0,) + j]))
+        return np.array(x0, dtype=float)
+
+    def simulate(self):
+        """Integrates from the initial state and loads the trajectory in the model.
+
+        Returns:
+            dict: Statistics (time, nfev, njev, newton iterations, status and message of solve_ivp).
+        """
+        start = time.time()
+        template = self.slices[-1]  #: the equations are the same at every time point
+        newton = [0]
+
+        def rhs(t, x):
+            template.set_states(x)
+            newton[0] += template.solve(self.mod)
+            return template.derivatives()
+
+        def jac(t, x):
+            template.set_states(x)
+            newton[0] += template.solve(self.mod)
+            return template.state_jacobian(self.mod)
+
+        x0 = self.initial_state()
+        sol = solve_ivp(rhs, (self.times[0], self.times[-1]), x0, method=self.method, t_eval=self.times[1:],
+                        jac=jac, rtol=self.rtol, atol=self.atol)
+        if sol.status != 0:
+            raise PlantSimError("Integration failed: " + str(sol.message))
+        for (k, sl) in enumerate(self.slices):
+            sl.set_states(sol.y[:, k])
+            newton[0] += sl.solve(self.mod)
+        self.initial.set_states(x0)
+        if self.initial.eqs:
+            newton[0] += self.initial.solve(self.mod)
+        self.stats = {"time": time.time() - start, "nfev": int(sol.nfev), "njev": int(sol.njev),
+                      "newton": newton[0], "status": int(sol.status), "message": str(sol.message)}
+        return self.stats
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Scenario engine for closed-loop studies.
+
+A scenario is a plain dictionary with the settings of one closed-loop run (weights, covariances, sigma of the noise,
+Ns, set-point profile, etc.). The user provides a function `closed_loop(scenario)` that builds the controller from the
+scenario, runs the loop and returns the controller object (or a dictionary of KPIs). The function has to be defined at
+module level so it can be sent to the workers.
+
+Example:
+    def closed_loop(sc):
+        e = MheGen_DAE(...)
+        e.set_covariance_meas(sc["R"])
+        ...
+        for i in range(0, sc["steps"]):
+            ...
+        return e
+
+    scenarios = expand_scenarios({"sigma": [1e-03, 1e-02], "Ns": [2, 3]}, base={"steps": 50})
+    summary = run_sweep(closed_loop, scenarios, root="sweep_1", processes=4)
+
+Every scenario runs in root/<name>/, where the framework files and a result.json are written. The aggregated
+results are written to root/summary.json."""
+
+from __future__ import print_function
+from __future__ import division
+
+from nmpc_mhe.aux.parallel import isolated_workdir, get_pool
+import numpy as np
+import itertools
+import traceback
+import datetime
+import json
+import time
+import sys
+import os
+
+__author__ = "agent"  #: October 2026
+
+
+def expand_scenarios(grid, base=None, seed=0):
+    # type: (dict, dict, int) -> list
+    """Cartesian product of the grid of settings.
+
+    Args:
+        grid (dict): Setting name -> list of values.
+        base (dict): Settings shared by all the scenarios.
+        seed (int): Seed of the first scenario, the i-th scenario gets seed + i.
+
+    Returns:
+        list: The scenarios, every one has a "name" and a "seed" entry.
+    """
+    keys = sorted(grid.keys())
+    scenarios = []
+    for i, values in enumerate(itertools.product(*[grid[k] for k in keys])):
+        sc = dict(base) if base else {}
+        sc.update(zip(keys, values))
+        sc.setdefault("name", "sc_{:04d}".format(i))
+        sc.setdefault("seed", seed + i)
+        scenarios.append(sc)
+    return scenarios
+
+
+def _stats(values):
+    v = np.asarray(values, dtype=float)
+    if v.size == 0:
+        return {"n": 0}
+    return {"n": int(v.size),
+            "total": float(v.sum()),
+            "mean": float(v.mean()),
+            "median": float(np.median(v)),
+            "p95": float(np.percentile(v, 95)),
+            "max": float(v.max())}
+
+
+def closed_loop_kpis(e, sp_tol=1e-08):
+    """Computes the KPIs of a finished closed-loop run.
+
+    Args:
+        e: The controller object (DynGen_DAE and derived classes).
+        sp_tol (float): Set-points with a smaller absolute value count as zero.
+
+    Returns:
+        dict: IAE of the states of interest (absolute and in % of the set-point, as in curr_off_soi), estimation
+        error of the MHE, and statistics of the solve times per model. Samples whose set-point is zero (below
+        sp_tol) are left out of the % IAE, a state without any other sample only gets the absolute one.
+    """
+    kpis = {}
+    hi_t = getattr(e, "hi_t", 1.)
+    soi_dict = getattr(e, "soi_dict", {})
+    sp_dict = getattr(e, "sp_dict", {})
+    if soi_dict:
+        iae = {}
+        iae_pct = {}
+        for k in soi_dict.keys():
+            soi = np.asarray(soi_dict[k], dtype=float)
+            sp = np.asarray(sp_dict[k][:soi.size], dtype=float)
+            off = np.abs(soi - sp)
+            iae[str(k)] = float(off.sum() * hi_t)
+            nz = np.abs(sp) > sp_tol
+            if nz.any():
+                iae_pct[str(k)] = float((100 * off[nz] / np.abs(sp[nz])).sum() * hi_t)
+        kpis["iae"] = iae
+        kpis["iae_off_soi"] = iae_pct
+        kpis["iae_total"] = sum(iae.values())
+
+    s_estimate = getattr(e, "s_estimate", {})
+    s_real = getattr(e, "s_real", {})
+    if s_estimate:
+        est = {}
+        sq = 0.
+        n = 0
+        for x in s_estimate.keys():
+            if not s_estimate[x]:
+                continue
+            err = np.asarray(s_estimate[x], dtype=float) - np.asarray(s_real[x], dtype=float)
+            est[x] = {"rmse": float(np.sqrt(np.mean(err ** 2))), "max_abs": float(np.abs(err).max())}
+            sq += float((err ** 2).sum())
+            n += err.size
+        kpis["estimation_error"] = est
+        if n:
+            kpis["estimation_rmse"] = np.sqrt(sq / n)
+
+    solve_log = getattr(e, "solve_log", [])
+    if solve_log:
+        by_model = {}
+        for entry in solve_log:
+            by_model.setdefault(entry["model"], []).append(entry)
+        solves = {}
+        for m, entries in by_model.items():
+            solves[m] = _stats([i["time"] for i in entries])
+            solves[m]["not_optimal"] = sum(1 for i in entries if i["termination"] != "optimal")
+        kpis["solve_time"] = solves
+    kpis["iterations"] = getattr(e, "_iteration_count", None)
+    return kpis
+
+
+def run_scenario(closed_loop, scenario, root):
+    """Runs one scenario in root/<name>. Never raises; a failure is reported in the result."""
+    result = {"scenario": scenario, "status": "ok"}
+    start = time.time()
+    with isolated_workdir(os.path.join(root, str(scenario["name"]))) as wd:
+        result["workdir"] = wd
+        np.random.seed(scenario.get("seed", 0))  #: noisy_plant_manager and update_noise_meas use np.random
+        try:
+            out = closed_loop(scenario)
+            result["kpis"] = out if isinstance(out, dict) else closed_loop_kpis(out)
+        except Exception as exc:
+            result["status"] = "error"
+            result["error"] = repr(exc)
+            result["traceback"] = traceback.format_exc()
+        result["wall_time"] = time.time() - start
+        with open("result.json", "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True, default=str)
+    return result
+
+
+def _run_scenario_star(args):
+    return run_scenario(*args)
+
+
+def aggregate(results):
+    """Table of scalar KPIs, one row per scenario."""
+    rows = []
+    for r in results:
+        row = {"name": r["scenario"]["name"], "status": r["status"], "wall_time": r.get("wall_time")}
+        kpis = r.get("kpis", {})
+        for k in ("iae_total", "estimation_rmse", "iterations"):
+            if k in kpis:
+                row[k] = kpis[k]
+        for m, s in kpis.get("solve_time", {}).items():
+            row["solve_mean_" + m] = s.get("mean")
+            row["solve_max_" + m] = s.get("max")
+            row["not_optimal_" + m] = s.get("not_optimal")
+        rows.append(row)
+    return rows
+
+
+def run_sweep(closed_loop, scenarios, root="sweep", processes=None):
+    # type: (callable, list, str, int) -> dict
+    """Runs all the scenarios in a process pool.
+
+    Args:
+        closed_loop (callable): Module level function taking a scenario and returning the controller or a dict.
+        scenarios (list): As given by expand_scenarios.
+        root (str): Directory of the results.
+        processes (int): Number of workers, 1 runs in this process.
+
+    Returns:
+        dict: Summary with the per-scenario results and the KPI table, also written to root/summary.json.
+    """
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    names = [sc["name"] for sc in scenarios]
+    if len(set(names)) != len(names):
+        raise ValueError("Scenario names must be unique")
+    args = [(closed_loop, sc, root) for sc in scenarios]
+    if processes == 1:
+        results = [_run_scenario_star(a) for a in args]
+    else:
+        pool = get_pool(processes=processes, maxtasksperchild=1)
+        try:
+            results = pool.map(_run_scenario_star, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    failed = [r["scenario"]["name"] for r in results if r["status"] != "ok"]
+    if failed:
+        print("W[[run_sweep]] Failed scenarios: " + ", ".join(failed), file=sys.stderr)
+    summary = {"timestamp": str(datetime.datetime.now()),
+               "table": aggregate(results),
+               "results": results}
+    with open(os.path.join(root, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2, sort_keys=True, default=str)
+    return summary
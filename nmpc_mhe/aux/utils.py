@@ -11,9 +11,11 @@ from pyomo.core.base import numvalue
 from os import getcwd, remove
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.sparse import lil_matrix
+from scipy.sparse import lil_matrix, coo_matrix
 from scipy.sparse.linalg import splu
 from scipy.linalg import solve_discrete_are, inv, eig
+from nmpc_mhe.aux.cpoinsc import collptsgen
+from nmpc_mhe.aux.lagrange_f import lgr, lgry
 
 __author__ = "David Thierry @dthierry, Kuan-Han Lin @kuanhanl"  #: March 2018, July 2020
 
@@ -30,13 +32,21 @@ def t_ij(time_set, i, j):
     Returns:
         float: Corresponding index of the ContinuousSet
     """
-    h = time_set.get_finite_elements()[1] - time_set.get_finite_elements()[0]  #: This would work even for 1 fe
+    fes = time_set.get_finite_elements()
+    h = _fe_length(fes, i)
     tau = time_set.get_discretization_info()['tau_points']
-    fe = time_set.get_finite_elements()[i]
+    fe = fes[i]
     time = fe + tau[j] * h
     return round(time, 6)
 
 
+def _fe_length(fes, i):
+    """Length of the i-th finite element given the element boundaries (the elements need not be uniform)"""
+    if i + 1 < len(fes):
+        return fes[i + 1] - fes[i]
+    return fes[i] - fes[i - 1]  #: End point
+
+
 def fe_cp(time_set, t):
     # type: (ContinuousSet, float) -> tuple
     """Return the corresponding fe and cp for a given time
@@ -54,7 +64,7 @@ def fe_cp(time_set, t):
             fe = j
             break
         j += 1
-    h = time_set.get_finite_elements()[1] - time_set.get_finite_elements()[0]
+    h = _fe_length(time_set.get_finite_elements(), fe)
     tauh = [i * h for i in time_set.get_discretization_info()['tau_points']]
     j = 0  #: Watch out for LEGENDRE
     cp = None
@@ -244,8 +254,31 @@ def reconcile_nvars_mequations(d_mod, keep_nl=False, **kwargs):
     return nvar, meqn
 
 
-def load_iguess(src, tgt, fe_src, fe_tgt):
-    # type: (ConcreteModel, ConcreteModel, int, int) -> None
+_interp_matrices = {}  #: (ncp_src, ncp_tgt, algebraic) -> Lagrange interpolation matrix, see interpolation_matrix
+
+
+def interpolation_matrix(ncp_src, ncp_tgt, algebraic=False):
+    # type: (int, int, bool) -> np.ndarray
+    """Matrix that maps the values at the Radau points (plus the element start) of an element with ncp_src collocation
+    points to the points of an element with ncp_tgt collocation points, with the Lagrange polynomials of the source.
+    With algebraic=True the polynomial only goes through the collocation points (degree ncp_src - 1), as for the
+    algebraic variables and derivatives, whose value at the element start does not belong to the element.
+    The matrices are computed once per pair.
+
+    Returns:
+        np.ndarray: (ncp_tgt + 1, ncp_src + 1) matrix (the first column is zero with algebraic=True).
+    """
+    key = (ncp_src, ncp_tgt, algebraic)
+    if key not in _interp_matrices:
+        tau_tgt = [0.] + collptsgen(ncp_tgt, 1, 0)
+        basis = lgry if algebraic else lgr
+        _interp_matrices[key] = np.array([[basis(k, tau, ncp_src, 1, 0) for k in range(0, ncp_src + 1)]
+                                          for tau in tau_tgt])
+    return _interp_matrices[key]
+
+
+def load_iguess(src, tgt, fe_src, fe_tgt, interpolate=True):
+    # type: (ConcreteModel, ConcreteModel, int, int, bool) -> None
     """Loads the current values of the src model into the tgt model, i.e. src-->tgt.
     This will assume that the time set is always at the beginning.
 
@@ -254,6 +287,10 @@ def load_iguess(src, tgt, fe_src, fe_tgt):
         tgt (ConcreteModel): Model with the target variables.
         fe_src (int): Source finite element.
         fe_tgt (int): Target finite element.
+        interpolate (bool): If the number of collocation points differs, interpolate the source element (otherwise
+            the last value of the source element is copied to every point). The differential states (a matching
+            DerivativeVar or <state>_ic) are interpolated through the element start, the rest only through the
+            collocation points.
 
     Returns:
         None:
@@ -338,6 +375,35 @@ def load_iguess(src, tgt, fe_src, fe_tgt):
                             t_tgt = t_ij(tS_tgt, fe_tgt, j)
                             index = index if isinstance(index, tuple) else (index,)  #: Transform to tuple
                             vd[(t_tgt,) + index].set_value(value(vs[(t_src,) + index]))
+    elif interpolate:
+        t_src = [t_ij(tS_src, fe_src, j) for j in range(0, cp_src + 1)]
+        t_tgt = [t_ij(tS_tgt, fe_tgt, j) for j in range(0, cp_tgt + 1)]
+        states = set(dv.get_state_var().getname() for dv in src.component_objects(Var)
+                     if isinstance(dv, DerivativeVar))
+        for vs in src.component_objects(Var, active=True):
+            algebraic = isinstance(vs, DerivativeVar) or \
+                        not (vs.getname() in states or hasattr(src, vs.getname() + "_ic"))
+            M = interpolation_matrix(cp_src, cp_tgt, algebraic=algebraic)
+            if vs._implicit_subsets is None:
+                if vs.index_set() is not tS_src:
+                    continue
+                remaining_set = [tuple()]
+            else:
+                if tS_src not in vs._implicit_subsets:
+                    continue
+                remaining_set = vs._implicit_subsets[1]
+                for j in range(2, len(vs._implicit_subsets)):
+                    remaining_set *= vs._implicit_subsets[j]
+            vd = getattr(tgt, vs.getname())
+            for index in remaining_set:
+                index = index if isinstance(index, tuple) else (index,)  #: Transform to tuple
+                vals = [vs[(t,) + index].value for t in t_src]
+                if algebraic:
+                    vals[0] = 0.  #: not used
+                if None in vals:
+                    continue
+                for (t, val) in zip(t_tgt, M.dot(vals)):
+                    vd[(t,) + index].set_value(float(val))
     else:
         for vs in src.component_objects(Var, active=True):
             if vs._implicit_subsets is None:
@@ -413,11 +479,64 @@ def augment_steady(dmod):
         dmod.is_steady = True
 
 
-def aug_discretization(d_mod, nfe, ncp):
+def aug_discretization(d_mod, nfe, ncp, fe_lengths=None):
+    """Radau collocation of the model.
+
+    Args:
+        d_mod (ConcreteModel): Model with a ContinuousSet whose bounds are already set (see augment_model).
+        nfe (int): Number of finite elements.
+        ncp (int): Number of collocation points.
+        fe_lengths (list): Lengths of the finite elements for a non-uniform grid, they must add up to the length of
+            the ContinuousSet. None gives uniform elements.
+    """
+    if fe_lengths is not None:
+        cs = [s for s in d_mod.component_objects(ContinuousSet)][-1]
+        if len(fe_lengths) != nfe:
+            raise ValueError("fe_lengths must have nfe = {:d} elements".format(nfe))
+        t0, tf = min(cs), max(cs)
+        if abs(t0 + sum(fe_lengths) - tf) > 1e-06:
+            raise ValueError("fe_lengths must add up to {}".format(tf - t0))
+        tb = t0
+        for h in fe_lengths[:-1]:
+            tb += h
+            cs.add(round(tb, 6))
+        cs._fe = sorted(cs)
+        cs.set_changed(True)
     collocation = TransformationFactory("dae.collocation")
     collocation.apply_to(d_mod, nfe=nfe, ncp=ncp, scheme="LAGRANGE-RADAU")
 
 
+def shift_profile(d_mod, dt):
+    # type: (ConcreteModel, float) -> None
+    """Shifts the time profiles of the variables of the model, v(t) <- v(t + dt). The values between the points of
+    the time set are interpolated linearly and the last value is held. Works for any finite element grid.
+
+    Args:
+        d_mod (ConcreteModel): Model (discretized), the time set is d_mod.t.
+        dt (float): Shift.
+    """
+    tS = d_mod.t
+    pts = np.array(sorted(tS))
+    for v in d_mod.component_objects(Var, active=True):
+        if v._implicit_subsets is None:
+            if v.index_set() is not tS:
+                continue
+            remaining_set = [tuple()]
+        else:
+            if tS not in v._implicit_subsets:
+                continue
+            remaining_set = v._implicit_subsets[1]
+            for j in range(2, len(v._implicit_subsets)):
+                remaining_set *= v._implicit_subsets[j]
+        for index in remaining_set:
+            index = index if isinstance(index, tuple) else (index,)  #: Transform to tuple
+            vals = [v[(t,) + index].value for t in pts]
+            if None in vals:
+                continue
+            for (t, val) in zip(pts, np.interp(pts + dt, pts, vals)):
+                v[(t,) + index].set_value(float(val))
+
+
 def create_bounds(d_mod, bounds=None, clear=False, pre_clear_check=True):
     #: might want to do something about fixed variables
     if pre_clear_check:
@@ -478,17 +597,27 @@ def get_lu_KKT(namestamp = ""):
     lu_kkt = splu(kkt)
     return lu_kkt, size_kkt
     
-def get_jacobian_k_aug(namestamp = ""):
+def get_jacobian_k_aug(namestamp = "", sparse = False):
+    """Reads the Jacobian written by k_aug (jacobi_debug.in).
+
+    Args:
+        namestamp (str): Suffix of the file name.
+        sparse (bool): Return a scipy.sparse.csr_matrix instead of a dense array.
+
+    Returns:
+        tuple: The Jacobian and its size (rows, cols).
+    """
     filename = "jacobi_debug" + str(namestamp) + ".in"
     jac_info = np.genfromtxt(filename, dtype = float)
-    row_jac_info,_ = np.shape(jac_info)
+    jac_info = np.atleast_2d(jac_info)
     row_jac = jac_info[0,0]
     col_jac = jac_info[0,1]
-    jac = lil_matrix((np.int(row_jac),np.int(col_jac)))
-    for ii in range(1, row_jac_info): #first row is #of constraints, variables, and nonzeros
-        jac[np.int(jac_info[ii, 0]) - 1, np.int(jac_info[ii, 1]) - 1] = jac_info[ii, 2]  # row # in txt => index     
-    jac = jac.tocsc()
-    jac = jac.toarray()
+    entries = jac_info[1:] #first row is #of constraints, variables, and nonzeros
+    rows = entries[:, 0].astype(int) - 1  # row # in txt => index
+    cols = entries[:, 1].astype(int) - 1
+    jac = coo_matrix((entries[:, 2], (rows, cols)), shape=(int(row_jac), int(col_jac))).tocsr()
+    if not sparse:
+        jac = jac.toarray()
     sizejac = (row_jac, col_jac)
     return jac, sizejac
 
@@ -511,6 +640,37 @@ def dlqr(A,B,Q,R):
  
     return K, X, eigVals
 
+def factor_weight(W, band=None):
+    # type: (np.ndarray, int) -> np.ndarray
+    """Upper triangular factor U of a symmetric positive (semi)definite weight matrix, W = U.T U.
+
+    A quadratic form 0.5 x.T W x can then be written as 0.5 sum(z ** 2) with z = U x, linear in x.
+
+    Args:
+        W (np.ndarray): Symmetric weight matrix.
+        band (int): Keep only the first band super-diagonals of U (banded approximation of W). None keeps all.
+
+    Returns:
+        np.ndarray: The factor U.
+    """
+    W = 0.5 * (np.asarray(W, dtype=float) + np.asarray(W, dtype=float).T)
+    n = W.shape[0]
+    if n == 0:
+        return np.zeros((0, 0))
+    try:
+        L = np.linalg.cholesky(W)
+    except np.linalg.LinAlgError:
+        #: Not positive definite (e.g. round-off from the reduced hessian); clip the spectrum
+        lam, V = np.linalg.eigh(W)
+        eps = max(np.abs(lam).max(), 1.) * 1e-12
+        lam = np.maximum(lam, eps)
+        L = np.linalg.cholesky((V * lam).dot(V.T) + eps * np.eye(n))
+    U = L.T
+    if band is not None:
+        U = np.tril(U, band)
+    return U
+
+
 def abline(slope, intercept, label = None):
     """Plot a line from slope and intercept"""
     axes = plt.gca()
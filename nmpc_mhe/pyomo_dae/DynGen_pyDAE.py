@@ -15,6 +15,12 @@ import datetime
 from shutil import copyfile
 from nmpc_mhe.aux.utils import t_ij, load_iguess, augment_model, augment_steady
 from nmpc_mhe.aux.utils import clone_the_model, aug_discretization, create_bounds
+from nmpc_mhe.aux.plant_sim import PlantSim, PlantSimError
+from nmpc_mhe.aux.parallel import BackgroundTask, wait_any
+from nmpc_mhe.aux.derivatives import active_constraints, free_variables, evaluate_jacobian, evaluate_param_jacobian
+from pyomo.core.kernel.component_map import ComponentMap
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
 import sys
 import time
 import re
@@ -50,6 +56,15 @@ class UnexpectedOption(RuntimeError):
         pass
 
 
+#: Alternative ipopt options of the retries after a failed solve, one set per rung (see solve_dyn_retry)
+RETRY_LADDER = [{"tol": 1e-03},
+                {"tol": 1e-03, "jacobian_regularization_value": 1e-04, "ma57_small_pivot_flag": 1,
+                 "ma57_pre_alloc": 5},
+                {"tol": 1e-03, "linear_scaling_on_demand": True, "ma57_pivtol": 1e-12, "ma57_pre_alloc": 5},
+                {"tol": 1e-03, "bound_push": 0.1, "ma57_pivtol": 1e-12, "ma57_pre_alloc": 5,
+                 "linear_scaling_on_demand": True}]
+
+
 class DynGen_DAE(object):
     """Default class for the Dynamic model"""
 
@@ -68,6 +83,24 @@ class DynGen_DAE(object):
       
 
         self.var_bounds = kwargs.get("var_bounds", None)
+        #: "ipopt" solves the collocation model of the plant, "radau"/"bdf" integrate it (see nmpc_mhe.aux.plant_sim)
+        self.plant_backend = kwargs.get("plant_backend", "ipopt")
+        if self.plant_backend not in ("ipopt", "radau", "bdf"):
+            raise ValueError("plant_backend must be ipopt, radau or bdf, got {}".format(self.plant_backend))
+        self.plant_sim = None
+        #: "nlp" solves PlantPred for curr_pstate, "sens" uses a linearization of the PlantSample (NLP as fallback)
+        self.predictor = kwargs.get("predictor", "nlp")
+        if self.predictor not in ("nlp", "sens"):
+            raise ValueError("predictor must be nlp or sens, got {}".format(self.predictor))
+        self.predictor_trust_region = kwargs.get("predictor_trust_region", 0.05)  #: relative, on (x0, u)
+        self._sens_pred = None
+        self.pred_stats = {"sens": 0, "nlp": 0, "linearizations": 0}
+        self.deadline = kwargs.get("deadline", None)  #: seconds per control interval for solve_dyn_deadline
+        self.missed_deadlines = {}  #: model name -> number of solves that missed the deadline
+        self._background = {}  #: model name -> BackgroundTask of a solve past its deadline
+        #: Option sets tried concurrently after a failed solve, the first optimal one wins (None retries serially)
+        self.retry_ladder = kwargs.get("retry_ladder", None)
+        self.retry_log = []  #: One entry per call to solve_dyn_retry
         create_bounds(self.d_mod, pre_clear_check=True)
 
         self.hi_t = hi_t
@@ -164,6 +197,8 @@ class DynGen_DAE(object):
         self.ip_time = 0
 
         self._stall_iter = 0
+        self.solve_log = []  #: One entry per call to solve_dyn, (wall) time and termination of the solve
+        self.uinject_log = []  #: One entry per call to plant_uinject, number of solves of the continuation
         self._window_keep = self.nfe_t + 2
 
         self._u_plant = {}  #: key: (ui, time)
@@ -300,6 +335,8 @@ class DynGen_DAE(object):
             mod (pyomo.core.base.PyomoModel.ConcreteModel): Target model
         Return:
             int: 0 if success 1 otw"""
+        if mod is self.PlantSample and self.plant_backend != "ipopt":
+            return self.simulate_plant(stop_if_nopt=kwargs.get("stop_if_nopt", False), tag=kwargs.get("tag", None))
         d = mod
         mu_init = 0.1
         iter_max = 3000
@@ -473,6 +510,7 @@ class DynGen_DAE(object):
         # Solution attempt
 
         results = None
+        solve_start = time.time()
         try:
             results = solver_ip.solve(d,
                                       tee=o_tee,
@@ -482,6 +520,12 @@ class DynGen_DAE(object):
         except (ApplicationError, ValueError):
             stop_if_nopt = 1
             d.write(filename="failure_.nl", io_options={"symbolic_solver_labels": True})
+        self.solve_log.append({"iteration": self._iteration_count,
+                               "model": name,
+                               "tag": tag,
+                               "time": time.time() - solve_start,
+                               "termination": str(results.solver.termination_condition)
+                               if isinstance(results, SolverResults) else "exception"})
 
         if isinstance(results, SolverResults):
             print(results.Solver.termination_condition, file=sys.stderr)
@@ -537,6 +581,135 @@ class DynGen_DAE(object):
         self.journalist("W", self._iteration_count, "solve_dyn", "Not-optimal.")
         return 1
 
+    def solve_dyn_deadline(self, mod, deadline=None, **kwargs):
+        """Solves a model in a background process and waits at most deadline seconds for it. If the deadline is missed
+        the solve keeps running, the next call for the same model loads its result as initial guess (or cancels it if
+        it is still running).
+        Args:
+            mod (pyomo.core.base.PyomoModel.ConcreteModel): Target model
+            deadline (float): Seconds, defaults to the deadline of the constructor (None solves in the foreground)
+            **kwargs: Options of solve_dyn
+        Return:
+            int: 0 if success, 1 if not optimal, 2 if the deadline was missed"""
+        deadline = self.deadline if deadline is None else deadline
+        if mod.name in self._background:
+            self.collect_background(mod, wait=False)
+        if deadline is None:
+            return self.solve_dyn(mod, **kwargs)
+        bg = self._background_solve(mod, **kwargs)
+        if bg.wait(deadline):
+            return self._load_background(mod, bg)
+        self.missed_deadlines[mod.name] = self.missed_deadlines.get(mod.name, 0) + 1
+        self._background[mod.name] = bg
+        self.journalist("W", self._iteration_count, "solve_dyn_deadline",
+                        "{} missed the deadline ({:d} so far)".format(mod.name, self.missed_deadlines[mod.name]))
+        return 2
+
+    def collect_background(self, mod, wait=False):
+        """Result of a solve that missed its deadline, loaded into mod if it finished (cancelled otw unless wait)
+        Return:
+            int: Status of the solve, None if it did not finish"""
+        bg = self._background.pop(mod.name)
+        if bg.wait(None if wait else 0):
+            return self._load_background(mod, bg)
+        bg.cancel()
+        self.journalist("W", self._iteration_count, "collect_background", "Cancelled the solve of " + mod.name)
+        return None
+
+    def solve_dyn_retry(self, mod, ladder=None, timeout=None, **kwargs):
+        """Retries a failed solve with every rung of the ladder at the same time, each one in its own process (with
+        its own copy of the model and working directory). The first optimal result is loaded, the rest is cancelled.
+        Args:
+            mod (pyomo.core.base.PyomoModel.ConcreteModel): Target model
+            ladder (list): Dictionaries of solve_dyn options, defaults to retry_ladder (or RETRY_LADDER)
+            timeout (float): Seconds to wait for an optimal result (None waits for all the rungs)
+            **kwargs: Options of solve_dyn common to all the rungs
+        Return:
+            int: 0 if one of the rungs succeeded 1 otw"""
+        ladder = ladder or self.retry_ladder or RETRY_LADDER
+        start = time.time()
+        tasks = []
+        for rung in ladder:
+            options = dict(kwargs)
+            options.update(rung)
+            options["stop_if_nopt"] = False
+            tasks.append(self._background_solve(mod, **options))
+        winner = None
+        pending = list(tasks)
+        while pending and winner is None:
+            left = None if timeout is None else timeout - (time.time() - start)
+            if left is not None and left <= 0:
+                break
+            for bg in wait_any(pending, left):
+                pending.remove(bg)
+                if bg.status == "ok" and bg.value[0] == 0:
+                    winner = bg
+                    break
+        for bg in pending:
+            bg.cancel()
+        stat = 1 if winner is None else self._load_background(mod, winner)
+        self.retry_log.append({"model": mod.name, "time": time.time() - start,
+                               "rung": None if winner is None else tasks.index(winner),
+                               "failed": sum(1 for bg in tasks if bg.status == "ok" and bg.value[0] != 0)})
+        self.journalist("I" if stat == 0 else "W", self._iteration_count, "solve_dyn_retry",
+                        "{} rung {}".format(mod.name, self.retry_log[-1]["rung"]))
+        return stat
+
+    def _background_solve(self, mod, **kwargs):
+        """solve_dyn in a BackgroundTask, the values of the variables and the solve_log entry are sent back"""
+        vars_ = [v for v in mod.component_data_objects(Var)]
+
+        def task():
+            stat = self.solve_dyn(mod, **kwargs)
+            return stat, [v.value for v in vars_], self.solve_log[-1] if self.solve_log else None
+
+        return BackgroundTask(task)
+
+    def _load_background(self, mod, bg):
+        if bg.status != "ok":
+            print(bg.value, file=sys.stderr)
+            return 1
+        stat, values, entry = bg.value
+        for (v, val) in zip(mod.component_data_objects(Var), values):
+            v.value = val
+        if entry is not None:
+            self.solve_log.append(entry)
+        return stat
+
+    def simulate_plant(self, method=None, stop_if_nopt=False, tag=None):
+        """Advances the PlantSample by numerical integration instead of ipopt
+        Args:
+            method (str): "radau" or "bdf", defaults to the plant_backend (radau if that is ipopt)
+            stop_if_nopt (bool): Raise DynSolWeAreDone if the integration fails
+            tag (str): Tag of the entry in the solve_log
+        Return:
+            int: 0 if success 1 otw"""
+        if method is None:
+            method = self.plant_backend if self.plant_backend != "ipopt" else "radau"
+        self.journalist("I", self._iteration_count, "simulate_plant", "Integrating with " + method)
+        solve_start = time.time()
+        try:
+            if self.plant_sim is None:
+                self.plant_sim = PlantSim(self.PlantSample, self.states, self.state_vars)
+            self.plant_sim.method = {"radau": "Radau", "bdf": "BDF"}[method]
+            self.plant_sim.simulate()
+            termination = "optimal"
+        except PlantSimError as exc:
+            print(exc, file=sys.stderr)
+            termination = "failure"
+        self.solve_log.append({"iteration": self._iteration_count,
+                               "model": self.PlantSample.name,
+                               "tag": tag,
+                               "time": time.time() - solve_start,
+                               "termination": termination})
+        if termination == "optimal":
+            return 0
+        if stop_if_nopt:
+            self.journalist("E", self._iteration_count, "simulate_plant", "Integration failed. Stoping")
+            raise DynSolWeAreDone("Integrator: we are done :(")
+        self.journalist("W", self._iteration_count, "simulate_plant", "Integration failed.")
+        return 1
+
     def cycleSamPlant(self, plant_step=False):
         """Patches the initial conditions with the last result from the simulation
         Args:
@@ -653,17 +826,21 @@ class DynGen_DAE(object):
         Args:
             d_mod (pyomo.core.base.PyomoModel.ConcreteModel): Model to be updated
             src_kind (str): Kind of update (default=dict)
-            nsteps (int): The number of continuation steps (default=5)
+            nsteps (int): If the full step fails the continuation starts with 1/nsteps of it (default=5)
         Keyword Args:
             src (pyomo.core.base.PyomoModel.ConcreteModel): Source model
-            src_fe (int): Finite element from the source model"""
+            src_fe (int): Finite element from the source model
+            iter_fast (int): Iteration limit of the continuation solves, converging within it grows the step
+            min_step (float): Smallest step before falling back to the loose solves
+        Return:
+            int: The number of solves (also in uinject_log, with the status of the last solve, None if no continuation
+            was needed)"""
         from pyomo.core.base.numvalue import value
         self.journalist("I", self._iteration_count, "plant_input", "Continuation_plant, src_kind=" + src_kind)
         #: Inputs
         target = {}
         current = {}
         ncont_steps = nsteps
-        sinopt = False
         if src_kind == "mod":
             src = kwargs.pop("src", None)
             if src:
@@ -695,59 +872,90 @@ class DynGen_DAE(object):
         cn = sum(current[u] for u in self.u) ** (1 / len(self.u))
         pgap = abs((tn - cn) / cn)
         print("Current Gap /\% {:f}".format(pgap * 100))
-        if pgap < 1e-05:
-            ncont_steps = 2
-        if skip_homotopy:
-            pass
+        n_solves = 0
+        stat = None
+        if skip_homotopy or (d_mod is self.PlantSample and self.plant_backend != "ipopt"):
+            pass  #: the integrator does not need continuation
         else:
-            for i in range(0, ncont_steps):
-                for u in self.u:
-                    plant_var = getattr(d_mod, u)
-                    plant_var[0].value += (target[u] - current[u]) / ncont_steps
-                    pgap -= pgap / ncont_steps
-                    print("Continuation {:d} :Current {:s}\t{:f}\t :Gap /\% {:f}".format(i, u, value(plant_var[0]),
-                                                                                         pgap * 100))
-                if i == ncont_steps - 1:
-                    sinopt = False
-                    tstv = self.solve_dyn(d_mod,
-                                          o_tee=True,
-                                          stop_if_nopt=False,
-                                          print_level=2,
-                                          max_cpu_time=120,
-                                          print_user_options=False)
-                else:
-                    tstv = self.solve_dyn(d_mod, o_tee=False,
-                                          stop_if_nopt=False,
-                                          print_level=2,
-                                          max_cpu_time=120,
-                                          print_user_options=False)
-                if tstv != 0:
-                    try:
-                        self.solve_dyn(d_mod, o_tee=True,
-                                       max_cpu_time=240,
-                                       halt_on_ampl_error=True,
-                                       tol=1e-03,
-                                       output_file="failed_homotopy_d1.txt",
-                                       stop_if_nopt=sinopt)
-                    except (ApplicationError, ValueError):
-                        print("Ipopt FAIL", file=sys.stderr)
-                        self.PlantSample.write_nl(name="baddie.nl")
-                        self.PlantSample.pprint(filename="baddie.txt")
-                        self.PlantSample.snap_shot(filename="baddie.py")
-                        self.PlantSample.report_zL(filename="bad_bounds")
-                        self.solve_dyn(d_mod, o_tee=True,
-                                       halt_on_ampl_error=True,
-                                       bound_push=0.1,
-                                       tol=1e-03,
-                                       output_file="failed_homotopy_d2.txt",
-                                       stop_if_nopt=sinopt,
-                                       ma57_pivtol=1e-12,
-                                       ma57_pre_alloc=5,
-                                       linear_scaling_on_demand=True)
+            n_solves, stat = self._adaptive_continuation(d_mod, target, current, nsteps, **kwargs)
         for u in self.u:
             plant_var = getattr(d_mod, u)
             for key in plant_var.keys():
                 plant_var[key].value = target[u]  #: To be sure
+        self.uinject_log.append({"iteration": self._iteration_count, "model": d_mod.name, "gap": pgap,
+                                 "solves": n_solves, "status": stat})
+        self.journalist("W" if stat else "I", self._iteration_count, "plant_input",
+                        "Solves {:d}, status {}".format(n_solves, stat))
+        return n_solves
+
+    def _adaptive_continuation(self, d_mod, target, current, nsteps, **kwargs):
+        """Moves the controls of d_mod from current to target. The full step is tried first, on failure the step is
+        1/nsteps and it doubles after every solve that converges within iter_fast iterations, it halves after every
+        failure (restoring the last converged point). Below min_step the loose solves are the last resort.
+        Return:
+            tuple: The number of solves and the status of the last one (0 if the target was reached)"""
+        iter_fast = kwargs.pop("iter_fast", 100)
+        min_step = kwargs.pop("min_step", 1e-03)
+
+        def set_controls(lam):
+            for u in self.u:
+                plant_var = getattr(d_mod, u)
+                for key in plant_var.keys():
+                    plant_var[key].value = current[u] + lam * (target[u] - current[u])
+
+        vars_ = [v for v in d_mod.component_data_objects(Var)]
+        lam = 0.0  #: fraction of the control move that has converged
+        step = 1.0
+        n_solves = 0
+        while lam < 1.0:
+            trial = min(1.0, lam + step)
+            snapshot = [v.value for v in vars_]
+            set_controls(trial)
+            stat = self.solve_dyn(d_mod, o_tee=(trial == 1.0),
+                                  stop_if_nopt=False,
+                                  print_level=2,
+                                  max_cpu_time=120,
+                                  iter_max=iter_fast if n_solves > 0 else 3000,
+                                  print_user_options=False)
+            n_solves += 1
+            print("Continuation {:d} :lambda {:f}\tstep {:f}\tstatus {:d}".format(n_solves, trial, step, stat))
+            if stat == 0:
+                lam = trial
+                step = 2.0 * step if n_solves > 1 else step
+                continue
+            for (v, val) in zip(vars_, snapshot):
+                v.value = val
+            step = step / nsteps if n_solves == 1 else 0.5 * step
+            if step < min_step:
+                break
+        if lam < 1.0 and self.retry_ladder is not None:
+            set_controls(1.0)
+            stat = self.solve_dyn_retry(d_mod, o_tee=False, max_cpu_time=240)
+            #: rungs that finished, the ones cancelled by the winner do not count
+            n_solves += self.retry_log[-1]["failed"] + (self.retry_log[-1]["rung"] is not None)
+        elif lam < 1.0:
+            set_controls(1.0)
+            try:
+                stat = self.solve_dyn(d_mod, o_tee=True,
+                                      max_cpu_time=240,
+                                      halt_on_ampl_error=True,
+                                      tol=1e-03,
+                                      output_file="failed_homotopy_d1.txt",
+                                      stop_if_nopt=False)
+            except (ApplicationError, ValueError):
+                print("Ipopt FAIL", file=sys.stderr)
+                stat = self.solve_dyn(d_mod, o_tee=True,
+                                      halt_on_ampl_error=True,
+                                      bound_push=0.1,
+                                      tol=1e-03,
+                                      output_file="failed_homotopy_d2.txt",
+                                      stop_if_nopt=False,
+                                      ma57_pivtol=1e-12,
+                                      ma57_pre_alloc=5,
+                                      linear_scaling_on_demand=True)
+                n_solves += 1
+            n_solves += 1
+        return n_solves, stat
 
     def update_u(self, src, **kwargs):
         """Update the current control(input) vector
@@ -790,8 +998,90 @@ class DynGen_DAE(object):
             for j in self.state_vars[x]:
                 self.curr_rstate[(x, j)] = value(xvar[t, j])
 
+    def build_sens_predictor(self):
+        """Linearizes the map (initial state, controls) -> final state of the PlantSample at its current solution.
+        The collocation Jacobian is factorized once and only the rows of the final state are solved for.
+        Return:
+            bool: False if the PlantSample is not square"""
+        m = self.PlantSample
+        cons = active_constraints(m)
+        w = free_variables(m, cons)
+        if len(w) != len(cons):
+            self.journalist("W", self._iteration_count, "build_sens_predictor", "PlantSample is not square")
+            self._sens_pred = None
+            return False
+        params = []
+        group = []  #: column of (x0, u) for every Param
+        p0 = []
+        for x in self.states:
+            xic = getattr(m, x + "_ic")
+            for j in self.state_vars[x]:
+                group.append(len(p0))
+                params.append(xic[j])
+                p0.append(value(xic[j]))
+        for u in self.u:
+            uvar = getattr(m, u)
+            for key in uvar.keys():
+                group.append(len(p0))
+                params.append(uvar[key])
+            p0.append(value(uvar[0]))
+        jw, _, _ = evaluate_jacobian(m, variables=w, constraints=cons)
+        jp, _, _ = evaluate_param_jacobian(m, params, constraints=cons)
+        position = ComponentMap((v, i) for (i, v) in enumerate(w))
+        tf = t_ij(m.t, 0, self.ncp_t)
+        final = [getattr(m, x)[(tf,) + j] for x in self.states for j in self.state_vars[x]]
+        sel = np.zeros((len(w), len(final)))
+        for (k, v) in enumerate(final):
+            sel[position[v], k] = 1.0
+        lam = splu(csc_matrix(jw)).solve(sel, trans="T")  #: Fw^-T E
+        sens = -jp.T.dot(lam).T  #: dxf/dparams
+        agg = np.zeros((len(params), len(p0)))
+        agg[np.arange(0, len(params)), group] = 1.0
+        self._sens_pred = {"S": sens.dot(agg), "p": np.array(p0), "xf": np.array([value(v) for v in final])}
+        self.pred_stats["linearizations"] += 1
+        return True
+
+    def sens_predictor_step(self, src="estimated"):
+        """Predicts curr_pstate with the linearization of the PlantSample. The linearization is reused while (x0, u)
+        is within the trust region of its point, otherwise it is rebuilt at the current PlantSample solution.
+        Return:
+            bool: False if the step is outside of the trust region (the NLP predictor has to be used)"""
+        state = self.curr_estate if src == "estimated" else self.curr_rstate
+        xf = self.sens_predict(state, self.curr_u)
+        if xf is None:
+            return False
+        self.curr_pstate.update(xf)
+        return True
+
+    def sens_predict(self, state, u_dict):
+        """Final state of one sampling interval from the linearization of the PlantSample (see sens_predictor_step)
+        Args:
+            state (dict): Initial state, (x, j) -> value
+            u_dict (dict): Controls, u -> value
+        Return:
+            dict: Final state, None if (x0, u) is outside of the trust region"""
+        keys = [(x, j) for x in self.states for j in self.state_vars[x]]
+        p = np.array([state[k] for k in keys] + [u_dict[u] for u in self.u], dtype=float)
+
+        def step():
+            sp = self._sens_pred
+            dp = p - sp["p"]
+            return dp, np.max(np.abs(dp) / np.maximum(np.abs(sp["p"]), 1.0))
+
+        if self._sens_pred is None or step()[1] > self.predictor_trust_region:
+            if not self.build_sens_predictor() or step()[1] > self.predictor_trust_region:
+                self.journalist("W", self._iteration_count, "sens_predict", "Outside of the trust region")
+                return None
+        dp, _ = step()
+        xf = self._sens_pred["xf"] + self._sens_pred["S"].dot(dp)
+        return dict(zip(keys, xf))
+
     def update_state_predicted(self, src="estimated"):
         """Make a prediction for the next state"""
+        if self.predictor == "sens" and self.sens_predictor_step(src=src):
+            self.pred_stats["sens"] += 1
+            return
+        self.pred_stats["nlp"] += 1
 
         if self.PlantPred:
             print(self.PlantPred)
@@ -13,12 +13,56 @@ from pyomo.core.base import Var, Objective, minimize, Set, Constraint, Expressio
 from pyomo.core.base.numvalue import value as value
 from pyutilib.common._exceptions import ApplicationError
 from nmpc_mhe.aux.utils import fe_compute, load_iguess, augment_model
-from nmpc_mhe.aux.utils import t_ij, clone_the_model, aug_discretization, create_bounds
+from nmpc_mhe.aux.utils import t_ij, clone_the_model, aug_discretization, create_bounds, factor_weight
+from nmpc_mhe.aux.utils import shift_profile
 from nmpc_mhe.pyomo_dae.NMPCGen_pyDAE import NmpcGen_DAE
 
 __author__ = "David Thierry @dthierry" #: March 2018
 
 
+def _weight_blocks(n, blocks):
+    """Sorted blocks of positions, every position belongs to exactly one block"""
+    if blocks is None:
+        return [list(range(0, n))]
+    blocks = [sorted(b) for b in blocks]
+    listed = [i for b in blocks for i in b]
+    if len(set(listed)) != len(listed) or any(i < 0 or i >= n for i in listed):
+        raise ValueError("The blocks must be disjoint positions in range(0, {:d})".format(n))
+    return blocks + [[i] for i in range(0, n) if i not in set(listed)]
+
+
+def _factor_cols(n, blocks):
+    """Columns of the upper-triangular factor for every row"""
+    cols = [[] for _ in range(0, n)]
+    for b in blocks:
+        for a in range(0, len(b)):
+            cols[b[a]] = b[a:]
+    return cols
+
+
+def _diag_weights(cov, n_t, n):
+    """Inverse variances from a vector, (n,) or (n_t, n), as values for a Param indexed by (t, k)"""
+    cov = np.asarray(cov, dtype=float)
+    if cov.ndim == 1:
+        cov = np.broadcast_to(cov, (n_t, n))
+    if cov.shape != (n_t, n):
+        raise ValueError("Expected a ({0},) or ({1}, {0}) array, got {2}".format(n, n_t, cov.shape))
+    if np.any(cov == 0.0):
+        raise ZeroDivisionError('wrong covariance')
+    w = 1 / cov
+    return dict(((i, k), w[i, k]) for i in range(0, n_t) for k in range(0, n))
+
+
+def _cov_array(cov_dict, key):
+    """Covariance dictionary with keys [(name, j), (name, k)] to a symmetric array in the order given by key"""
+    cov = np.zeros((len(key), len(key)))
+    for (vj, vk), c in cov_dict.items():
+        j = key[(vj[0],) + vj[1]]
+        k = key[(vk[0],) + vk[1]]
+        cov[j, k] = cov[k, j] = c
+    return cov
+
+
 class MheGen_DAE(NmpcGen_DAE):
     def __init__(self, d_mod, hi_t, states, controls, noisy_states, measurements, **kwargs):
         # type: (ConcreteModel, float, list, list, list, list, dict) -> None
@@ -49,21 +93,43 @@ class MheGen_DAE(NmpcGen_DAE):
         if self.diag_Q_R:
             self.journalist('W', self._iteration_count, "Initializing MHE", "The Q_MHE and R_MHE matrices are diagonal")
 
+        #: With diag_QR=False the weights are block-diagonal; blocks are lists of positions in xkN_key (yk_key) order
+        #: and the positions not listed form 1x1 blocks. None means a single full block.
+        Q_blocks = kwargs.pop('Q_blocks', None)
+        R_blocks = kwargs.pop('R_blocks', None)
+
         self.IgnoreProcessNoise = kwargs.pop('IgnoreProcessNoise', False)
+        #: "dense" double sum with PikN_mhe or "factorized" 0.5 * sum(z**2), z = U (x - x0), with PikN_mhe = U.T U
+        self.arrival_cost = kwargs.pop('arrival_cost', 'dense')
+        self.arrival_band = kwargs.pop('arrival_band', None)  #: Number of super-diagonals of U kept (None: all)
+        if self.arrival_cost not in ("dense", "factorized"):
+            raise ValueError("arrival_cost must be dense or factorized %s" % self.arrival_cost)
         # One can specify different discretization lenght
         self.nfe_tmhe = kwargs.pop('nfe_tmhe', self.nfe_t)  #: Specific number of finite elements
         self.ncp_tmhe = kwargs.pop('ncp_tmhe', self.ncp_t)  #: Specific number of collocation points
+        #: Lengths of the finite elements of the lsmhe, e.g. coarse in the past and fine near the present (the last
+        #: one is the sampling time). None gives nfe_tmhe elements of length hi_t
+        self.fe_lengths_mhe = kwargs.pop('fe_lengths_mhe', None)
+        if self.fe_lengths_mhe is None:
+            self.fe_lengths_mhe = [self.hi_t] * self.nfe_tmhe
+        else:
+            self.nfe_tmhe = len(self.fe_lengths_mhe)
+            if abs(self.fe_lengths_mhe[-1] - self.hi_t) > 1e-09:
+                raise ValueError("The last finite element must have the length of the sampling time %s" % self.hi_t)
+            self.journalist('W', self._iteration_count, "Initializing MHE",
+                            "Non-uniform grid: one measurement per finite element, the measurements of the coarse "
+                            "elements are not aligned with the sampling times after a shift")
 
         # nstates = sum(len(self.x_vars[x]) for x in self.x_noisy)
         # self.journalist("I", self._iteration_count, "MHE with \t", str(nstates) + "states")
-        _t_mhe = self.nfe_tmhe * self.hi_t
+        _t_mhe = sum(self.fe_lengths_mhe)
 
         self.lsmhe = clone_the_model(self.d_mod) # (self.nfe_tmhe, self.ncp_tmhe, _t=_t_mhe)
         self.dum_mhe = clone_the_model(self.d_mod)
 
         augment_model(self.lsmhe, self.nfe_tmhe, self.ncp_tmhe, new_timeset_bounds=(0, _t_mhe))
         augment_model(self.dum_mhe, 1, self.ncp_tmhe, new_timeset_bounds=(0, self.hi_t), given_name="Dummy[MHE]")
-        aug_discretization(self.lsmhe, self.nfe_tmhe, self.ncp_tmhe)
+        aug_discretization(self.lsmhe, self.nfe_tmhe, self.ncp_tmhe, fe_lengths=self.fe_lengths_mhe)
         self.lsmhe.name = "LSMHE (Least-Squares MHE)"
         create_bounds(self.lsmhe, bounds=self.var_bounds)
         #: create x_pi constraint
@@ -103,9 +169,16 @@ class MheGen_DAE(NmpcGen_DAE):
             if self.IgnoreProcessNoise else Var(self.lsmhe.fe_t, self.lsmhe.xkNk_mhe, initialize=0.0)  #: Model disturbance
         self.lsmhe.PikN_mhe = Param(self.lsmhe.xkNk_mhe, self.lsmhe.xkNk_mhe,
                                 initialize=lambda m, i, ii: 1. if i == ii else 0.0, mutable=True)  #: Prior-Covariance
-        self.lsmhe.Q_mhe = Param(range(0, (self.nfe_tmhe - 1)), self.lsmhe.xkNk_mhe, initialize=1, mutable=True) if self.diag_Q_R\
-            else Param(range(0, (self.nfe_tmhe - 1)), self.lsmhe.xkNk_mhe, self.lsmhe.xkNk_mhe,
-                             initialize=lambda m, t, i, ii: 1. if i == ii else 0.0, mutable=True)  #: Disturbance-weight
+        if self.diag_Q_R:
+            self.lsmhe.Q_mhe = Param(range(0, (self.nfe_tmhe - 1)), self.lsmhe.xkNk_mhe, initialize=1, mutable=True)
+        else:
+            #: Factor of the disturbance-weight, Q = U.T U; only the upper triangle of each block
+            self._Q_blocks = _weight_blocks(len(self.xkN_l), Q_blocks)
+            self._Q_cols = _factor_cols(len(self.xkN_l), self._Q_blocks)
+            self.lsmhe.xkNk_Q_mhe = Set(dimen=2, initialize=[(j, k) for j in range(0, len(self.xkN_l))
+                                                             for k in self._Q_cols[j]])
+            self.lsmhe.Q_L_mhe = Param(range(0, (self.nfe_tmhe - 1)), self.lsmhe.xkNk_Q_mhe,
+                                       initialize=lambda m, t, i, ii: 1. if i == ii else 0.0, mutable=True)
 
         #: Create list of measurements vars
         self.yk_l = {}
@@ -175,12 +248,19 @@ class MheGen_DAE(NmpcGen_DAE):
                        rule=lambda mod, t, i:mod.yk0_mhe[t, i] - self.yk_l[t][i] - mod.nuk_mhe[t, i] == 0.0)
         #: This will work because yk_l is indexed by fe
         self.lsmhe.hyk_c_mhe.deactivate()
-        self.lsmhe.R_mhe = Param(self.lsmhe.fe_t,
-                                 self.lsmhe.ykk_mhe,
-                                 initialize=1.0,
-                                 mutable=True) if self.diag_Q_R else \
-            Param(self.lsmhe.fe_t, self.lsmhe.ykk_mhe, self.lsmhe.ykk_mhe,
-                             initialize=lambda mod, t, i, ii: 1.0 if i == ii else 0.0, mutable=True)
+        if self.diag_Q_R:
+            self.lsmhe.R_mhe = Param(self.lsmhe.fe_t,
+                                     self.lsmhe.ykk_mhe,
+                                     initialize=1.0,
+                                     mutable=True)
+        else:
+            #: Factor of the measurement-weight, R = U.T U
+            self._R_blocks = _weight_blocks(len(self.yk_l[0]), R_blocks)
+            self._R_cols = _factor_cols(len(self.yk_l[0]), self._R_blocks)
+            self.lsmhe.ykk_R_mhe = Set(dimen=2, initialize=[(j, k) for j in range(0, len(self.yk_l[0]))
+                                                            for k in self._R_cols[j]])
+            self.lsmhe.R_L_mhe = Param(self.lsmhe.fe_t, self.lsmhe.ykk_R_mhe,
+                                       initialize=lambda mod, t, i, ii: 1.0 if i == ii else 0.0, mutable=True)
 
         #: Constraints for the input noise
         tfe_mhe_dic = dict()
@@ -258,23 +338,34 @@ class MheGen_DAE(NmpcGen_DAE):
         self.lsmhe.noisy_cont.deactivate()
 
         #: Expressions for the objective function (least-squares)
+        if not self.diag_Q_R:
+            #: 0.5 w.T Q w = 0.5 sum(z ** 2), with z = U w as linear constraints
+            if not self.IgnoreProcessNoise:
+                self.lsmhe.wk_z_mhe = Var(range(0, self.nfe_tmhe - 1), self.lsmhe.xkNk_mhe, initialize=0.0)
+                self.lsmhe.wk_z_c_mhe = Constraint(
+                    range(0, self.nfe_tmhe - 1), self.lsmhe.xkNk_mhe,
+                    rule=lambda m, i, j: m.wk_z_mhe[i, j] ==
+                                         sum(m.Q_L_mhe[i, j, k] * m.wk_mhe[i, k] for k in self._Q_cols[j]))
+            self.lsmhe.nuk_z_mhe = Var(self.lsmhe.fe_t, self.lsmhe.ykk_mhe, initialize=0.0)
+            self.lsmhe.nuk_z_c_mhe = Constraint(
+                self.lsmhe.fe_t, self.lsmhe.ykk_mhe,
+                rule=lambda m, i, j: m.nuk_z_mhe[i, j] ==
+                                     sum(m.R_L_mhe[i, j, k] * m.nuk_mhe[i, k] for k in self._R_cols[j]))
+
         self.lsmhe.Q_e_mhe = 0.0 if self.IgnoreProcessNoise else Expression(
             expr=0.5 * sum(
                 sum(
                     self.lsmhe.Q_mhe[i, k] * self.lsmhe.wk_mhe[i, k]**2 for k in self.lsmhe.xkNk_mhe)
                 for i in range(0, self.nfe_tmhe - 1))) if self.diag_Q_R else Expression(
-            expr=sum(sum(self.lsmhe.wk_mhe[i, j] *
-                         sum(self.lsmhe.Q_mhe[i, j, k] * self.lsmhe.wk_mhe[i, k] for k in self.lsmhe.xkNk_mhe)
-                         for j in self.lsmhe.xkNk_mhe) for i in range(0, self.nfe_tmhe - 1)))
+            expr=0.5 * sum(self.lsmhe.wk_z_mhe[i, k] ** 2
+                           for i in range(0, self.nfe_tmhe - 1) for k in self.lsmhe.xkNk_mhe))
 
         self.lsmhe.R_e_mhe = Expression(
             expr=0.5 * sum(
                 sum(
                     self.lsmhe.R_mhe[i, k] * self.lsmhe.nuk_mhe[i, k]**2 for k in self.lsmhe.ykk_mhe)
                 for i in self.lsmhe.fe_t)) if self.diag_Q_R else Expression(
-            expr=sum(sum(self.lsmhe.nuk_mhe[i, j] *
-                         sum(self.lsmhe.R_mhe[i, j, k] * self.lsmhe.nuk_mhe[i, k] for k in self.lsmhe.ykk_mhe)
-                         for j in self.lsmhe.ykk_mhe) for i in self.lsmhe.fe_t))
+            expr=0.5 * sum(self.lsmhe.nuk_z_mhe[i, k] ** 2 for i in self.lsmhe.fe_t for k in self.lsmhe.ykk_mhe))
         expr_u_obf = 0
         for i in self.lsmhe.fe_t:
             for u in self.u:
@@ -283,10 +374,26 @@ class MheGen_DAE(NmpcGen_DAE):
 
         self.lsmhe.U_e_mhe = Expression(expr=0.5 * expr_u_obf)  # how about this
 
-        self.lsmhe.Arrival_e_mhe = Expression(
-            expr=0.5 * sum((self.xkN_l[j] - self.lsmhe.x_0_mhe[j]) *
-                     sum(self.lsmhe.PikN_mhe[j, k] * (self.xkN_l[k] - self.lsmhe.x_0_mhe[k]) for k in self.lsmhe.xkNk_mhe)
-                     for j in self.lsmhe.xkNk_mhe))
+        if self.arrival_cost == "factorized":
+            #: The factor only changes values, the expressions are built once
+            n_x = len(self.xkN_l)
+            band = n_x if self.arrival_band is None else self.arrival_band
+            self._arrival_cols = [[k for k in range(j, min(n_x, j + band + 1))] for j in range(0, n_x)]
+            self.lsmhe.xkNk_L_mhe = Set(dimen=2, initialize=[(j, k) for j in range(0, n_x) for k in self._arrival_cols[j]])
+            self.lsmhe.PikN_L_mhe = Param(self.lsmhe.xkNk_L_mhe,
+                                          initialize=lambda m, j, k: 1. if j == k else 0.0, mutable=True)
+            self.lsmhe.zk_arrival_mhe = Var(self.lsmhe.xkNk_mhe, initialize=0.0)
+            self.lsmhe.arrival_c_mhe = Constraint(
+                self.lsmhe.xkNk_mhe,
+                rule=lambda m, j: m.zk_arrival_mhe[j] ==
+                                  sum(m.PikN_L_mhe[j, k] * (self.xkN_l[k] - m.x_0_mhe[k]) for k in self._arrival_cols[j]))
+            self.lsmhe.Arrival_e_mhe = Expression(
+                expr=0.5 * sum(self.lsmhe.zk_arrival_mhe[j] ** 2 for j in self.lsmhe.xkNk_mhe))
+        else:
+            self.lsmhe.Arrival_e_mhe = Expression(
+                expr=0.5 * sum((self.xkN_l[j] - self.lsmhe.x_0_mhe[j]) *
+                         sum(self.lsmhe.PikN_mhe[j, k] * (self.xkN_l[k] - self.lsmhe.x_0_mhe[k]) for k in self.lsmhe.xkNk_mhe)
+                         for j in self.lsmhe.xkNk_mhe))
 
         self.lsmhe.Arrival_dummy_e_mhe = Expression(
             expr=100000.0 * sum((self.xkN_l[j] - self.lsmhe.x_0_mhe[j]) ** 2 for j in self.lsmhe.xkNk_mhe))
@@ -308,7 +415,8 @@ class MheGen_DAE(NmpcGen_DAE):
                                               self.lsmhe.U_e_mhe)
         self.lsmhe.obfun_mhe.deactivate()
 
-        self._PI = {}  #: Container of the KKT matrix
+        self._PI = np.zeros((0, 0))  #: Container of the KKT matrix (inverse of the reduced hessian)
+        self._PikN = np.eye(len(self.xkN_l))  #: Copy of the values of PikN_mhe
         self.xreal_W = {}
         self.curr_m_noise = {}   #: Current measurement noise
         self.curr_y_offset = {}  #: Current offset of measurement
@@ -530,12 +638,14 @@ class MheGen_DAE(NmpcGen_DAE):
     def set_covariance_meas(self, cov_dict):
         """Sets covariance(inverse) for the measurements.
         Args:
-            cov_dict (dict): a dictionary with the following key structure [(meas_name, j), (meas_name, k), time]
+            cov_dict: With diag_QR, a dictionary of variances by measurement name or a vector of variances in yk_key
+            order ((nfe_tmhe, n_y) for time-varying values). Otherwise a covariance array in yk_key order,
+            (n_y, n_y) or (nfe_tmhe, n_y, n_y), or a dictionary with the key structure [(meas_name, j), (meas_name, k)]
         Returns:
             None
         """
-        rtarget = getattr(self.lsmhe, "R_mhe")
-        if self.diag_Q_R:
+        rtarget = getattr(self.lsmhe, "R_mhe") if self.diag_Q_R else getattr(self.lsmhe, "R_L_mhe")
+        if self.diag_Q_R and isinstance(cov_dict, dict):
             for i in range(0, self.nfe_tmhe):
                 for y in self.y:
                     for jth in self.y_vars[y]:  #: the jth variable
@@ -543,21 +653,25 @@ class MheGen_DAE(NmpcGen_DAE):
                         if cov_dict[y] == 0:
                             raise ZeroDivisionError('wrong covariance')
                         rtarget[i, v_i] = 1 / cov_dict[y]
+        elif self.diag_Q_R:
+            rtarget.store_values(_diag_weights(cov_dict, self.nfe_tmhe, len(self.yk_l[0])))
         else:
-            sys.exit(1)
+            cov = _cov_array(cov_dict, self.yk_key) if isinstance(cov_dict, dict) else cov_dict
+            rtarget.store_values(self._factor_weights(cov, self.nfe_tmhe, self._R_blocks, "set_covariance_meas"))
 
     def set_covariance_disturb(self, cov_dict):
         """Assign values to the covariance of the disturbance.
 
-        For now we only take diagonal covariance(variance) matrices.
         Args:
-            cov_dict (dict): The values of the covariance
+            cov_dict: With diag_QR, a dictionary of variances by state name or a vector of variances in xkN_key
+            order ((nfe_tmhe - 1, n_x) for time-varying values). Otherwise a covariance array in xkN_key order,
+            (n_x, n_x) or (nfe_tmhe - 1, n_x, n_x), or a dictionary with the key structure [(state_name, j), (state_name, k)]
 
         Returns:
             None:
         """
-        qtarget = getattr(self.lsmhe, "Q_mhe")
-        if self.diag_Q_R:
+        qtarget = getattr(self.lsmhe, "Q_mhe") if self.diag_Q_R else getattr(self.lsmhe, "Q_L_mhe")
+        if self.diag_Q_R and isinstance(cov_dict, dict):
             for i in range(0, self.nfe_tmhe - 1):
                 for x in self.x_noisy:
                     for jth in self.x_vars[x]:  #: the jth variable
@@ -566,9 +680,33 @@ class MheGen_DAE(NmpcGen_DAE):
                             qtarget[i, v_i] = 1 / cov_dict[x]
                         else:
                             raise ZeroDivisionError
+        elif self.diag_Q_R:
+            qtarget.store_values(_diag_weights(cov_dict, self.nfe_tmhe - 1, len(self.xkN_l)))
         else:
-            raise Exception("Not yet implemented [set_covariance_disturb]")
-
+            cov = _cov_array(cov_dict, self.xkN_key) if isinstance(cov_dict, dict) else cov_dict
+            qtarget.store_values(self._factor_weights(cov, self.nfe_tmhe - 1, self._Q_blocks, "set_covariance_disturb"))
+
+    def _factor_weights(self, cov, n_t, blocks, who):
+        """Inverts and factorizes a covariance block by block, returns the values for the factor Param"""
+        n = sum(len(b) for b in blocks)
+        cov = np.asarray(cov, dtype=float)
+        if cov.ndim == 2:
+            cov = np.broadcast_to(cov, (n_t, n, n))
+        if cov.shape != (n_t, n, n):
+            raise ValueError("Expected a ({0}, {0}) or ({1}, {0}, {0}) array, got {2}".format(n, n_t, cov.shape))
+        in_blocks = np.zeros((n, n), dtype=bool)
+        for b in blocks:
+            in_blocks[np.ix_(b, b)] = True
+        if np.any(cov[:, ~in_blocks] != 0.0):
+            self.journalist("W", self._iteration_count, who, "Covariance entries outside the blocks are ignored")
+        values = {}
+        for i in range(0, n_t):
+            for b in blocks:
+                U = factor_weight(np.linalg.inv(cov[i][np.ix_(b, b)]))
+                for a in range(0, len(b)):
+                    for c in range(a, len(b)):
+                        values[i, b[a], b[c]] = U[a, c]
+        return values
 
     def set_covariance_u(self, cov_dict):
         """Sets covariance(inverse) for the states.
@@ -586,9 +724,13 @@ class MheGen_DAE(NmpcGen_DAE):
             qtarget[_t, vni] = 1 / cov_dict[vni]
 
     def shift_mhe(self):
-        """Shifts current initial guesses of variables for the mhe problem by one finite element.
+        """Shifts current initial guesses of variables for the mhe problem by one finite element (by the sampling
+        time if the grid is not uniform).
 
         """
+        if any(abs(h - self.hi_t) > 1e-09 for h in self.fe_lengths_mhe):
+            shift_profile(self.lsmhe, self.hi_t)
+            return
         for v in self.lsmhe.component_objects(Var, active=True):
             if v._implicit_subsets is None:
                 if v.index_set() is self.lsmhe.t:  #: time is the only set
@@ -826,11 +968,14 @@ class MheGen_DAE(NmpcGen_DAE):
     def regen_objective_fun(self):
 
         """Given the exclusion list, regenerate the expression for the arrival cost"""
-        self.lsmhe.Arrival_e_mhe.set_value(0.5 * sum((self.xkN_l[j] - self.lsmhe.x_0_mhe[j]) *
-                                                     sum(self.lsmhe.PikN_mhe[j, k] *
-                                                         (self.xkN_l[k] - self.lsmhe.x_0_mhe[k]) for k in
-                                                         self.lsmhe.xkNk_mhe if self.xkN_nexcl[k])
-                                                     for j in self.lsmhe.xkNk_mhe if self.xkN_nexcl[j]))
+        if self.arrival_cost == "factorized":
+            self.update_arrival_factor_mhe()
+        else:
+            self.lsmhe.Arrival_e_mhe.set_value(0.5 * sum((self.xkN_l[j] - self.lsmhe.x_0_mhe[j]) *
+                                                         sum(self.lsmhe.PikN_mhe[j, k] *
+                                                             (self.xkN_l[k] - self.lsmhe.x_0_mhe[k]) for k in
+                                                             self.lsmhe.xkNk_mhe if self.xkN_nexcl[k])
+                                                         for j in self.lsmhe.xkNk_mhe if self.xkN_nexcl[j]))
         self.lsmhe.obfun_mhe.set_value(self.lsmhe.Arrival_e_mhe +
                                        self.lsmhe.R_e_mhe +
                                        self.lsmhe.Q_e_mhe +
@@ -843,6 +988,14 @@ class MheGen_DAE(NmpcGen_DAE):
         if not self.lsmhe.hyk_c_mhe.active:
             self.lsmhe.hyk_c_mhe.activate()
 
+    def update_arrival_factor_mhe(self):
+        """Factorizes PikN_mhe = U.T U (the states in the exclusion list are left out) and loads U into PikN_L_mhe"""
+        n_x = len(self.xkN_l)
+        idx = [j for j in range(0, n_x) if self.xkN_nexcl[j]]
+        U = np.zeros((n_x, n_x))
+        U[np.ix_(idx, idx)] = factor_weight(self._PikN[np.ix_(idx, idx)])
+        self.lsmhe.PikN_L_mhe.store_values(dict(((j, k), U[j, k]) for (j, k) in self.lsmhe.xkNk_L_mhe))
+
     def load_covariance_prior(self):
         """Computes the reduced-hessian (inverse of the prior-covariance)
         Reads the result_hessian.txt file that contains the covariance information"""
@@ -862,21 +1015,9 @@ class MheGen_DAE(NmpcGen_DAE):
             return 1
         self.lsmhe.f_timestamp.display(ostream=sys.stderr)
 
-        self._PI.clear()
-        with open("inv_.in", "r") as rh:
-            ll = []
-            l = rh.readlines()
-            row = 0
-            for i in l:
-                ll = i.split()
-                col = 0
-                for j in ll:
-                    self._PI[row, col] = float(j)
-                    col += 1
-                row += 1
-            rh.close()
+        self._PI = np.loadtxt("inv_.in", ndmin=2)
         print("-" * 120)
-        print("I[[load covariance]] e-states nrows {:d} ncols {:d}".format(len(l), len(ll)))
+        print("I[[load covariance]] e-states nrows {:d} ncols {:d}".format(self._PI.shape[0], self._PI.shape[1]))
         print("-" * 120)
 
         ftimings = open("timings_k_aug.txt", "r")
@@ -888,46 +1029,48 @@ class MheGen_DAE(NmpcGen_DAE):
 
     def set_state_covariance(self):
         """Sets covariance(inverse) for the prior_state.
+        The rows of inv_.in are mapped to the noisy states through the rh_name suffix; states with dof_v = 0 (at
+        their bounds) keep their previous weights.
         Args:
             None
         Return:
             None
         """
         t_prior = t_ij(self.lsmhe.t, 1, 0)
-        pikn = getattr(self.lsmhe, "PikN_mhe")
-        for key_j in self.x_noisy:
-            for key_k in self.x_noisy:
-                vj = getattr(self.lsmhe, key_j)
-                vk = getattr(self.lsmhe, key_k)
-                for j in self.x_vars[key_j]:
-                    if vj[(t_prior,) + j].get_suffix_value(self.lsmhe.dof_v) == 0:
-                        #: This state is at its bound, skip
-                        continue
-                    for k in self.x_vars[key_k]:
-                        if vk[(t_prior,) + k].get_suffix_value(self.lsmhe.dof_v) == 0:
-                            #: This state is at its bound, skip
-                            print("vj {:s} {:d} .sfx={:d}, vk {:s} {:d}.sfx={:d}"
-                                  .format(key_j, j[0], vj[(t_prior,) + j].get_suffix_value(self.lsmhe.dof_v),
-                                          key_k, k[0], vk[(t_prior,) + k].get_suffix_value(self.lsmhe.dof_v),))
-                            continue
-                        row = vj[(t_prior,) + j].get_suffix_value(self.lsmhe.rh_name)
-                        col = vk[(t_prior,) + k].get_suffix_value(self.lsmhe.rh_name)
-                        #: Ampl does not give you back 0's
-                        if not row:
-                            row = 0
-                        if not col:
-                            col = 0
-
-                        # print((row, col), (key_j, j), (key_k, k))
-                        q0j = self.xkN_key[(key_j,) + j]
-                        q0k = self.xkN_key[(key_k,) + k]
-                        pi = self._PI[row, col]
-                        try:
-                            pikn[q0j, q0k] = pi
-                        except KeyError:
-                            errk = key_j + "_" + str(j) + ", " + key_k + "_" + str(k)
-                            print("Kerror, var {:}".format(errk))
-                            pikn[q0j, q0k] = 0.0
+        n_x = len(self.xkN_l)
+        rh_row = np.zeros(n_x, dtype=int)
+        active = np.zeros(n_x, dtype=bool)
+        for x in self.x_noisy:
+            v = getattr(self.lsmhe, x)
+            for j in self.x_vars[x]:
+                q = self.xkN_key[(x,) + j]
+                vj = v[(t_prior,) + j]
+                active[q] = self.lsmhe.dof_v.get(vj) != 0
+                rh_row[q] = self.lsmhe.rh_name.get(vj) or 0  #: Ampl does not give you back 0's
+        idx = np.flatnonzero(active)
+        rows = rh_row[idx]
+        found = rows < min(self._PI.shape)
+        if not found.all():
+            print("Kerror, vars {:}".format([self.xkN_l[q].name for q in idx[~found]]))
+        block = np.zeros((idx.size, idx.size))
+        block[np.ix_(found, found)] = self._PI[np.ix_(rows[found], rows[found])]
+        pikn = self._PikN.copy()
+        pikn[np.ix_(idx, idx)] = block
+        self.set_arrival_weight_mhe(pikn)
+
+    def set_arrival_weight_mhe(self, pikn):
+        # type: (np.ndarray) -> None
+        """Sets the prior weight (inverse of the prior covariance) in one go.
+
+        Args:
+            pikn (np.ndarray): n_x by n_x array in xkN_key order.
+        """
+        pikn = np.asarray(pikn, dtype=float)
+        n_x = len(self.xkN_l)
+        if pikn.shape != (n_x, n_x):
+            raise ValueError("Expected a ({0}, {0}) array, got {1}".format(n_x, pikn.shape))
+        self._PikN = pikn
+        self.lsmhe.PikN_mhe.store_values(dict(zip(product(range(0, n_x), repeat=2), pikn.ravel().tolist())))
 
     def set_prior_state_from_prior_mhe(self):
         """Mechanism to assign a value to x0 (prior-state) from the previous mhe
@@ -1234,6 +1377,28 @@ class MheGen_DAE(NmpcGen_DAE):
             for j in self.state_vars[x]:
                 self.curr_estate[(x, j)] = value(xvar[t_mhe, j])
 
+    def solve_mhe_deadline(self, deadline=None, **kwargs):
+        """Solves the lsmhe with a deadline (see solve_dyn_deadline). If the solve misses the deadline or fails,
+        the estimate is the prediction of the last period (fallback_mhe).
+        Args:
+            deadline (float): Seconds, defaults to the deadline of the constructor
+            **kwargs: Options of solve_dyn
+        Returns:
+            int: Status of the solve (0 if success, 1 if not optimal, 2 if the deadline was missed)"""
+        stat = self.solve_dyn_deadline(self.lsmhe, deadline=deadline, **kwargs)
+        if stat == 0:
+            self.update_state_mhe()
+        else:
+            self.fallback_mhe()
+        return stat
+
+    def fallback_mhe(self):
+        """The current estimate is taken from the predicted state (see update_state_predicted)"""
+        if not self.curr_pstate:
+            self.journalist("W", self._iteration_count, "fallback_mhe", "No prediction, the estimate is kept")
+            return
+        self.curr_estate.update(self.curr_pstate)
+
     def update_measurement(self):
         """Update the current dictionary from the plant"""
         t_ncp = t_ij(self.PlantSample.t, 0, self.ncp_t)
@@ -5,24 +5,54 @@ from __future__ import division
 from pyomo.core.base import Var, Objective, minimize, Set, Constraint, Expression, Param, Suffix, TransformationFactory
 from pyomo.core.base.numvalue import value
 from pyomo.opt import SolverFactory, ProblemFormat, SolverStatus, TerminationCondition
-from nmpc_mhe.pyomo_dae.DynGen_pyDAE import DynGen_DAE
+from nmpc_mhe.pyomo_dae.DynGen_pyDAE import DynGen_DAE, DynSolWeAreDone
 from nmpc_mhe.aux.utils import t_ij
 from nmpc_mhe.aux.utils import fe_compute, load_iguess, augment_model, augment_steady, aug_discretization, create_bounds
 from nmpc_mhe.aux.utils import clone_the_model, get_lu_KKT, get_jacobian_k_aug, dlqr, abline, solve_bounded_line
+from nmpc_mhe.aux.utils import factor_weight, shift_profile
+from nmpc_mhe.aux.parallel import get_pool, BackgroundTask
+from nmpc_mhe.aux.derivatives import evaluate_jacobian, evaluate_hessian, evaluate_gradient, evaluate_residuals
+from nmpc_mhe.aux.derivatives import active_constraints, free_variables
+from pyomo.core.base import ConcreteModel
+from pyomo.core.expr.current import identify_variables
+from pyomo.core.kernel.component_map import ComponentMap
 import sys
 import os
 import time
+import shutil
+import tempfile
+import json
 import control
+from bisect import bisect_right
 import numpy as np
 import matplotlib.pyplot as plt
 from pyomo.dae import DerivativeVar
 from copy import deepcopy
-from scipy.sparse import csc_matrix
+from collections import OrderedDict
+from scipy.sparse import csc_matrix, issparse, bmat, identity
+from scipy.sparse.linalg import splu
 
 __author__ = "David Thierry @dthierry, Kuan-Han Lin @kuanhanl" #: March 2018, Jul 2020
 
 """This version does not necesarily have the same time horizon/discretization as the MHE"""
 
+_TP_CONTEXT = {}  #: State shared with the workers of the terminal-region sampler (inherited through fork)
+
+
+def _tp_sampler_init(workdir_root, batch_size):
+    """Every worker runs in its own directory and owns its simulator"""
+    wd = os.path.join(workdir_root, "worker_{:d}".format(os.getpid()))
+    os.makedirs(wd)
+    os.chdir(wd)
+    _TP_CONTEXT["sim"], _TP_CONTEXT["blocks"] = _TP_CONTEXT["nmpc"].tp_build_simulator(batch_size)
+
+
+def _tp_sampler_run(task):
+    seed, n_points = task
+    c = _TP_CONTEXT
+    return c["nmpc"].tp_run_samples(c["sim"], c["blocks"], seed, n_points, c["state_norm"], c["Ak"], c["K"])
+
+
 
 class NmpcGen_DAE(DynGen_DAE):
     def __init__(self, d_mod, hi_t, states, controls, **kwargs):
@@ -35,6 +65,28 @@ class NmpcGen_DAE(DynGen_DAE):
         # One can specify different discretization lenght
         self.nfe_tnmpc = kwargs.pop('nfe_tnmpc', self.nfe_t)  #: Specific number of finite elements
         self.ncp_tnmpc = kwargs.pop('ncp_tnmpc', self.ncp_t)  #: Specific number of collocation points
+        #: Lengths of the finite elements of the olnmpc, e.g. fine near the present and coarse far out (the first
+        #: one is the sampling time). None gives nfe_tnmpc elements of length hi_t. The tracking weights of an element
+        #: (Q_w_nmpc, R_w_nmpc) are scaled by its length over hi_t, so a coarse element weighs as the sampling times
+        #: it covers
+        self.fe_lengths_nmpc = kwargs.pop('fe_lengths_nmpc', None)
+        if self.fe_lengths_nmpc is None:
+            self.fe_lengths_nmpc = [self.hi_t] * self.nfe_tnmpc
+        else:
+            self.nfe_tnmpc = len(self.fe_lengths_nmpc)
+            if abs(self.fe_lengths_nmpc[0] - self.hi_t) > 1e-09:
+                raise ValueError("The first finite element must have the length of the sampling time %s" % self.hi_t)
+        #: Control parametrization of the olnmpc: u_blocks are the lengths (in finite elements) of the blocks,
+        #: "blocks" holds the control over every block, "linear" interpolates between the first elements of the blocks
+        #: (the last block is held). None keeps one control per finite element
+        self.u_blocks = kwargs.pop("u_blocks", None)
+        self.u_parametrization = kwargs.pop("u_parametrization", "blocks")
+        if self.u_parametrization not in ("blocks", "linear"):
+            raise ValueError("u_parametrization must be blocks or linear %s" % self.u_parametrization)
+        if self.u_blocks is not None and (sum(self.u_blocks) != self.nfe_tnmpc or min(self.u_blocks) < 1):
+            raise ValueError("u_blocks must be positive and add up to the number of finite elements %s"
+                             % str(self.u_blocks))
+        self.u_param_nmpc = self.control_parametrization_nmpc()  #: fe -> [(free fe, weight)]
 
         # We need a list of tuples that contain the bounds of u
         self.olnmpc = object()
@@ -72,10 +124,22 @@ class NmpcGen_DAE(DynGen_DAE):
         self.profile_state_target = {}
         self.profile_u_target = {}
         self.profile_target = False
+        self.objective_build_time = {}  #: Seconds spent building every objective of olnmpc
+        self.target_cache = {}  #: Solutions of SteadyRef2 by reference state, see target_cache_key
+        self._xmpc_keys = None  #: (state, index) in xmpc_key order
+        self._profile_steps = None  #: Sorted steps of the set-point profile, see build_profile_lookup_nmpc
+        self._profile_x = None
+        self._profile_u = None
         
         #objects for amsnmpc
         self.num_flatten_var = None #number of flatten variables
         self.amsnmpc_Ns = kwargs.pop('Ns_amsnmpc', None) #Ns for amsnmpc
+        #: "nlp" solves the Ns elements at once, "march" solves the one-element predictor element by element and
+        #: "sens" chains the linearization of the PlantSample (marching outside of its trust region)
+        self.ams_predictor = kwargs.pop("ams_predictor", "nlp")
+        if self.ams_predictor not in ("nlp", "march", "sens"):
+            raise ValueError("ams_predictor must be nlp, march or sens %s" % self.ams_predictor)
+        self._ams_pred_task = None #prediction running in the background, see predictor_amsNMPC
         if self.amsnmpc_Ns is not None:
             self.Pred_amsnmpc = None #state predictor for amsnmpc
             self.record_suffix_u = {}
@@ -127,6 +191,26 @@ class NmpcGen_DAE(DynGen_DAE):
         self.tp_area = None #area of terminal region
         self.tp_P = None #cost-to-go P of LQR >> matrix in terminal cost
         self.tp_exist = False
+        self.tp_samples = None #(ln|x|, ln|phi|) from the last terminal region sampling
+        self.tp_rejected = 0 #samples of the last terminal region sampling whose simulation failed
+        self.terminal_cost = kwargs.pop("terminal_cost", "dense") #"factorized": sum of squares of z = U (x - x_ref)
+        self.terminal_band = kwargs.pop("terminal_band", None) #number of super-diagonals of U kept (None: all)
+        if self.terminal_cost not in ("dense", "factorized"):
+            raise ValueError("terminal_cost must be dense or factorized %s" % self.terminal_cost)
+        self.tp_cache = {} #terminal properties by operating point, see tp_cache_key
+        self.tp_cache_file = kwargs.pop("tp_cache_file", None) #json file, the cache persists across runs
+        self.tp_cache_digits = kwargs.pop("tp_cache_digits", 8) #significant digits of the key
+        if self.tp_cache_file is not None and os.path.exists(self.tp_cache_file):
+            self.load_tp_cache(self.tp_cache_file)
+        #: Hessian of the real-time iteration, "gauss-newton" (objective only, robust far from the solution) or
+        #: "exact" (Lagrangian with the last multipliers, exact sensitivities for the feedback near the solution)
+        self.rti_hessian = kwargs.pop("rti_hessian", "gauss-newton")
+        if self.rti_hessian not in ("gauss-newton", "exact"):
+            raise ValueError("rti_hessian must be gauss-newton or exact %s" % self.rti_hessian)
+        self.rti = None #linearization of the olnmpc from the last preparation phase
+        self.rti_reg = kwargs.pop("rti_reg", (0., 0.)) #primal and dual regularization of the KKT matrix
+        self.rti_log = [] #one entry per sampling period, times of the preparation/feedback phases
+        self._plan_nmpc = None #values of the olnmpc after the last solve within the deadline
         
 
     def create_nmpc(self, **kwargs):
@@ -139,19 +223,19 @@ class NmpcGen_DAE(DynGen_DAE):
         kwargs.pop("newncp", self.ncp_tnmpc)
         self.journalist('W', self._iteration_count, "Initializing NMPC",
                         "With {:d} fe and {:d} cp".format(self.nfe_tnmpc, self.ncp_tnmpc))
-        _tnmpc = self.hi_t * self.nfe_tnmpc
+        _tnmpc = sum(self.fe_lengths_nmpc)
         self.olnmpc = clone_the_model(self.d_mod)
         self.olnmpc.name = "olnmpc (Open-Loop NMPC)"
 
         augment_model(self.olnmpc, self.nfe_tnmpc, self.ncp_tnmpc, new_timeset_bounds=(0, _tnmpc))
-        aug_discretization(self.olnmpc, self.nfe_tnmpc, self.ncp_tnmpc)
+        aug_discretization(self.olnmpc, self.nfe_tnmpc, self.ncp_tnmpc, fe_lengths=self.fe_lengths_nmpc)
 
         self.olnmpc.fe_t = Set(initialize=[i for i in range(0, self.nfe_tnmpc)])  #: Set for the NMPC stuff
 
         tfe_dic = dict()
         for t in self.olnmpc.t:
             if t == max(self.olnmpc.t):
-                tfe_dic[t] = fe_compute(self.olnmpc.t, t-1)
+                tfe_dic[t] = self.nfe_tnmpc - 1
             else:
                 tfe_dic[t] = fe_compute(self.olnmpc.t, t)
         #: u vars and u constraints creation
@@ -176,9 +260,13 @@ class NmpcGen_DAE(DynGen_DAE):
                 cv[k].setlb(self.u_bounds[u][0])
                 cv[k].setub(self.u_bounds[u][1])
 
+            for k in cv.keys():
+                if self.u_param_nmpc[k] != [(k, 1.0)]:
+                    cv[k].fix()  #: not a decision, it follows the free controls (see sync_controls_nmpc)
+
             self.olnmpc.add_component(u + '_cdummy', Constraint(self.olnmpc.t))
             dumm_eq = getattr(self.olnmpc, u + '_cdummy')
-            dumm_eq.rule = lambda m, i: cv[tfe_dic[i]] == control_var[i]
+            dumm_eq.rule = lambda m, i: self.control_expr_nmpc(cv, tfe_dic[i]) == control_var[i]
             dumm_eq.reconstruct()
 
         #: Dictionary of the states for a particular time point i
@@ -191,29 +279,31 @@ class NmpcGen_DAE(DynGen_DAE):
         k = 0
         for x in self.states:
             n_s = getattr(self.olnmpc, x)  #: State
-            t = t_ij(self.olnmpc.t, 0, self.ncp_t)
+            t = t_ij(self.olnmpc.t, 0, self.ncp_tnmpc)
             for j in self.state_vars[x]:
                 self.xmpc_l[0].append(n_s[(t,) + j])
                 self.xmpc_key[(x, j)] = k
                 k += 1
         #: Iterate over the rest
         for t in range(1, self.nfe_tnmpc):
-            time = t_ij(self.olnmpc.t, t, self.ncp_tnmpc)
+            tfe = t_ij(self.olnmpc.t, t, self.ncp_tnmpc)
             self.xmpc_l[t] = []
             for x in self.states:
                 n_s = getattr(self.olnmpc, x)  #: State
                 for j in self.state_vars[x]:
-                    self.xmpc_l[t].append(n_s[(time,) + j])
+                    self.xmpc_l[t].append(n_s[(tfe,) + j])
         #: A set with the length of flattened states
         self.olnmpc.xmpcS_nmpc = Set(initialize=[i for i in range(0, len(self.xmpc_l[0]))])
         #: Create set of noisy_states
         self.olnmpc.xmpc_ref_nmpc = Param(self.olnmpc.xmpcS_nmpc, initialize=0.0, mutable=True)  #: Ref-state
-        self.olnmpc.xmpc_ref_nmpc2 = Param(self.olnmpc.fe_t, self.olnmpc.xmpcS_nmpc, initialize=0.0, mutable=True)
         self.olnmpc.Q_nmpc = Param(self.olnmpc.xmpcS_nmpc, initialize=1, mutable=True)  #: Control-weight
         # (diagonal Matrices)
 
-        self.olnmpc.Q_w_nmpc = Param(self.olnmpc.fe_t, initialize=1e-04, mutable=True)
-        self.olnmpc.R_w_nmpc = Param(self.olnmpc.fe_t, initialize=1e+02, mutable=True)
+        self.olnmpc.Q_w_nmpc = Param(self.olnmpc.fe_t, initialize=lambda m, fe: 1e-04 * self.fe_weight_nmpc(fe),
+                                     mutable=True)
+        self.olnmpc.R_w_nmpc = Param(self.olnmpc.fe_t, initialize=lambda m, fe: 1e+02 * self.fe_weight_nmpc(fe),
+                                     mutable=True)
+        t0 = time.time()
         #: Build the xT*Q*x part
         self.olnmpc.xQ_expr_nmpc = Expression(expr=sum(
             sum(self.olnmpc.Q_w_nmpc[fe] *
@@ -221,25 +311,20 @@ class NmpcGen_DAE(DynGen_DAE):
                 for k in self.olnmpc.xmpcS_nmpc)
                 for fe in range(0, self.nfe_tnmpc)))
 
-        self.olnmpc.xQ_expr_nmpc2 = Expression(expr=sum(
-            sum(self.olnmpc.Q_w_nmpc[fe] *
-                self.olnmpc.Q_nmpc[k] * (self.xmpc_l[fe][k] - self.olnmpc.xmpc_ref_nmpc2[fe, k])**2
-                for k in self.olnmpc.xmpcS_nmpc)
-                for fe in range(0, self.nfe_tnmpc)))
-
+        t1 = time.time()
         #: Build the control list
         self.umpc_l = {}
         for t in range(0, self.nfe_tnmpc):
             self.umpc_l[t] = []
             for u in self.u:
                 uvar = getattr(self.olnmpc, u)
-                self.umpc_l[t].append(uvar[t])
+                self.umpc_l[t].append(self.control_expr_nmpc(uvar, t))
         #: Create set of u
         self.olnmpc.umpcS_nmpc = Set(initialize=[i for i in range(0, len(self.umpc_l[0]))])
         #: ref u
         self.olnmpc.umpc_ref_nmpc = Param(self.olnmpc.umpcS_nmpc, initialize=0.0, mutable=True)
-        self.olnmpc.umpc_ref_nmpc2 = Param(self.olnmpc.fe_t, self.olnmpc.umpcS_nmpc, initialize=0.0, mutable=True)
         self.olnmpc.R_nmpc = Param(self.olnmpc.umpcS_nmpc, initialize=1, mutable=True)  #: Control-weight
+        t2 = time.time()
         #: Build the uT * R * u expression
         self.olnmpc.xR_expr_nmpc = Expression(expr=sum(
             sum(self.olnmpc.R_w_nmpc[fe] *
@@ -247,15 +332,9 @@ class NmpcGen_DAE(DynGen_DAE):
                 self.olnmpc.umpcS_nmpc)
             for fe in range(0, self.nfe_tnmpc)))
         
-        self.olnmpc.xR_expr_nmpc2 = Expression(expr=sum(
-            sum(self.olnmpc.R_w_nmpc[fe] *
-                self.olnmpc.R_nmpc[k] * (self.umpc_l[fe][k] - self.olnmpc.umpc_ref_nmpc2[fe, k]) ** 2 for k in
-                self.olnmpc.umpcS_nmpc)
-            for fe in range(0, self.nfe_tnmpc)))
-        
         self.olnmpc.objfun_nmpc = Objective(expr=self.olnmpc.xQ_expr_nmpc + self.olnmpc.xR_expr_nmpc)
-        self.olnmpc.objfun_nmpc2 = Objective(expr=self.olnmpc.xQ_expr_nmpc2 + self.olnmpc.xR_expr_nmpc2)
-        self.olnmpc.objfun_nmpc2.deactivate()
+        #: The profile-tracking objective (objfun_nmpc2) is built on demand by build_profile_objective_nmpc
+        self.objective_build_time["objfun_nmpc"] = (t1 - t0) + (time.time() - t2)
 
         #for amsnmpc
         count = 0
@@ -265,6 +344,46 @@ class NmpcGen_DAE(DynGen_DAE):
         self.num_flatten_var = count
         # print(self.num_flatten_var)
         
+    def control_parametrization_nmpc(self):
+        """Control of every finite element as a combination of the free controls (see u_blocks)
+        Returns:
+            dict: fe -> list of (free fe, weight)"""
+        if self.u_blocks is None:
+            return dict((i, [(i, 1.0)]) for i in range(0, self.nfe_tnmpc))
+        starts = [sum(self.u_blocks[:b]) for b in range(0, len(self.u_blocks))]
+        param = {}
+        for (b, i0) in enumerate(starts):
+            for i in range(i0, i0 + self.u_blocks[b]):
+                if i == i0 or self.u_parametrization == "blocks" or b == len(starts) - 1:
+                    param[i] = [(i0, 1.0)]
+                else:
+                    w = (i - i0) / float(self.u_blocks[b])
+                    param[i] = [(i0, 1.0 - w), (starts[b + 1], w)]
+        return param
+
+    def control_expr_nmpc(self, uvar, fe):
+        """Control of the finite element fe in terms of the free controls"""
+        terms = self.u_param_nmpc[fe]
+        if len(terms) == 1 and terms[0][1] == 1.0:
+            return uvar[terms[0][0]]
+        return sum(w * uvar[i] for (i, w) in terms)
+
+    def sync_controls_nmpc(self):
+        """Sets the values of the fixed controls of the olnmpc from the free ones"""
+        if self.u_blocks is None:
+            return
+        for u in self.u:
+            uvar = getattr(self.olnmpc, u)
+            for i in range(0, self.nfe_tnmpc):
+                if uvar[i].fixed:
+                    uvar[i].value = value(self.control_expr_nmpc(uvar, i))
+
+    def solve_dyn(self, mod, keepsolve=False, **kwargs):
+        stat = DynGen_DAE.solve_dyn(self, mod, keepsolve=keepsolve, **kwargs)
+        if mod is self.olnmpc:
+            self.sync_controls_nmpc()
+        return stat
+
     def initialize_olnmpc(self, ref, src_kind, **kwargs):
         # The reference is always a model
         # The source of the state might be different
@@ -291,10 +410,17 @@ class NmpcGen_DAE(DynGen_DAE):
             self.journalist("E", self._iteration_count, "initialize_olnmpc", "SRC not given")
             raise ValueError("Unexpected src_kind %s" % src_kind)
 
-        dum = clone_the_model(self.d_mod) #(1, self.ncp_tnmpc, _t=self.hi_t)
-        augment_model(dum, 1, self.ncp_tnmpc, new_timeset_bounds=(0, self.hi_t))
-        aug_discretization(dum, 1, self.ncp_tnmpc)
-        create_bounds(dum, bounds=self.var_bounds)
+        dums = {}  #: one-element models by element length
+
+        def dummy(h):
+            if h not in dums:
+                dums[h] = clone_the_model(self.d_mod) #(1, self.ncp_tnmpc, _t=h)
+                augment_model(dums[h], 1, self.ncp_tnmpc, new_timeset_bounds=(0, h))
+                aug_discretization(dums[h], 1, self.ncp_tnmpc)
+                create_bounds(dums[h], bounds=self.var_bounds)
+            return dums[h]
+
+        dum = dummy(self.fe_lengths_nmpc[0])
         #: Load current solution
         # self.load_iguess_single(ref, dum, 0, 0)
         load_iguess(ref, dum, 0, 0)
@@ -319,6 +445,14 @@ class NmpcGen_DAE(DynGen_DAE):
                 else:
                     self.journalist("E", self._iteration_count, "initialize_olnmpc", "SRC not given")
                     sys.exit()
+            elif dummy(self.fe_lengths_nmpc[finite_elem]) is not dum:  #: non-uniform grid
+                prev, dum = dum, dummy(self.fe_lengths_nmpc[finite_elem])
+                load_iguess(prev, dum, 0, 0)
+                for u in self.u:
+                    cv_dum = getattr(dum, u)
+                    for i in cv_dum.keys():
+                        cv_dum[i].value = value(getattr(prev, u)[0])
+                self.load_init_state_gen(dum, src_kind="mod", ref=prev, fe=0)
             else:
                 self.load_init_state_gen(dum, src_kind="mod", ref=dum, fe=0)
 
@@ -331,16 +465,19 @@ class NmpcGen_DAE(DynGen_DAE):
                                output_file="dummy_ip.log")
             if tst != 0:
                 self.journalist("W", self._iteration_count, "initialize_olnmpc", "non-optimal dummy")
-                tst1 = self.solve_dyn(dum,
-                             o_tee=True,
-                             tol=1e-03,
-                             iter_max=1000,
-                             stop_if_nopt=False,
-                             jacobian_regularization_value=1e-04,
-                             ma57_small_pivot_flag=1,
-                             ma57_pre_alloc=5,
-                             linear_scaling_on_demand="yes", ma57_pivtol=1e-12,
-                             output_file="dummy_ip.log")
+                if self.retry_ladder is not None:
+                    tst1 = self.solve_dyn_retry(dum, o_tee=False, iter_max=1000, output_file="dummy_ip.log")
+                else:
+                    tst1 = self.solve_dyn(dum,
+                                 o_tee=True,
+                                 tol=1e-03,
+                                 iter_max=1000,
+                                 stop_if_nopt=False,
+                                 jacobian_regularization_value=1e-04,
+                                 ma57_small_pivot_flag=1,
+                                 ma57_pre_alloc=5,
+                                 linear_scaling_on_demand="yes", ma57_pivtol=1e-12,
+                                 output_file="dummy_ip.log")
                 if tst1 != 0:
                     # sys.exit()
                     print("Too bad :(", file=sys.stderr)
@@ -475,110 +612,114 @@ class NmpcGen_DAE(DynGen_DAE):
             dbu_Q_nmpc = kwargs.pop("Q_nmpc", None)
             dbu_R_nmpc = kwargs.pop("R_nmpc", None)
             self.update_targets_nmpc()
-            for x in self.states:
-                for j in self.state_vars[x]:
-                    k = self.xmpc_key[(x,j)]
-                    if isinstance(dbu_Q_nmpc, dict):
-                        self.olnmpc.Q_nmpc[k].value = dbu_Q_nmpc[(x,j)]
-                    if not isinstance(dbu_Q_nmpc, dict):
-                        self.olnmpc.Q_nmpc[k].value = dbu_Q_nmpc
-                    self.olnmpc.xmpc_ref_nmpc[k].value = self.curr_state_target[(x, j)]
-                        
-            k = 0
-            for u in self.u:
-                if isinstance(dbu_R_nmpc, dict):
-                    self.olnmpc.R_nmpc[k].value = dbu_R_nmpc[u]
-                if not isinstance(dbu_R_nmpc, dict):
-                    self.olnmpc.R_nmpc[k].value = dbu_R_nmpc
-                self.olnmpc.umpc_ref_nmpc[k].value = self.curr_u_target[u]
-                k += 1
+            q = self.state_vector_nmpc(dbu_Q_nmpc) if isinstance(dbu_Q_nmpc, dict) else dbu_Q_nmpc
+            r = self.control_vector_nmpc(dbu_R_nmpc) if isinstance(dbu_R_nmpc, dict) else dbu_R_nmpc
+            self.set_weights_nmpc(Q=q, R=r)
+            self.set_references_nmpc(x_ref=self.state_vector_nmpc(self.curr_state_target),
+                                     u_ref=self.control_vector_nmpc(self.curr_u_target))
         else:
             check_values = kwargs.pop("check_values", False)
             # if check_values: #I think it's a bug if we have this if statement. KH.L
             max_w_value = kwargs.pop("max_w_value", 1e+06)
             min_w_value = kwargs.pop("min_w_value", 0.0)
             self.update_targets_nmpc()
-            if src == "mhe":
-                for x in self.states:
-                    for j in self.state_vars[x]:
-                        k = self.xmpc_key[(x, j)]
-                        temp = abs(self.curr_estate[(x, j)] - self.curr_state_target[(x, j)])
-                        if temp > 1e-08:
-                            self.olnmpc.Q_nmpc[k].value = temp**n
-                        else:
-                            self.olnmpc.Q_nmpc[k].value = max_w_value
-                        self.olnmpc.xmpc_ref_nmpc[k].value = self.curr_state_target[(x, j)]
-            elif src == "plant":
-                for x in self.states:
-                    for j in self.state_vars[x]:
-                        k = self.xmpc_key[(x, j)]
-                        # self.olnmpc.Q_nmpc[k].value = abs(self.curr_rstate[(x, j)] - self.curr_state_target[(x, j)])**n
-                        temp = abs(self.curr_rstate[(x, j)] - self.curr_state_target[(x, j)])
-                        if temp > 1e-08:
-                            self.olnmpc.Q_nmpc[k].value = temp ** n
-                        else:
-                            self.olnmpc.Q_nmpc[k].value = max_w_value
-                        self.olnmpc.xmpc_ref_nmpc[k].value = self.curr_state_target[(x, j)]
-            k = 0
-            for u in self.u:
-                self.olnmpc.R_nmpc[k].value = abs(self.curr_u[u] - self.curr_u_target[u])**n
-                self.olnmpc.umpc_ref_nmpc[k].value = self.curr_u_target[u]
-                k += 1
+            x_ref = self.state_vector_nmpc(self.curr_state_target)
+            u_ref = self.control_vector_nmpc(self.curr_u_target)
+            q = None
+            if src in ("mhe", "plant"):
+                x_curr = self.state_vector_nmpc(self.curr_estate if src == "mhe" else self.curr_rstate)
+                temp = np.abs(x_curr - x_ref)
+                q = np.full(temp.size, max_w_value, dtype=float)
+                q[temp > 1e-08] = temp[temp > 1e-08] ** n
+            temp = np.abs(self.control_vector_nmpc(self.curr_u) - u_ref)
+            r = np.full(temp.size, max_w_value, dtype=float)
+            r[temp > 1e-08] = temp[temp > 1e-08] ** n
             if check_values:
-                for k in self.olnmpc.xmpcS_nmpc:
-                    if value(self.olnmpc.Q_nmpc[k]) < min_w_value:
-                        self.olnmpc.Q_nmpc[k].value = min_w_value
-                    if value(self.olnmpc.Q_nmpc[k]) > max_w_value:
-                        self.olnmpc.Q_nmpc[k].value = max_w_value
-                k = 0
-                for u in self.u:
-                    if value(self.olnmpc.R_nmpc[k]) < min_w_value:
-                        self.olnmpc.R_nmpc[k].value = min_w_value
-                    if value(self.olnmpc.R_nmpc[k]) > max_w_value:
-                        self.olnmpc.R_nmpc[k].value = max_w_value
-                    k += 1
+                q = None if q is None else np.clip(q, min_w_value, max_w_value)
+                r = np.clip(r, min_w_value, max_w_value)
+            self.set_weights_nmpc(Q=q, R=r)
+            self.set_references_nmpc(x_ref=x_ref if q is not None else None, u_ref=u_ref)
+            if check_values and q is None:  #: Q was not computed, only clip it
+                q = np.array([value(self.olnmpc.Q_nmpc[k]) for k in self.olnmpc.xmpcS_nmpc])
+                self.set_weights_nmpc(Q=np.clip(q, min_w_value, max_w_value))
                               
         target_step = kwargs.pop("target_step", None)
         if self.profile_target:
+            self.build_profile_objective_nmpc()
             self.olnmpc.objfun_nmpc.deactivate()
             self.olnmpc.objfun_nmpc2.activate()
             
             if target_step is None:
                 raise RuntimeError("Please give the target step to load the corresponding setpoint.")
-                
-            sorted_key = list(self.profile_state_target.keys())
-            sorted_key.sort()
-            
-            for i in range(self.nfe_tnmpc):
-                goal = i + target_step
-                for s in sorted_key:
-                    if goal >= s:
-                        cor = s # goal is in group "cor", which is s
-                for x in self.states:
-                    for j in self.state_vars[x]:
-                        k = self.xmpc_key[(x, j)]
-                        self.olnmpc.xmpc_ref_nmpc2[i, k].value = self.profile_state_target[cor][(x,j)]
-                k = 0
-                for u in self.u:
-                    self.olnmpc.umpc_ref_nmpc2[i, k].value = self.profile_u_target[cor][u]
-                    k += 1
-                    
-    def new_weights_olnmpc(self, state_weight, control_weight):
-        """Change the weights associated with the control objective function"""
+            self.set_profile_references_nmpc(target_step)
 
-        if isinstance(state_weight, dict):
-            for fe in self.olnmpc.fe_t:
-                self.olnmpc.Q_w_nmpc[fe].value = state_weight[fe]
-        else:
-            for fe in self.olnmpc.fe_t:
-                self.olnmpc.Q_w_nmpc[fe].value = state_weight
+    def state_vector_nmpc(self, d):
+        """Values of a dictionary keyed by (state, index) as a vector in xmpc_key order"""
+        if self._xmpc_keys is None or len(self._xmpc_keys) != len(self.xmpc_key):
+            self._xmpc_keys = sorted(self.xmpc_key.keys(), key=lambda i: self.xmpc_key[i])
+        return np.array([d[i] for i in self._xmpc_keys], dtype=float)
 
-        if isinstance(control_weight, dict):
-            for fe in self.olnmpc.fe_t:
-                self.olnmpc.R_w_nmpc[fe].value = control_weight[fe]
-        else:
-            for fe in self.olnmpc.fe_t:
-                self.olnmpc.R_w_nmpc[fe].value = control_weight
+    def control_vector_nmpc(self, d):
+        """Values of a dictionary keyed by control as a vector in the order of self.u"""
+        return np.array([d[u] for u in self.u], dtype=float)
+
+    def set_weights_nmpc(self, Q=None, R=None):
+        """Bulk update of the diagonal weights.
+
+        Args:
+            Q (np.ndarray or float): State weights in xmpc_key order (or one value for all). None leaves them.
+            R (np.ndarray or float): Control weights in the order of self.u (or one value for all). None leaves them.
+        """
+        for (w, p) in ((Q, self.olnmpc.Q_nmpc), (R, self.olnmpc.R_nmpc)):
+            if w is None:
+                continue
+            if np.ndim(w) == 0:
+                p.store_values(float(w))
+                continue
+            w = np.asarray(w, dtype=float).ravel()
+            if w.size != len(p):
+                raise ValueError("Wrong number of weights for {}: {} != {}".format(p.name, w.size, len(p)))
+            p.store_values(dict(zip(range(0, w.size), w.tolist())))
+
+    def set_references_nmpc(self, x_ref=None, u_ref=None):
+        """Bulk update of xmpc_ref_nmpc (xmpc_key order) and umpc_ref_nmpc (order of self.u)"""
+        for (v, p) in ((x_ref, self.olnmpc.xmpc_ref_nmpc), (u_ref, self.olnmpc.umpc_ref_nmpc)):
+            if v is None:
+                continue
+            v = np.asarray(v, dtype=float).ravel()
+            if v.size != len(p):
+                raise ValueError("Wrong size of the reference for {}: {} != {}".format(p.name, v.size, len(p)))
+            p.store_values(dict(zip(range(0, v.size), v.tolist())))
+
+    def build_profile_lookup_nmpc(self):
+        """Sorted steps of the set-point profile with the targets as arrays (rows in the order of the steps)"""
+        steps = sorted(self.profile_state_target.keys())
+        self._profile_steps = steps
+        self._profile_x = np.array([self.state_vector_nmpc(self.profile_state_target[s]) for s in steps])
+        self._profile_u = np.array([self.control_vector_nmpc(self.profile_u_target[s]) for s in steps])
+
+    def set_profile_references_nmpc(self, target_step):
+        """Loads xmpc_ref_nmpc2/umpc_ref_nmpc2, element i gets the target of the last profile step <= target_step + i"""
+        if self._profile_steps is None or len(self._profile_steps) != len(self.profile_state_target):
+            self.build_profile_lookup_nmpc()
+        rows = [max(bisect_right(self._profile_steps, i + target_step) - 1, 0) for i in range(0, self.nfe_tnmpc)]
+        x = self._profile_x[rows]
+        u = self._profile_u[rows]
+        self.olnmpc.xmpc_ref_nmpc2.store_values(
+            dict(((i, k), x[i, k]) for i in range(0, self.nfe_tnmpc) for k in range(0, x.shape[1])))
+        self.olnmpc.umpc_ref_nmpc2.store_values(
+            dict(((i, k), u[i, k]) for i in range(0, self.nfe_tnmpc) for k in range(0, u.shape[1])))
+                    
+    def fe_weight_nmpc(self, fe):
+        """Length of element fe of the olnmpc over the sampling time (one on a uniform grid)"""
+        return self.fe_lengths_nmpc[fe] / self.hi_t
+
+    def new_weights_olnmpc(self, state_weight, control_weight):
+        """Change the weights associated with the control objective function (scaled by fe_weight_nmpc)"""
+        for (w, p) in ((state_weight, self.olnmpc.Q_w_nmpc), (control_weight, self.olnmpc.R_w_nmpc)):
+            if not isinstance(w, dict):
+                w = dict.fromkeys(self.olnmpc.fe_t, w)
+            p.store_values(dict((fe, w[fe] * self.fe_weight_nmpc(fe)) for fe in self.olnmpc.fe_t))
 
     def create_suffixes_nmpc(self):
         """Creates the required suffixes for the advanced-step olnmpc problem (reduced-sens)
@@ -703,7 +844,10 @@ class NmpcGen_DAE(DynGen_DAE):
                 val = 1/val
             weights_ref[i] = val
 
+        key = self.target_cache_key(kwargs.get("weights"))
         weights = kwargs.pop("weights", weights_ref)
+        use_cache = kwargs.pop("use_cache", True)
+        warm_start = kwargs.pop("warm_start", True)
 
         self.journalist("I", self._iteration_count, "find_target_ss", "Attempting to find steady state")
 
@@ -748,6 +892,11 @@ class NmpcGen_DAE(DynGen_DAE):
             vkey = i[1]
             ofexp += weights[i] * (v[(1,) + vkey] - self.ref_state[i])**2
         self.SteadyRef2.obfun_SteadyRef2 = Objective(expr=ofexp, sense=minimize)
+        if use_cache and key in self.target_cache:
+            self.load_target_nmpc(self.target_cache[key])
+            return
+        elif warm_start:
+            self.warm_start_target_nmpc()
         tst = self.solve_dyn(self.SteadyRef2, iter_max=10000, stop_if_nopt=True, halt_on_ampl_error=False, **kwargs)
         if tst != 0:
             self.SteadyRef2.display(filename="failed_SteadyRef2.txt")
@@ -755,6 +904,8 @@ class NmpcGen_DAE(DynGen_DAE):
                            format=ProblemFormat.nl,
                            io_options={"symbolic_solver_labels": True})
             # sys.exit(-1)
+        else:
+            self.store_target_nmpc(key)
         self.journalist("I", self._iteration_count, "find_target_ss", "Target: solve done")
         for i in self.ref_state.keys():
             print(i)
@@ -772,6 +923,53 @@ class NmpcGen_DAE(DynGen_DAE):
                   "\tvalue {:f}".format(val))
         self.update_targets_nmpc()
 
+    def target_cache_key(self, weights=None):
+        """Key of the steady-state target of self.ref_state, with the weights only if they were given explicitly
+        (the default weights depend on the current plant state)."""
+        r = lambda v: float("{:.{}g}".format(float(v), self.tp_cache_digits))
+        key = {"ref": sorted([str(k), r(v)] for (k, v) in self.ref_state.items())}
+        if weights is not None:
+            key["weights"] = sorted([str(k), r(v)] for (k, v) in weights.items())
+        return json.dumps(key, sort_keys=True)
+
+    def store_target_nmpc(self, key):
+        """Saves the solution of SteadyRef2 in the target cache"""
+        values = dict((v.getname(), dict((k, v[k].value) for k in v.keys()))
+                      for v in self.SteadyRef2.component_objects(Var))
+        self.target_cache[key] = {"ref": dict(self.ref_state), "values": values}
+
+    def load_target_nmpc(self, entry):
+        """Loads a cached solution into SteadyRef2 and updates the targets"""
+        for name, vals in entry["values"].items():
+            v = getattr(self.SteadyRef2, name, None)
+            if v is None:
+                continue
+            for k, val in vals.items():
+                if k in v:
+                    v[k].set_value(val)
+        self.journalist("I", self._iteration_count, "target", "Steady-state target from cache")
+        self.update_targets_nmpc()
+
+    def warm_start_target_nmpc(self):
+        """Initializes SteadyRef2 from the cached target whose reference is the closest to self.ref_state"""
+        best, best_d = None, None
+        for entry in self.target_cache.values():
+            if set(entry["ref"].keys()) != set(self.ref_state.keys()):
+                continue
+            d = sum(((entry["ref"][k] - self.ref_state[k]) / max(abs(self.ref_state[k]), 1e-08)) ** 2
+                    for k in self.ref_state.keys())
+            if best_d is None or d < best_d:
+                best, best_d = entry, d
+        if best is None:
+            return
+        for name, vals in best["values"].items():
+            v = getattr(self.SteadyRef2, name, None)
+            if v is None:
+                continue
+            for k, val in vals.items():
+                if k in v and val is not None:
+                    v[k].set_value(val)
+
     def update_targets_nmpc(self):
         """Use the reference model to update  the current state and control targets dictionaries"""
         for x in self.states:
@@ -807,7 +1005,10 @@ class NmpcGen_DAE(DynGen_DAE):
             weights_ref[i] = val
 
         #: If no weights are passed, use the reference that we have just calculated
+        key = self.target_cache_key(kwargs.get("weights"))
         weights = kwargs.pop("weights", weights_ref)
+        use_cache = kwargs.pop("use_cache", True)
+        warm_start = kwargs.pop("warm_start", True)
 
         ofexp = 0.0
         for i in self.ref_state.keys():
@@ -816,7 +1017,22 @@ class NmpcGen_DAE(DynGen_DAE):
             ofexp += weights[i] * (v[(1,) + vkey] - self.ref_state[i]) ** 2
 
         self.SteadyRef2.obfun_SteadyRef2.set_value(ofexp)
-        self.solve_dyn(self.SteadyRef2, iter_max=500, stop_if_nopt=True, **kwargs)
+        if use_cache and key in self.target_cache:
+            entry = self.target_cache[key]
+            self.load_target_nmpc(entry)
+            if kwargs.get("keepsolve"):
+                #: the .sol file only comes out of a solve, from the cached point it converges right away
+                if self.solve_dyn(self.SteadyRef2, iter_max=500, **kwargs) != 0:
+                    self.load_target_nmpc(entry)
+            elif kwargs.get("wantparams"):
+                self.param_writer(self.SteadyRef2, kwargs.get("tag", "SteadyRef2"))
+            return
+
+        if warm_start:
+            self.warm_start_target_nmpc()
+        tst = self.solve_dyn(self.SteadyRef2, iter_max=500, stop_if_nopt=True, **kwargs)
+        if tst == 0:
+            self.store_target_nmpc(key)
 
         for i in self.ref_state.keys():
             v = getattr(self.SteadyRef2, i[0])
@@ -921,18 +1137,205 @@ class NmpcGen_DAE(DynGen_DAE):
     def method_for_nmpc_simulation(self):
         pass
     
-    def setup_sp_profile(self, ref_info):
-        
+    def build_profile_objective_nmpc(self):
+        """Builds the set-point profile tracking objective (objfun_nmpc2, deactivated) and its reference Params, only
+        the first time it is called. The construction time is kept in objective_build_time."""
+        if hasattr(self.olnmpc, "objfun_nmpc2"):
+            return
+        t0 = time.time()
+        self.olnmpc.xmpc_ref_nmpc2 = Param(self.olnmpc.fe_t, self.olnmpc.xmpcS_nmpc, initialize=0.0, mutable=True)
+        self.olnmpc.umpc_ref_nmpc2 = Param(self.olnmpc.fe_t, self.olnmpc.umpcS_nmpc, initialize=0.0, mutable=True)
+        self.olnmpc.xQ_expr_nmpc2 = Expression(expr=sum(
+            sum(self.olnmpc.Q_w_nmpc[fe] *
+                self.olnmpc.Q_nmpc[k] * (self.xmpc_l[fe][k] - self.olnmpc.xmpc_ref_nmpc2[fe, k])**2
+                for k in self.olnmpc.xmpcS_nmpc)
+                for fe in range(0, self.nfe_tnmpc)))
+        self.olnmpc.xR_expr_nmpc2 = Expression(expr=sum(
+            sum(self.olnmpc.R_w_nmpc[fe] *
+                self.olnmpc.R_nmpc[k] * (self.umpc_l[fe][k] - self.olnmpc.umpc_ref_nmpc2[fe, k]) ** 2 for k in
+                self.olnmpc.umpcS_nmpc)
+            for fe in range(0, self.nfe_tnmpc)))
+        self.olnmpc.objfun_nmpc2 = Objective(expr=self.olnmpc.xQ_expr_nmpc2 + self.olnmpc.xR_expr_nmpc2)
+        self.olnmpc.objfun_nmpc2.deactivate()
+        self.objective_build_time["objfun_nmpc2"] = time.time() - t0
+        self.journalist("I", self._iteration_count, "build_profile_objective_nmpc",
+                        "objfun_nmpc2 built in {:.3f} s".format(self.objective_build_time["objfun_nmpc2"]))
+
+    def setup_sp_profile(self, ref_info, **kwargs):
+        """Computes the targets of a set-point profile.
+
+        Args:
+            ref_info (dict): Step -> reference state.
+            write_files (bool): Keep the .sol and the json file of the parameters of every target (default False).
+        """
+        write_files = kwargs.pop("write_files", False)
+        self.build_profile_objective_nmpc()
         for i in ref_info.keys():
             self.profile_state_target[i] = {}
             self.profile_u_target[i] = {}
             ref = ref_info[i]
-            self.change_setpoint(ref_state=ref, keepsolve=True, wantparams=True, tag="sp")
+            self.change_setpoint(ref_state=ref, keepsolve=write_files, wantparams=write_files, tag="sp", **kwargs)
             self.profile_state_target[i] = self.curr_state_target.copy()
             self.profile_u_target[i] = self.curr_u_target.copy()
             
+        self.build_profile_lookup_nmpc()
         self.profile_target = True
             
+    def shift_olnmpc(self):
+        """Shifts the olnmpc one sampling time forward (one finite element if the grid is uniform), the end of the
+        horizon (and the last control) is kept"""
+        self.sync_controls_nmpc()
+        if any(abs(h - self.hi_t) > 1e-09 for h in self.fe_lengths_nmpc):
+            #: non-uniform grid, shift by the sampling time
+            shift_profile(self.olnmpc, self.hi_t)
+            fes = self.olnmpc.t.get_finite_elements()
+            for u in self.u:
+                uvar = getattr(self.olnmpc, u)
+                u_old = [value(uvar[i]) for i in range(0, self.nfe_tnmpc)]
+                for i in range(0, self.nfe_tnmpc):
+                    k = min(bisect_right(fes, fes[i] + self.hi_t + 1e-09) - 1, self.nfe_tnmpc - 1)
+                    uvar[i].set_value(u_old[k])
+            self.sync_controls_nmpc()
+            return
+        for i in range(0, self.nfe_tnmpc - 1):
+            load_iguess(self.olnmpc, self.olnmpc, i + 1, i)
+            for u in self.u:
+                uvar = getattr(self.olnmpc, u)
+                uvar[i].set_value(value(uvar[i + 1]))
+        self.sync_controls_nmpc()
+
+    def rti_linearize_nmpc(self):
+        """Factorizes the KKT matrix of the olnmpc equality-constrained QP at the current point
+        [H J'; J -dc I] [dw; y] = -[g; c], H depends on rti_hessian. There is no globalization, the exact Hessian
+        should be used close to the solution (e.g. after a few Gauss-Newton iterations).
+        Only the equality constraints enter the KKT matrix, inequality constraints and variable bounds are left out
+        (rti_step_nmpc projects the step on the bounds afterwards), the iteration is meant for plans that stay away
+        from them"""
+        m = self.olnmpc
+        cons = [c for c in active_constraints(m) if c.equality]
+        w = free_variables(m, cons)
+        jac, rows, _ = evaluate_jacobian(m, variables=w, constraints=cons)
+        grad, _ = evaluate_gradient(m, variables=w)
+        res, _ = evaluate_residuals(m, constraints=cons)
+        y = dict(zip(self.rti["rows"], self.rti["y"])) if self.rti is not None else {}
+        if self.rti_hessian == "exact" and y:
+            hess, _ = evaluate_hessian(m, variables=w, constraints=cons, multipliers=y)
+        else:
+            hess, _ = evaluate_hessian(m, variables=w, constraints=[], objective=True)
+        reg = self.rti_reg
+        kkt = bmat([[hess + reg[0] * identity(len(w)), jac.T], [jac, -reg[1] * identity(len(cons))]], format="csc")
+        ic_rows = []
+        ic_vals = []
+        position = dict((lbl, i) for (i, lbl) in enumerate(rows))
+        for x in self.states:
+            xic = getattr(m, x + "_ic")
+            for j in self.state_vars[x]:
+                ic_rows.append(position[(x + "_icc", tuple(j))])
+                ic_vals.append(value(xic[j]))
+        self.rti = {"lu": splu(kkt), "w": w, "w0": np.array([value(v) for v in w]), "rows": rows, "g": grad, "c": res,
+                    "ic_rows": ic_rows, "ic": np.array(ic_vals), "y": np.array([y.get(lbl, 0.) for lbl in rows])}
+
+    def rti_step_nmpc(self, dc=None):
+        """Solves the factorized KKT system and moves the olnmpc to w0 + dw (projected on the bounds).
+        Args:
+            dc (numpy.ndarray): Change of the residuals of the initial-condition constraints (new state)
+        Returns:
+            numpy.ndarray: dw"""
+        r = self.rti
+        c = r["c"].copy()
+        if dc is not None:
+            c[r["ic_rows"]] += dc
+        nw = len(r["w"])
+        sol = r["lu"].solve(-np.concatenate((r["g"], c)))
+        dw = sol[:nw]
+        r["y"] = sol[nw:]
+        for (v, val) in zip(r["w"], r["w0"] + dw):
+            if v.lb is not None and val < v.lb:
+                val = v.lb
+            if v.ub is not None and val > v.ub:
+                val = v.ub
+            v.set_value(val)
+        self.sync_controls_nmpc()
+        return dw
+
+    def rti_preparation_nmpc(self, shift=True, iterations=1, time_budget=None):
+        """Preparation phase of the real-time iteration, done before the new state is known. The olnmpc is shifted
+        and at most `iterations` SQP steps are taken on the current initial condition, the factorization of the last
+        linearization is kept for the feedback. An SQP step is skipped if it would not fit in `time_budget` judging by
+        the duration of the previous one. This is a soft bound: the shift and the first linearization are always done
+        and a step can take longer than the previous one.
+        Args:
+            shift (bool): Shift the olnmpc one element forward first
+            iterations (int): SQP steps before the final linearization (0 only linearizes)
+            time_budget (float): Seconds available for the phase
+        Returns:
+            int: The number of SQP steps taken"""
+        start = time.time()
+        if shift:
+            self.shift_olnmpc()
+        k = 0
+        t0 = time.time()
+        self.rti_linearize_nmpc()
+        last = time.time() - t0
+        while k < iterations:
+            t0 = time.time()
+            if time_budget is not None and t0 - start + last > time_budget:
+                break
+            self.rti_step_nmpc()
+            self.rti_linearize_nmpc()
+            last = time.time() - t0
+            k += 1
+        self.rti_log.append({"iteration": self._iteration_count, "preparation": time.time() - start, "sqp": k})
+        return k
+
+    def rti_feedback_nmpc(self, src="estimated"):
+        """Feedback phase of the real-time iteration, one back-solve with the new initial condition. The olnmpc is
+        moved by the full step and curr_u is taken from its first element.
+        Args:
+            src (str): "estimated" or "real" state
+        Returns:
+            int: 0 if the controls are within bounds 1 otw (see update_u)"""
+        start = time.time()
+        r = self.rti
+        state = self.curr_estate if src == "estimated" else self.curr_rstate
+        ic = np.array([state[(x, j)] for x in self.states for j in self.state_vars[x]])
+        self.rti_step_nmpc(dc=r["ic"] - ic)  #: the residual is x(0) - x_ic
+        self.load_init_state_nmpc(src_kind="dict", state_dict=src)
+        r["ic"] = ic
+        stat = self.update_u(self.olnmpc)
+        if self.rti_log:
+            self.rti_log[-1]["feedback"] = time.time() - start
+        return stat
+
+    def solve_nmpc_deadline(self, src="estimated", deadline=None, **kwargs):
+        """Solves the olnmpc with a deadline (see solve_dyn_deadline). If the solve misses the deadline or fails,
+        the last plan is shifted and corrected for the new state with one real-time iteration (fallback_nmpc).
+        Args:
+            src (str): "estimated" or "real" state for the fallback
+            deadline (float): Seconds, defaults to the deadline of the constructor
+            **kwargs: Options of solve_dyn
+        Returns:
+            int: Status of the solve (0 if success, 1 if not optimal, 2 if the deadline was missed)"""
+        stat = self.solve_dyn_deadline(self.olnmpc, deadline=deadline, **kwargs)
+        if stat == 0:
+            self._plan_nmpc = [v.value for v in self.olnmpc.component_data_objects(Var)]
+            self.update_u(self.olnmpc)
+        else:
+            self.fallback_nmpc(src=src)
+        return stat
+
+    def fallback_nmpc(self, src="estimated"):
+        """Shifted last plan with a first order correction for the new state, curr_u is updated"""
+        if self._plan_nmpc is None:
+            self.journalist("W", self._iteration_count, "fallback_nmpc", "No plan, the controls are kept")
+            return 1
+        for (v, val) in zip(self.olnmpc.component_data_objects(Var), self._plan_nmpc):
+            v.value = val
+        self.rti_preparation_nmpc(shift=True, iterations=0)
+        stat = self.rti_feedback_nmpc(src=src)
+        self._plan_nmpc = [v.value for v in self.olnmpc.component_data_objects(Var)]
+        return stat
+
     def create_suffixes_amsnmpc(self):
         '''create suffixes for amsnmpc. Because we need to extend the KKT matrix, 
         dsdp mode is used. Therefore, create suffixes seperately from asnmpc.
@@ -958,14 +1361,20 @@ class NmpcGen_DAE(DynGen_DAE):
         
         self.record_suffix_u = {}
         count_var = 1
+        free = {}  #: the stages of a block share the suffix of its free control
         for i in range(self.amsnmpc_Ns):
             # t = t_ij(self.olnmpc.t, i, 0)
             self.record_suffix_u[i] = {}
+            if len(self.u_param_nmpc[i]) > 1:
+                raise ValueError("amsNMPC needs a free control (block start) at each of the first Ns elements")
+            i0 = self.u_param_nmpc[i][0][0]
             for u in self.u:
-                uv = getattr(self.olnmpc, u)
-                uv[i].set_suffix_value(self.olnmpc.var_order, count_var)
-                self.record_suffix_u[i][u] = count_var
-                count_var += 1
+                if (u, i0) not in free:
+                    uv = getattr(self.olnmpc, u)
+                    uv[i0].set_suffix_value(self.olnmpc.var_order, count_var)
+                    free[(u, i0)] = count_var
+                    count_var += 1
+                self.record_suffix_u[i][u] = free[(u, i0)]
                 
         self.record_suffix_x = {}
         for i in range(self.amsnmpc_Ns):
@@ -1240,28 +1649,72 @@ class NmpcGen_DAE(DynGen_DAE):
         self.Pred_amsnmpc.name = "Dynamic Predictor for amsNMPC"
         aug_discretization(self.Pred_amsnmpc, nfe=self.amsnmpc_Ns, ncp=self.ncp_t)
 
-    def predictor_amsNMPC(self, src="estimated"):
-        """Predict the states for the next Nsth step for amsNMPC"""
-        if self.Pred_amsnmpc:
-            pass
-        else:
-            self.create_predictor_amsNMPC()
-        for i in range(self.amsnmpc_Ns):
-            load_iguess(self.olnmpc, self.Pred_amsnmpc, i, i) #better to use result after update but it's fine KH.L
-        if src == "estimated":
-            self.load_init_state_gen(self.Pred_amsnmpc, src_kind="dict", state_dict="estimated")  #: Load the initial state
-        else:
-            self.load_init_state_gen(self.Pred_amsnmpc, src_kind="dict", state_dict="real")  #: Load the initial state
-            
-        #inject inputs
+    def predictor_amsNMPC(self, src="estimated", background=False):
+        """Predict the states for the next Nsth step for amsNMPC
+        Args:
+            src (str): "estimated" or "real" initial state
+            background (bool): Start the prediction in a separate process and return, e.g. to overlap it with the
+            plant step. The next call (or preparation_phase_nmpc) collects the result. The predictor models are
+            built here before the fork, the child only solves them and sends its solve_log entries back"""
+        if background:
+            self.build_predictor_amsNMPC()
+            if self.ams_predictor == "sens":  #: otherwise every child linearizes again
+                state = self.curr_estate if src == "estimated" else self.curr_rstate
+                self.sens_predict(state, self._u_inject_amsnmpc()[0])
+            n_log = len(self.solve_log)
+            self._ams_pred_task = BackgroundTask(lambda: (self._predict_amsnmpc(src), self.pred_stats,
+                                                          self.solve_log[n_log:]))
+            return
+        if self._ams_pred_task is not None:
+            self.collect_predictor_amsNMPC()
+            return
+        self.curr_pstate.update(self._predict_amsnmpc(src))
+
+    def collect_predictor_amsNMPC(self):
+        """Waits for the prediction started with predictor_amsNMPC(background=True)"""
+        task, self._ams_pred_task = self._ams_pred_task, None
+        task.wait()
+        if task.status != "ok":
+            raise DynSolWeAreDone("amsNMPC predictor failed " + str(task.value))
+        pstate, self.pred_stats, entries = task.value
+        self.solve_log.extend(entries)
+        self.curr_pstate.update(pstate)
+
+    def build_predictor_amsNMPC(self):
+        """Builds the predictor model if it is not there, Pred_amsnmpc for "nlp" and PlantPred otherwise"""
+        if self.ams_predictor == "nlp":
+            if not self.Pred_amsnmpc:
+                self.create_predictor_amsNMPC()
+        elif not self.PlantPred:
+            self.create_predictor()
+            load_iguess(self.PlantSample, self.PlantPred, 0, 0)
+
+    def _u_inject_amsnmpc(self):
         check = 0
         for i in self.u_for_pred.keys():
             if not self.u_for_pred[i]:
                 check = 1
         if check == 0:
-            u_inject = self.u_for_pred
+            return self.u_for_pred
+        return self.u_within_Ns_recent
+
+    def _predict_amsnmpc(self, src):
+        #inject inputs
+        u_inject = self._u_inject_amsnmpc()
+        self.build_predictor_amsNMPC()
+        if self.ams_predictor != "nlp":
+            state = dict(self.curr_estate if src == "estimated" else self.curr_rstate)
+            for i in range(self.amsnmpc_Ns):
+                state = self._predict_element_amsnmpc(state, u_inject[i])
+            return state
+
+        for i in range(self.amsnmpc_Ns):
+            load_iguess(self.olnmpc, self.Pred_amsnmpc, i, i) #better to use result after update but it's fine KH.L
+        if src == "estimated":
+            self.load_init_state_gen(self.Pred_amsnmpc, src_kind="dict", state_dict="estimated")  #: Load the initial state
         else:
-            u_inject = self.u_within_Ns_recent
+            self.load_init_state_gen(self.Pred_amsnmpc, src_kind="dict", state_dict="real")  #: Load the initial state
+
         for i in range(self.amsnmpc_Ns):
             for j in range(self.ncp_tnmpc+1):
                 tij = t_ij(self.Pred_amsnmpc.t, i, j)
@@ -1274,12 +1727,41 @@ class NmpcGen_DAE(DynGen_DAE):
                               stop_if_nopt=True,
                               jacobian_regularization_value=1e-02,
                               linear_scaling_on_demand=True)
+        pstate = {}
         for x in self.states:
             xvar = getattr(self.Pred_amsnmpc, x)
             t = t_ij(self.Pred_amsnmpc.t, self.amsnmpc_Ns-1, self.ncp_t) #end time
             for j in self.state_vars[x]:
-                self.curr_pstate[(x, j)] = value(xvar[t, j]) 
-            
+                pstate[(x, j)] = value(xvar[t, j])
+        return pstate
+
+    def _predict_element_amsnmpc(self, state, u_dict):
+        """Final state of one element from state with the controls u_dict, one-element predictor (PlantPred)"""
+        if self.ams_predictor == "sens":
+            xf = self.sens_predict(state, u_dict)
+            if xf is not None:
+                self.pred_stats["sens"] += 1
+                return xf
+        self.pred_stats["nlp"] += 1
+        for x in self.states:
+            xic = getattr(self.PlantPred, x + "_ic")
+            xvar = getattr(self.PlantPred, x)
+            for j in self.state_vars[x]:
+                xic[j].value = state[(x, j)]
+                xvar[(0,) + j].set_value(state[(x, j)])
+        for u in self.u:
+            uvar = getattr(self.PlantPred, u)
+            for key in uvar.keys():
+                uvar[key].value = u_dict[u]
+        self.solve_dyn(self.PlantPred, skip_update=True,
+                       iter_max=250,
+                       stop_if_nopt=True,
+                       jacobian_regularization_value=1e-02,
+                       linear_scaling_on_demand=True)
+        t = t_ij(self.PlantPred.t, 0, self.ncp_t)
+        return dict(((x, j), value(getattr(self.PlantPred, x)[(t,) + j])) for x in self.states
+                    for j in self.state_vars[x])
+
     def update_u_amsnmpc(self):
         stat = 0
         fe = 0
@@ -1357,23 +1839,47 @@ class NmpcGen_DAE(DynGen_DAE):
                         else:
                             self.other_vars[name].append((index,))     
         
+        self.tp_incidence_structure()
         self.diff_equ = []
         self.alge_equ = []
         self.diff_var_con = {}
+        self.tp_state_con = {}
+        for con_key, dvars in self.tp_con_der_vars.items():
+            if not dvars:
+                self.alge_equ.append(con_key)
+                continue
+            self.diff_equ.append(con_key)
+            for (x, index) in dvars:
+                self.diff_var_con[x] = con_key[0]
+                self.tp_state_con[(x, index)] = con_key
+
+    def tp_incidence_structure(self):
+        """Walks the expression of every constraint of tp_model once.
+
+        self.tp_incidence(ComponentMap): variable data -> list of (constraint name, index)
+        self.tp_con_der_vars(dict): (constraint name, index) -> list of (state, index) of its derivative variables
+        """
+        der_map = ComponentMap()
+        for dvname in self.der_var:
+            dv = getattr(self.tp_model, dvname, None)  #: a plain Var in the steady-state model
+            if dv is None:
+                continue
+            x = self.diff_der_var[dvname]
+            for k in dv.keys():
+                der_map[dv[k]] = (x, k if isinstance(k, tuple) else (k,))
+        self.tp_incidence = ComponentMap()
+        self.tp_con_der_vars = OrderedDict()
         for con in self.tp_model.component_objects(Constraint):
-            conname = con.getname()                
-            for i in list(con.keys()):
-                conexpr_string = con[i].expr.to_string()
-                flag = 0
-                for dv in self.der_var:
-                    if dv in conexpr_string:
-                        self.diff_equ.append((conname,i))
-                        set_index = self.diff_der_var[dv]
-                        self.diff_var_con[set_index] = conname
-                        flag = 1
-                if flag == 0:
-                    self.alge_equ.append((conname,i))          
-    
+            conname = con.getname()
+            for i in con.keys():
+                con_key = (conname, i)
+                dvars = []
+                for v in identify_variables(con[i].body, include_fixed=True):
+                    self.tp_incidence.setdefault(v, []).append(con_key)
+                    if v in der_map:
+                        dvars.append(der_map[v])
+                self.tp_con_der_vars[con_key] = dvars
+
     def tp_k_aug_suffix_locate_cons_vars(self):
         
         if hasattr(self.olnmpc, "dcdp"):
@@ -1397,11 +1903,11 @@ class NmpcGen_DAE(DynGen_DAE):
                 xvar[(1,) + j].set_suffix_value(self.tp_model.var_order, count_var)
                 self.tp_vars_suffix[(x, (1,) + j)] = count_var
             
-            condotx = self.diff_var_con[x]
-            conv = getattr(self.tp_model, condotx)
-            for j in self.state_vars[x]: #remaining set of constraint must be the same as x KH.L
-                index = (1,) + j
-                count_con += 1 
+            for j in self.state_vars[x]:
+                #: the equation of dx/dt from the incidence structure, same index as x by default
+                condotx, index = self.tp_state_con.get((x, (1,) + j), (self.diff_var_con[x], (1,) + j))
+                conv = getattr(self.tp_model, condotx)
+                count_con += 1
                 conv[index].set_suffix_value(self.tp_model.dcdp, count_con)
                 self.tp_cons_suffix[(condotx, index)] = count_con
         
@@ -1433,24 +1939,24 @@ class NmpcGen_DAE(DynGen_DAE):
             conv[index].set_suffix_value(self.tp_model.dcdp, count_con)
             self.tp_cons_suffix[con_flag] = count_con
         
+    @staticmethod
+    def tp_order_index(filename):
+        """Position of every row (column) of the k_aug Jacobian in the suffix order, from conorder.txt (varorder.txt).
+        Entry i of the file is the 1-based position of the i-th row (column)."""
+        order = np.atleast_1d(np.genfromtxt(filename, dtype = float)).astype(int) - 1
+        index = np.empty(order.size, dtype = int)
+        index[order] = np.arange(order.size)
+        return index
+
     def tp_rearrange_jac(self, jac):
-        #change the column order first
-        col_jac_info = np.genfromtxt("varorder.txt", dtype = float)
-        ncol, = np.shape(col_jac_info)
-        col_perm = np.zeros((ncol, ncol))
-        for i, idx in enumerate(col_jac_info):
-            col_perm[i, np.int(idx)-1] = 1
-        newjac = np.dot(jac, col_perm)
-        
-        #change the row order next
-        row_jac_info = np.genfromtxt("conorder.txt", dtype = float)
-        nrow, = np.shape(row_jac_info)
-        row_perm = np.zeros((nrow, nrow))
-        for i, idx in enumerate(row_jac_info):
-            row_perm[np.int(idx)-1, i] = 1
-        reordered_jac = np.dot(row_perm, newjac)
-        return reordered_jac
-    
+        """Reorders the rows and columns of the Jacobian by the dcdp and var_order suffixes. Works on dense arrays
+        and scipy.sparse matrices (the result is csr)."""
+        col_index = self.tp_order_index("varorder.txt")
+        row_index = self.tp_order_index("conorder.txt")
+        if issparse(jac):
+            return jac.tocsc()[:, col_index].tocsr()[row_index, :]
+        return jac[row_index][:, col_index]
+
     def tp_number_vars_cons_info(self):
         '''
         Get info about number of 
@@ -1472,35 +1978,54 @@ class NmpcGen_DAE(DynGen_DAE):
         self.n_DE = len(self.diff_equ)
         self.n_AE = len(self.alge_equ)
         
+    def tp_jac_blocks(self, reordered_jac):
+        """Blocks of the reordered Jacobian: rows are (diff. equations, alg. equations) and columns are (states,
+        controls, other vars)."""
+        nx = self.num_flatten_var
+        nu = self.n_controls
+        ny = self.n_flatten_othervars
+        f = reordered_jac[0:self.n_DE, :]
+        g = reordered_jac[self.n_DE:self.n_DE + self.n_AE, :]
+        return {"dfdx": f[:, 0:nx], "dfdu": f[:, nx:nx + nu], "dfdy": f[:, nx + nu:nx + nu + ny],
+                "dgdx": g[:, 0:nx], "dgdu": g[:, nx:nx + nu], "dgdy": g[:, nx + nu:nx + nu + ny]}
+
+    @staticmethod
+    def tp_reduce_blocks(dfdy, dgdy, blocks):
+        """-(df/dz - df/dy (dg/dy)^-1 dg/dz) for every (df/dz, dg/dz) in blocks. dg/dy is factorized once (sparse LU)
+        and all the right hand sides are solved together."""
+        dense = lambda m: m.toarray() if issparse(m) else np.asarray(m, dtype=float)
+        sizes = [df.shape[1] for (df, dg) in blocks]
+        dfdz = np.hstack([dense(df) for (df, dg) in blocks])
+        if dgdy.shape[0] > 0:
+            rhs = np.hstack([dense(dg) for (df, dg) in blocks])
+            if issparse(dgdy):
+                sol = splu(csc_matrix(dgdy)).solve(rhs)
+            else:
+                sol = np.linalg.solve(dgdy, rhs)
+            dfdz = dfdz - np.asarray(dfdy.dot(sol))
+        return np.split(-dfdz, np.cumsum(sizes)[:-1], axis=1)
+
+    def tp_calculate_A_B(self, reordered_jac):
+        """Linear model dx/dt = A dx + B du of the DAE, the algebraic variables are eliminated.
+
+        Args:
+            reordered_jac: Jacobian reordered by tp_rearrange_jac (dense or scipy.sparse).
+
+        Returns:
+            tuple: tp_A (numpy.ndarray), tp_B (numpy.ndarray)
+        """
+        blk = self.tp_jac_blocks(reordered_jac)
+        tp_A, tp_B = self.tp_reduce_blocks(blk["dfdy"], blk["dgdy"],
+                                           [(blk["dfdx"], blk["dgdx"]), (blk["dfdu"], blk["dgdu"])])
+        return tp_A, tp_B
+
     def tp_calculate_A(self, reordered_jac):
-        dfdx = reordered_jac[0:self.n_DE, 0:self.num_flatten_var]
-        dfdy = reordered_jac[0:self.n_DE, 
-                             self.num_flatten_var+self.n_controls:self.num_flatten_var+self.n_controls+self.n_flatten_othervars]
-        dgdx = reordered_jac[self.n_DE:self.n_DE+self.n_AE, 0:self.num_flatten_var]
-        dgdy = reordered_jac[self.n_DE:self.n_DE+self.n_AE, 
-                             self.num_flatten_var+self.n_controls:self.num_flatten_var+self.n_controls+self.n_flatten_othervars]
-          
-        a1 = np.matmul(dfdy, np.linalg.inv(dgdy))
-        tp_A = dfdx - np.matmul(a1, dgdx) 
-        tp_A = -tp_A
-        return tp_A
-    
+        return self.tp_calculate_A_B(reordered_jac)[0]
+
     def tp_calculate_B(self, reordered_jac):
-        dfdx = reordered_jac[0:self.n_DE,
-                             self.num_flatten_var:self.num_flatten_var+self.n_controls]
-        dfdy = reordered_jac[0:self.n_DE, 
-                             self.num_flatten_var+self.n_controls:self.num_flatten_var+self.n_controls+self.n_flatten_othervars]
-        dgdx = reordered_jac[self.n_DE:self.n_DE+self.n_AE,
-                             self.num_flatten_var:self.num_flatten_var+self.n_controls]
-        dgdy = reordered_jac[self.n_DE:self.n_DE+self.n_AE, 
-                             self.num_flatten_var+self.n_controls:self.num_flatten_var+self.n_controls+self.n_flatten_othervars]
-        
-        b1 = np.matmul(dfdy, np.linalg.inv(dgdy))
-        tp_B = dfdx - np.matmul(b1, dgdx) 
-        tp_B = -tp_B
-        return tp_B
-        
-    def tp_linearize_A_B(self):
+        return self.tp_calculate_A_B(reordered_jac)[1]
+
+    def tp_linearize_A_B(self, jacobian="k_aug"):
         '''
         Linearize the DAE model with steady states and controls. 
         1. Solve for the steady states and controls
@@ -1510,6 +2035,11 @@ class NmpcGen_DAE(DynGen_DAE):
             (because the model is DAE not ODE, need to use the "derivative jacobian"
              to get A and B)
 
+        Parameters
+        ----------
+        jacobian(str): "k_aug" (default) or "ad", the latter evaluates the Jacobian in this process
+            (nmpc_mhe.aux.derivatives) already in the suffix order, skipping steps 2 and 3.
+
         Returns
         -------
         tp_A : numpy.ndarray(matrix)
@@ -1554,7 +2084,16 @@ class NmpcGen_DAE(DynGen_DAE):
         
         self.catagorize_equations_vars()
         self.tp_k_aug_suffix_locate_cons_vars()
-        
+        self.tp_number_vars_cons_info()
+
+        if jacobian == "ad":
+            rows = sorted(self.tp_model.dcdp.keys(), key=lambda c: self.tp_model.dcdp[c])
+            cols = sorted(self.tp_model.var_order.keys(), key=lambda v: self.tp_model.var_order[v])
+            reordered_jac, _, _ = evaluate_jacobian(self.tp_model, variables=cols, constraints=rows)
+            return self.tp_calculate_A_B(reordered_jac)
+        elif jacobian != "k_aug":
+            raise ValueError("jacobian must be either \"k_aug\" or \"ad\"")
+
         self.solve_dyn(self.tp_model, iter_max=2, stop_if_nopt=True)
         
         self.tp_model.ipopt_zL_in.update(self.tp_model.ipopt_zL_out)  #: important!
@@ -1565,12 +2104,10 @@ class NmpcGen_DAE(DynGen_DAE):
         self.tp_model.solutions.load_from(results)
         os.rename(r'jacobi_debug.in', r'jacobi_debug' + str(self.int_file_nmpc_suf) + '.in')
         
-        jac, sizejac = get_jacobian_k_aug(self.int_file_nmpc_suf)
+        jac, sizejac = get_jacobian_k_aug(self.int_file_nmpc_suf, sparse=True)
         reordered_jac = self.tp_rearrange_jac(jac)
         
-        self.tp_number_vars_cons_info()
-        tp_A = self.tp_calculate_A(reordered_jac)
-        tp_B = self.tp_calculate_B(reordered_jac)
+        tp_A, tp_B = self.tp_calculate_A_B(reordered_jac)
         
         return tp_A, tp_B
     
@@ -1592,74 +2129,159 @@ class NmpcGen_DAE(DynGen_DAE):
         
         return tp_Q_nmpc, tp_R_nmpc
     
-    def tp_simulation_many_pts(self, simulate_points, state_norm, tp_Ad, tp_Bd, K, plot_figure):
-        
-        #initilaize with ss
-        self.tp_simulate = clone_the_model(self.d_mod)
-        augment_model(self.tp_simulate, 1, self.ncp_t, new_timeset_bounds=(0, self.hi_t))
-        aug_discretization(self.tp_simulate, nfe=1, ncp=self.ncp_t)
-        
-        list_ln_pert_x = []
-        list_ln_phi = []
-        
-        for pt in range(simulate_points):
-            #icc
-            norm_x = np.random.rand()*state_norm + 0.01
-            random_x = np.zeros((self.num_flatten_var, 1))
-            for i in range(self.num_flatten_var):
-                random_x[i,0] = np.random.normal(0., 1.)
-            norm_random_x = np.linalg.norm(random_x)
-            pert_x = norm_x*(random_x/norm_random_x)
-            
-            n_pert_x = np.linalg.norm(pert_x, "fro")
-            if not np.allclose([norm_x],[n_pert_x]):
-                raise RuntimeError("assigned norm and calculated norm don't match")
-            ln_n_pert_x = np.log(n_pert_x)
-            
-            uf = -K.dot(pert_x)
-            
-            count = 0
-            for x in self.states:
-                xvar = getattr(self.tp_simulate, x)
-                x_ic = getattr(self.tp_simulate, x + "_ic")
-                for j in self.state_vars[x]:
-                    xvar[:,j] = self.tp_state_ss[(x,j)]
-                    x_ic[j] = self.tp_state_ss[(x,j)] + pert_x[count,0]
-                    count += 1
-             
-            count = 0
-            for u in self.u:
-                uvar = getattr(self.tp_simulate, u)
-                uvar[:] = self.tp_u_ss[u] + uf[count,0] 
-                count += 1
-                
-                
-            self.solve_dyn(self.tp_simulate, iter_max=10, stop_if_nopt=True)
-            
-            phi_1 = np.zeros((self.num_flatten_var, 1))
-            t = t_ij(self.tp_simulate.t, 0, self.ncp_t)
-            count = 0
-            for x in self.states:
-                xvar = getattr(self.tp_simulate, x)
-                for j in self.state_vars[x]:
-                    phi_1[count,0] = value(xvar[(t,j)]) - self.tp_state_ss[(x,j)]
-                    count += 1
-            
-            Ak = tp_Ad - tp_Bd.dot(K)
-            phi_2 = Ak.dot(pert_x)
-            
-            phi = phi_1 - phi_2
-            n_phi = np.linalg.norm(phi, "fro")
-            ln_n_phi = np.log(n_phi)
-            
-            
-            list_ln_pert_x.append(ln_n_pert_x)
-            list_ln_phi.append(ln_n_phi)
-        
-        q, lnM = solve_bounded_line(list_ln_pert_x, list_ln_phi)
+    def tp_build_simulator(self, batch_size=1):
+        """One-element simulator of the plant around the steady state. With batch_size > 1 the model holds that many
+        independent copies (scenarios) that are solved as a single NLP.
+
+        Returns:
+            tuple: The model to solve and the list of scenario blocks.
+        """
+        blocks = []
+        for b in range(0, batch_size):
+            sim = clone_the_model(self.d_mod)
+            augment_model(sim, 1, self.ncp_t, new_timeset_bounds=(0, self.hi_t))
+            aug_discretization(sim, nfe=1, ncp=self.ncp_t)
+            blocks.append(sim)
+        if batch_size == 1:
+            return blocks[0], blocks
+        batch = ConcreteModel()
+        for b in range(0, batch_size):
+            batch.add_component("scenario_{:d}".format(b), blocks[b])
+        batch.name = "tp_simulate_batch"
+        return batch, blocks
+
+    def tp_run_samples(self, sim, blocks, seed, n_points, state_norm, Ak, K):
+        """Simulates n_points random initial states (norm in [0.01, 0.01 + state_norm]) with the LQR control u = -Kx and
+        computes phi = x_plant - (A - BK)x.
+
+        Args:
+            sim: Model from tp_build_simulator.
+            blocks (list): Scenario blocks of sim.
+            seed: Seed or np.random.SeedSequence of this stream.
+            n_points (int): Number of samples.
+            state_norm (float): Range of the norm of the perturbation.
+            Ak (np.ndarray): Closed-loop matrix Ad - Bd K.
+            K (np.ndarray): LQR gain.
+
+        Returns:
+            tuple: ln|x| and ln|phi| arrays, nan where the simulation failed, and the number of rejected samples.
+        """
+        rng = np.random.default_rng(seed)
+        rejected = 0
+        ln_x = np.full(n_points, np.nan)
+        ln_phi = np.full(n_points, np.nan)
+        t = t_ij(blocks[0].t, 0, self.ncp_t)
+        for start in range(0, n_points, len(blocks)):
+            batch = range(start, min(start + len(blocks), n_points))
+            pert = np.zeros((len(blocks), self.num_flatten_var, 1))  #: unused blocks stay at the steady state
+            for b, pt in enumerate(batch):
+                norm_x = rng.random() * state_norm + 0.01
+                random_x = rng.normal(0., 1., (self.num_flatten_var, 1))
+                pert[b] = norm_x * (random_x / np.linalg.norm(random_x))
+            for b, blk in enumerate(blocks):
+                uf = -K.dot(pert[b])
+                count = 0
+                for x in self.states:
+                    xvar = getattr(blk, x)
+                    x_ic = getattr(blk, x + "_ic")
+                    for j in self.state_vars[x]:
+                        xvar[:, j] = self.tp_state_ss[(x, j)]
+                        x_ic[j] = self.tp_state_ss[(x, j)] + pert[b][count, 0]
+                        count += 1
+                for count, u in enumerate(self.u):
+                    uvar = getattr(blk, u)
+                    uvar[:] = self.tp_u_ss[u] + uf[count, 0]
+            try:
+                stat = self.solve_dyn(sim, iter_max=10, o_tee=False)
+            except DynSolWeAreDone:
+                stat = 1
+            if stat != 0:
+                rejected += len(batch)
+                self.journalist("W", self._iteration_count, "tp_run_samples",
+                                "Simulation of samples {:d} to {:d} failed, rejected".format(batch[0], batch[-1]))
+                continue
+            for b, pt in enumerate(batch):
+                phi_1 = np.zeros((self.num_flatten_var, 1))
+                count = 0
+                for x in self.states:
+                    xvar = getattr(blocks[b], x)
+                    for j in self.state_vars[x]:
+                        phi_1[count, 0] = value(xvar[(t,) + j]) - self.tp_state_ss[(x, j)]
+                        count += 1
+                phi = phi_1 - Ak.dot(pert[b])
+                ln_x[pt] = np.log(np.linalg.norm(pert[b], "fro"))
+                ln_phi[pt] = np.log(np.linalg.norm(phi, "fro"))
+        return ln_x, ln_phi, rejected
+
+    def tp_sample_many_pts(self, simulate_points, state_norm, tp_Ad, tp_Bd, K, **kwargs):
+        """Samples (ln|x|, ln|phi|) for the terminal region, optionally over a process pool.
+
+        The samples are split in chunks, each one with its own random stream spawned from seed, so the result does
+        not depend on the number of workers.
+
+        Args:
+            simulate_points (int): Number of samples.
+            state_norm (float): Range of the norm of the perturbation.
+            tp_Ad, tp_Bd, K (np.ndarray): Discrete-time linear model and LQR gain.
+            n_workers (int): Processes of the pool, None or 1 runs in this process.
+            seed (int): Seed of the streams, by default drawn from np.random.
+            batch_size (int): Samples solved together in one multi-scenario NLP.
+            chunk_size (int): Samples per task.
+
+        Returns:
+            tuple: ln|x| and ln|phi| arrays of the successful samples. The number of rejected samples (failed
+            simulations) is kept in tp_rejected.
+        """
+        n_workers = kwargs.pop("n_workers", None)
+        seed = kwargs.pop("seed", None)
+        batch_size = kwargs.pop("batch_size", 1)
+        chunk_size = kwargs.pop("chunk_size", max(batch_size, 25))
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - 1)
+        n_chunks = int(np.ceil(simulate_points / chunk_size))
+        streams = np.random.SeedSequence(seed).spawn(n_chunks)
+        tasks = [(streams[i], min(chunk_size, simulate_points - i * chunk_size)) for i in range(0, n_chunks)]
+        Ak = tp_Ad - tp_Bd.dot(K)
+
+        if not n_workers or n_workers == 1:
+            sim, blocks = self.tp_build_simulator(batch_size)
+            self.tp_simulate = sim
+            results = [self.tp_run_samples(sim, blocks, sd, n, state_norm, Ak, K) for sd, n in tasks]
+        else:
+            _TP_CONTEXT.clear()
+            _TP_CONTEXT.update({"nmpc": self, "state_norm": state_norm, "Ak": Ak, "K": K})
+            root = tempfile.mkdtemp(prefix="tp_sampler_", dir=os.getcwd())
+            pool = get_pool(processes=n_workers, initializer=_tp_sampler_init, initargs=(root, batch_size))
+            try:
+                results = pool.map(_tp_sampler_run, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+                _TP_CONTEXT.clear()
+                shutil.rmtree(root, ignore_errors=True)
+
+        ln_x = np.concatenate([r[0] for r in results])
+        ln_phi = np.concatenate([r[1] for r in results])
+        self.tp_rejected = sum(r[2] for r in results)
+        ok = np.isfinite(ln_x) & np.isfinite(ln_phi)
+        if not ok.any():
+            raise RuntimeError("Error when calculating terminal properties: all the simulations failed")
+        if not ok.all():
+            self.journalist("W", self._iteration_count, "tp_sample_many_pts",
+                            "{:d} of {:d} samples dropped ({:d} failed simulations)".format(
+                                int((~ok).sum()), simulate_points, self.tp_rejected))
+        self.tp_samples = (ln_x[ok], ln_phi[ok])
+        return self.tp_samples
+
+    def tp_simulation_many_pts(self, simulate_points, state_norm, tp_Ad, tp_Bd, K, plot_figure, **kwargs):
+        """Bounds the nonlinear part of the DAE, ln|phi| <= q ln|x| + lnM, from sampled simulations.
+        kwargs are passed to tp_sample_many_pts."""
+        ln_x, ln_phi = self.tp_sample_many_pts(simulate_points, state_norm, tp_Ad, tp_Bd, K, **kwargs)
+
+        q, lnM = solve_bounded_line(ln_x.tolist(), ln_phi.tolist())
         
         if plot_figure:
-            plt.plot(list_ln_pert_x, list_ln_phi, ".", label = "simulation points")
+            plt.plot(ln_x, ln_phi, ".", label = "simulation points")
             # abline(2.2, 3.25, label = "from Devin's thesis")
             abline(q, lnM, label = "bounded line")
             plt.legend()
@@ -1695,16 +2317,33 @@ class NmpcGen_DAE(DynGen_DAE):
         rhou(float): Ration between R and tp_Rt.
         simulate_points(float): Number of simulations.
         state_norm(float): Vecotr norm of the perturbed x.
+        plot_figure(bool): Plot the samples and the bounding line.
+        n_workers(int): Processes used for the simulations (None runs them here).
+        seed(int): Seed of the random perturbations.
+        batch_size(int): Simulations solved together as one NLP.
+        jacobian(str): "k_aug" or "ad", see tp_linearize_A_B.
+        use_cache(bool): Reuse the terminal properties of a previously visited operating point (tp_cache_key).
 
         '''
         
         simulate_points = kwargs.pop("simulate_points", 1000)
         state_norm = kwargs.pop("state_norm", 0.005)
-        plot_figure = kwargs.pop("plot_figure", True)
+        plot_figure = kwargs.pop("plot_figure", False)
         safety_factor_on_M = kwargs.pop("safety_factor_on_M", False)
+        jacobian = kwargs.pop("jacobian", "k_aug")
+        use_cache = kwargs.pop("use_cache", True)
+        sampler_kwargs = dict((k, kwargs.pop(k)) for k in ("n_workers", "seed", "batch_size") if k in kwargs)
+
+        key = self.tp_cache_key(rhox, rhou, simulate_points=simulate_points, state_norm=state_norm,
+                                safety_factor_on_M=safety_factor_on_M, seed=sampler_kwargs.get("seed"))
+        if use_cache and key in self.tp_cache:
+            self.journalist("I", self._iteration_count, "add_terminal_property_nmpc", "Terminal properties from cache")
+            self.tp_load_cache_entry(self.tp_cache[key])
+            self.add_terminal_cost_region()
+            return
         
         #Step 1 ~ 2
-        tp_Ac, tp_Bc = self.tp_linearize_A_B()
+        tp_Ac, tp_Bc = self.tp_linearize_A_B(jacobian=jacobian)
         tp_Cc = np.identity(self.num_flatten_var, dtype = float)
         tp_Dc = np.zeros((self.num_flatten_var, self.n_controls))
         
@@ -1725,7 +2364,8 @@ class NmpcGen_DAE(DynGen_DAE):
         K, P, E = dlqr(tp_Ad, tp_Bd, tp_Qt, tp_Rt)
         
         #Step 7 ~ 9
-        q, lnM = self.tp_simulation_many_pts(simulate_points, state_norm, tp_Ad, tp_Bd, K, plot_figure)
+        q, lnM = self.tp_simulation_many_pts(simulate_points, state_norm, tp_Ad, tp_Bd, K, plot_figure,
+                                             **sampler_kwargs)
         
         if q <=1:
             print("Warning: q is smaller than 1 and could yield infinite terminal region!")
@@ -1775,19 +2415,67 @@ class NmpcGen_DAE(DynGen_DAE):
         self.tp_cf = cf
         self.tp_area = area
         self.tp_P = P
+
+        self.tp_cache[key] = {"A": tp_Ac, "B": tp_Bc, "Ad": tp_Ad, "Bd": tp_Bd, "K": K, "P": P,
+                              "cf": cf, "area": area, "q": q, "lnM": lnM,
+                              "state_ss": [[x, list(j), self.tp_state_ss[(x, j)]] for (x, j) in self.tp_state_ss],
+                              "u_ss": self.tp_u_ss}
+        if self.tp_cache_file is not None:
+            self.save_tp_cache(self.tp_cache_file)
         
         self.add_terminal_cost_region()
+
+    def tp_cache_key(self, rhox, rhou, **kwargs):
+        """Key of the terminal properties: steady-state target, weights of the NMPC, rhox, rhou, sampling time and the
+        settings of the sampling (kwargs). Floats are rounded to tp_cache_digits significant digits."""
+        r = lambda v: float("{:.{}g}".format(float(v), self.tp_cache_digits))
+        key = {"x": sorted([str(k), r(v)] for (k, v) in self.curr_state_target.items()),
+               "u": sorted([str(k), r(v)] for (k, v) in self.curr_u_target.items()),
+               "Q": [r(value(self.olnmpc.Q_nmpc[k])) for k in sorted(self.olnmpc.Q_nmpc.keys())],
+               "R": [r(value(self.olnmpc.R_nmpc[k])) for k in sorted(self.olnmpc.R_nmpc.keys())],
+               "rho": [r(rhox), r(rhou)],
+               "hi_t": r(self.hi_t)}
+        for k in sorted(kwargs.keys()):
+            key[k] = kwargs[k] if kwargs[k] is None or isinstance(kwargs[k], bool) else r(kwargs[k])
+        return json.dumps(key, sort_keys=True)
+
+    def tp_load_cache_entry(self, entry):
+        self.tp_state_ss = dict(((x, tuple(j)), v) for (x, j, v) in entry["state_ss"])
+        self.tp_u_ss = dict(entry["u_ss"])
+        self.tp_cf = entry["cf"]
+        self.tp_area = entry["area"]
+        self.tp_P = np.asarray(entry["P"])
+
+    def save_tp_cache(self, filename):
+        """Writes the terminal-property cache to a json file."""
+        out = {}
+        for key, entry in self.tp_cache.items():
+            out[key] = dict((k, v.tolist() if isinstance(v, np.ndarray) else v) for (k, v) in entry.items())
+        with open(filename, "w") as f:
+            json.dump(out, f, default=float)
+
+    def load_tp_cache(self, filename):
+        """Adds the entries of a json file written by save_tp_cache."""
+        with open(filename, "r") as f:
+            entries = json.load(f)
+        for key, entry in entries.items():
+            for k in ("A", "B", "Ad", "Bd", "K", "P"):
+                entry[k] = np.asarray(entry[k])
+            self.tp_cache[key] = entry
         
     def add_terminal_cost_region(self, **kwargs):
         
         term_pen_value = kwargs.pop("term_pen", 1000.)
-        dict_tp_P = {}
-        for i in range(self.num_flatten_var):
-            for j in range(self.num_flatten_var):
-                # if self.tp_P[i,j] < 1.0E3:
-                #     dict_tp_P[(i,j)] = 1.0E3
-                # else:
-                dict_tp_P[(i,j)] = self.tp_P[i,j]
+        n_x = self.num_flatten_var
+        if self.terminal_cost == "factorized":
+            #: P = U.T U, the terminal cost is sum(z ** 2) with z = U (x - x_ref)
+            U = factor_weight(self.tp_P, band=self.terminal_band)
+            band = n_x if self.terminal_band is None else self.terminal_band
+            self._term_cols = [list(range(i, min(n_x, i + band + 1))) for i in range(0, n_x)]
+            dict_tp_L = dict(((i, j), U[i, j]) for i in range(0, n_x) for j in self._term_cols[i])
+        else:
+            P = np.asarray(self.tp_P)
+            dict_tp_P = dict(((i, j), P[i, j]) for i in range(0, n_x) for j in range(0, n_x))
                 
         def _terminal_region():
             expr_tr = 0
@@ -1802,7 +2490,10 @@ class NmpcGen_DAE(DynGen_DAE):
             self.olnmpc.term_epi.value = 0.
             self.olnmpc.term_pen.value = term_pen_value
             self.olnmpc.term_cf.value = self.tp_cf
-            self.olnmpc.term_P.store_values(dict_tp_P)
+            if self.terminal_cost == "factorized":
+                self.olnmpc.term_L.store_values(dict_tp_L)
+            else:
+                self.olnmpc.term_P.store_values(dict_tp_P)
             
             self.olnmpc.del_component("terminal_region")
             self.olnmpc.terminal_region = Constraint(expr = _terminal_region() - self.olnmpc.term_epi <= self.olnmpc.term_cf**2)
@@ -1811,7 +2502,6 @@ class NmpcGen_DAE(DynGen_DAE):
             self.olnmpc.term_epi = Var(initialize = 0., bounds = (0,None))
             self.olnmpc.term_pen = Param(initialize = term_pen_value, mutable = True)
             self.olnmpc.term_cf = Param(initialize = self.tp_cf, mutable = True)
-            self.olnmpc.term_P = Param(self.olnmpc.xmpcS_nmpc, self.olnmpc.xmpcS_nmpc, initialize = dict_tp_P, mutable = True)
             
             stage_cost_x_expr  = sum(
                                     sum(self.olnmpc.Q_w_nmpc[fe] * 
@@ -1821,10 +2511,23 @@ class NmpcGen_DAE(DynGen_DAE):
             self.olnmpc.stage_cost_x = Expression(expr = stage_cost_x_expr)
             
             fe_end = self.nfe_tnmpc -1
-            tc_expr = sum( (self.xmpc_l[fe_end][i] - self.olnmpc.xmpc_ref_nmpc[i])*
-                          sum( (self.xmpc_l[fe_end][j] - self.olnmpc.xmpc_ref_nmpc[j]) * self.olnmpc.term_P[i,j] 
-                              for j in self.olnmpc.xmpcS_nmpc)
-                          for i in self.olnmpc.xmpcS_nmpc)
+            if self.terminal_cost == "factorized":
+                self.olnmpc.term_L_set = Set(dimen=2, initialize=sorted(dict_tp_L.keys()))
+                self.olnmpc.term_L = Param(self.olnmpc.term_L_set, initialize = dict_tp_L, mutable = True)
+                dx = [value(self.xmpc_l[fe_end][j] - self.olnmpc.xmpc_ref_nmpc[j]) for j in range(0, n_x)]
+                self.olnmpc.term_z = Var(self.olnmpc.xmpcS_nmpc,
+                                         initialize = lambda m, i: sum(U[i, j] * dx[j] for j in self._term_cols[i]))
+                self.olnmpc.term_z_c = Constraint(self.olnmpc.xmpcS_nmpc,
+                                                  rule = lambda m, i: m.term_z[i] ==
+                                                  sum(m.term_L[i, j] * (self.xmpc_l[fe_end][j] - m.xmpc_ref_nmpc[j])
+                                                      for j in self._term_cols[i]))
+                tc_expr = sum(self.olnmpc.term_z[i] ** 2 for i in self.olnmpc.xmpcS_nmpc)
+            else:
+                self.olnmpc.term_P = Param(self.olnmpc.xmpcS_nmpc, self.olnmpc.xmpcS_nmpc, initialize = dict_tp_P, mutable = True)
+                tc_expr = sum( (self.xmpc_l[fe_end][i] - self.olnmpc.xmpc_ref_nmpc[i])*
+                              sum( (self.xmpc_l[fe_end][j] - self.olnmpc.xmpc_ref_nmpc[j]) * self.olnmpc.term_P[i,j] 
+                                  for j in self.olnmpc.xmpcS_nmpc)
+                              for i in self.olnmpc.xmpcS_nmpc)
             self.olnmpc.terminal_cost_x = Expression(expr = tc_expr)
             
             self.olnmpc.terminal_region = Constraint(expr = _terminal_region() - self.olnmpc.term_epi <= self.olnmpc.term_cf**2)
@@ -1845,7 +2548,13 @@ class NmpcGen_DAE(DynGen_DAE):
         self.olnmpc.del_component("term_pen")
         self.olnmpc.del_component("term_cf")
         self.olnmpc.del_component("term_P")
+        self.olnmpc.del_component("term_z_c")
+        self.olnmpc.del_component("term_z")
+        self.olnmpc.del_component("term_L")
+        self.olnmpc.del_component("term_L_set")
         self.olnmpc.del_component("terminal_region")
+        self.olnmpc.del_component("stage_cost_x")
+        self.olnmpc.del_component("terminal_cost_x")
         
         obj_target = getattr(self.olnmpc, "objfun_nmpc")
         obj_target.expr = self.olnmpc.xQ_expr_nmpc + self.olnmpc.xR_expr_nmpc
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark suite for the sample models.
+
+Builds the sample models through MheGen_DAE (which also builds the SteadyRef, PlantSample, lsmhe and olnmpc models)
+over a grid of discretization/horizon sizes and records the time spent on the most common operations of the closed
+loop, plus memory. Results are written as json so that runs can be compared against each other.
+
+Usage:
+    python -m testing.benchmarks.bench_sample_mods --models cstr_rodrigo hicks --nfe_t 5 10 --ncp_t 1 3 -o bench.json
+    python -m testing.benchmarks.bench_sample_mods --compare old.json new.json
+
+Every case runs in its own process and working directory, so the files written by the framework (ipopt.opt, labels,
+logs) do not pile up in the current directory and the peak rss reported belongs to that case only."""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import traceback
+
+try:
+    import resource
+except ImportError:  #: Not available on windows
+    resource = None
+
+
+def _cstr_rodrigo(nfe_t, ncp_t):
+    from sample_mods.cstr_rodrigo.cstr_c_nmpc import cstr_rodrigo_dae
+    return cstr_rodrigo_dae(nfe_t, ncp_t)
+
+
+def _hicks(nfe_t, ncp_t):
+    from sample_mods.hicks_reactor.hicks_reactor_devin import hicks_reactor_devin_dae_w_AE
+    return hicks_reactor_devin_dae_w_AE(nfe_t, ncp_t)
+
+
+def _yeonsoo(nfe_t, ncp_t):
+    from sample_mods.cstr_yeonsoo.cstr_yeonsoo import cstr_yeonsoo_dae
+    return cstr_yeonsoo_dae(nfe_t, ncp_t)
+
+
+def _distc(nfe_t, ncp_t):
+    from sample_mods.distc_pyDAE.distcpydaemod import mod
+    return mod.clone()  #: module level model, do not touch the original
+
+
+def _bfb(nfe_t, ncp_t):
+    try:
+        from sample_mods.bfb.dae.bfb import m
+    except Exception as exc:  #: The dae version of the bfb is still a script with errors at module level
+        raise ImportError("sample_mods.bfb.dae.bfb can not be imported: {!r}".format(exc))
+    return m.clone()
+
+
+#: name: (factory, states, controls, measurements, kwargs for MheGen_DAE)
+MODELS = {
+    "cstr_rodrigo": (_cstr_rodrigo, ["Ca", "T", "Tj"], ["u1"], ["T"],
+                     {"u_bounds": {"u1": (200, 1000)}}),
+    "hicks": (_hicks, ["zc", "zT"], ["d_u1", "d_u2"], ["zT"],
+              {"u_bounds": {"d_u1": (0.1667, 1.), "d_u2": (0.025, 1.)},
+               "var_bounds": {"zc": (0.0, 1.0), "zT": (0.0, None)}}),
+    "yeonsoo": (_yeonsoo, ["z1", "z2"], ["d_u1", "d_u2"], ["z2"],
+                {"u_bounds": {"d_u1": (0, 2500), "d_u2": (1, 40)}}),
+    "distc": (_distc, ["x", "M"], ["u1", "u2"], ["T", "Mv", "Mv1", "Mvn"],
+              {"u_bounds": {"u1": (0.1, 99.999), "u2": (0, None)},
+               "var_bounds": {"M": (1.0, 1e+07), "T": (200, 500), "x": (0.0, 1.0), "y": (0.0, 1.0)}}),
+    "bfb": (_bfb, ["Hgc", "Nsc", "Hsc", "Hge", "Nse", "Hse"], ["u1"], ["Tgb"], {}),
+}
+
+
+def expand_grid(models, nfe_t, ncp_t, nfe_tmhe, nfe_tnmpc, hi_t, ncp_tnmpc=(0,)):
+    """Cartesian product of the requested sizes. A value of 0 for nfe_tmhe/nfe_tnmpc means "same as nfe_t" (ncp_tnmpc
+    "same as ncp_t")."""
+    cases = []
+    for m, nfe, ncp, nmhe, nnmpc, cnmpc in itertools.product(models, nfe_t, ncp_t, nfe_tmhe, nfe_tnmpc, ncp_tnmpc):
+        cases.append({"model": m,
+                      "hi_t": hi_t,
+                      "nfe_t": nfe,
+                      "ncp_t": ncp,
+                      "nfe_tmhe": nmhe if nmhe > 0 else nfe,
+                      "nfe_tnmpc": nnmpc if nnmpc > 0 else nfe,
+                      "ncp_tnmpc": cnmpc if cnmpc > 0 else ncp})
+    return cases
+
+
+def _maxrss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  #: bytes in mac, kilobytes in linux
+        return rss / 1024. ** 2
+    return rss / 1024.
+
+
+def _timed(timings, name, f, *args, **kwargs):
+    t0 = time.perf_counter()
+    r = f(*args, **kwargs)
+    timings[name] = time.perf_counter() - t0
+    return r
+
+
+def _count(mod):
+    from pyomo.core.base import Var, Constraint
+    nv = sum(1 for _ in mod.component_data_objects(Var))
+    nc = sum(1 for _ in mod.component_data_objects(Constraint, active=True))
+    return {"n_vars": nv, "n_cons": nc}
+
+
+def _ipopt_iterations(logfile):
+    """Number of iterations from an ipopt output file, None if it is not there"""
+    try:
+        with open(logfile, "r") as f:
+            for line in f:
+                if line.startswith("Number of Iterations"):
+                    return int(line.split(":")[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _construct(case, timings, memory=None):
+    """Builds the MheGen_DAE object of a case and its olnmpc, the construction steps are timed in timings. With memory
+    (a dict, tracemalloc running) the traced peaks of the construction are stored there too."""
+    from nmpc_mhe.pyomo_dae.MHEGen_pyDAE import MheGen_DAE
+    factory, states, controls, measurements, kw = MODELS[case["model"]]
+    d_mod = _timed(timings, "build_base", factory, 1, 1)
+    e = _timed(timings, "construct_mhegen", MheGen_DAE, d_mod, case["hi_t"], states, controls, states, measurements,
+               nfe_t=case["nfe_t"], ncp_t=case["ncp_t"],
+               nfe_tmhe=case["nfe_tmhe"], nfe_tnmpc=case["nfe_tnmpc"],
+               ncp_tnmpc=case.get("ncp_tnmpc", case["ncp_t"]),
+               override_solver_check=True, **kw)
+    if memory is not None:
+        memory["tracemalloc_construction_mb"] = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+    _timed(timings, "get_state_vars", e.get_state_vars)
+    _timed(timings, "create_nmpc", e.create_nmpc)
+    if memory is not None:
+        memory["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+    return e
+
+
+def _memory_pass(case):
+    """Peak traced memory of the construction, in a pass of its own since tracemalloc slows down the allocations"""
+    memory = {}
+    tracemalloc.start()
+    try:
+        _construct(case, {}, memory=memory)
+    finally:
+        tracemalloc.stop()
+    return memory
+
+
+def _run_case_in_cwd(case, solve):
+    from nmpc_mhe.aux.utils import load_iguess
+    timings = {}
+    sizes = {}
+    solves = {}
+
+    e = _construct(case, timings)
+
+    t0 = time.perf_counter()
+    for i in range(0, e.nfe_tmhe):
+        load_iguess(e.PlantSample, e.lsmhe, 0, i)
+    timings["load_iguess_lsmhe"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i in range(0, e.nfe_tnmpc):
+        load_iguess(e.PlantSample, e.olnmpc, 0, i)
+    timings["load_iguess_olnmpc"] = time.perf_counter() - t0
+    _timed(timings, "shift_mhe", e.shift_mhe)
+
+    for name in ("PlantSample", "lsmhe", "olnmpc"):
+        sizes[name] = _count(getattr(e, name))
+
+    for method in ("radau", "bdf"):  #: integrator backend of the plant, compare with solves["PlantSample"]
+        t0 = time.perf_counter()
+        try:
+            stat = e.simulate_plant(method=method)
+        except Exception as exc:  #: Any failure is a result, not a crash of the suite
+            stat = repr(exc)
+        solves["plant_sim_" + method] = {"time": time.perf_counter() - t0, "status": stat}
+        if stat == 0:  #: only successful integrations are compared between runs
+            timings["plant_sim_" + method] = solves["plant_sim_" + method]["time"]
+
+    if solve:
+        if not e.ipopt.available(exception_flag=False):
+            solves["status"] = "ipopt unavailable"
+        else:
+            for name in ("SteadyRef", "PlantSample", "lsmhe", "olnmpc"):
+                mod = getattr(e, name)
+                t0 = time.perf_counter()
+                try:
+                    stat = e.solve_dyn(mod, o_tee=False, max_cpu_time=600)
+                except Exception as exc:  #: Any failure is a result, not a crash of the suite
+                    stat = repr(exc)
+                solves[name] = {"time": time.perf_counter() - t0, "status": stat}
+            if e.ncp_tnmpc != e.ncp_t:  #: ipopt iterations of the olnmpc from each initial guess of load_iguess
+                for interpolate in (False, True):
+                    for i in range(0, e.nfe_tnmpc):
+                        load_iguess(e.PlantSample, e.olnmpc, 0, i, interpolate=interpolate)
+                    log = "olnmpc_iguess_{}.log".format("lagrange" if interpolate else "copy")
+                    try:
+                        stat = e.solve_dyn(e.olnmpc, o_tee=False, max_cpu_time=600, output_file=log)
+                    except Exception as exc:
+                        stat = repr(exc)
+                    solves[log[:-4]] = {"status": stat, "iterations": _ipopt_iterations(log)}
+
+    memory = _memory_pass(case)
+    memory["maxrss_mb"] = _maxrss_mb()
+    return {"timings": timings,
+            "sizes": sizes,
+            "solves": solves,
+            "memory": memory}
+
+
+def run_case(args):
+    """Runs a single case inside a temporary working directory. Never raises, errors are part of the result."""
+    case, solve, keep_dirs = args
+    result = dict(case)
+    cwd = os.getcwd()
+    wd = tempfile.mkdtemp(prefix="bench_{}_".format(case["model"]))
+    os.chdir(wd)
+    try:
+        result.update(_run_case_in_cwd(case, solve))
+        result["status"] = "ok"
+    except ImportError as exc:
+        result["status"] = "unavailable"
+        result["error"] = repr(exc)
+    except Exception as exc:
+        result["status"] = "error"
+        result["error"] = repr(exc)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+        if keep_dirs:
+            result["workdir"] = wd
+        else:
+            shutil.rmtree(wd, ignore_errors=True)
+    return result
+
+
+def run_suite(cases, solve=False, keep_dirs=False, isolate=True):
+    """Runs all the cases, each one in a fresh process (isolate=True) so memory figures are not cumulative."""
+    results = []
+    for case in cases:
+        print("I[[bench]] {model} nfe_t={nfe_t} ncp_t={ncp_t} nfe_tmhe={nfe_tmhe} nfe_tnmpc={nfe_tnmpc} "
+              "ncp_tnmpc={ncp_tnmpc}".format(**case), file=sys.stderr)
+        if isolate:
+            pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+            try:
+                r = pool.apply(run_case, ((case, solve, keep_dirs),))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            r = run_case((case, solve, keep_dirs))
+        results.append(r)
+    return results
+
+
+def environment_info():
+    info = {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now().isoformat()}
+    for pkg in ("pyomo", "numpy", "scipy"):
+        try:
+            info[pkg] = __import__(pkg).__version__
+        except (ImportError, AttributeError):
+            info[pkg] = None
+    return info
+
+
+def _case_key(r):
+    return (r["model"], r["nfe_t"], r["ncp_t"], r["nfe_tmhe"], r["nfe_tnmpc"], r.get("ncp_tnmpc", r["ncp_t"]))
+
+
+def compare(old, new, threshold=0.2):
+    """Returns a list of (case, timing, old, new) for timings that got slower than threshold (relative)."""
+    old_map = dict((_case_key(r), r) for r in old["results"] if r.get("status") == "ok")
+    regressions = []
+    for r in new["results"]:
+        if r.get("status") != "ok" or _case_key(r) not in old_map:
+            continue
+        ro = old_map[_case_key(r)]
+        for k, v in r["timings"].items():
+            vo = ro["timings"].get(k)
+            if vo and v > vo * (1. + threshold):
+                regressions.append((_case_key(r), k, vo, v))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the sample models at a grid of horizon sizes")
+    parser.add_argument("--models", nargs="+", default=sorted(MODELS.keys()), choices=sorted(MODELS.keys()))
+    parser.add_argument("--nfe_t", nargs="+", type=int, default=[5])
+    parser.add_argument("--ncp_t", nargs="+", type=int, default=[3])
+    parser.add_argument("--nfe_tmhe", nargs="+", type=int, default=[0], help="0 means equal to nfe_t")
+    parser.add_argument("--nfe_tnmpc", nargs="+", type=int, default=[0], help="0 means equal to nfe_t")
+    parser.add_argument("--ncp_tnmpc", nargs="+", type=int, default=[0],
+                        help="0 means equal to ncp_t, otherwise --solve compares the initial guesses of the olnmpc")
+    parser.add_argument("--hi_t", type=float, default=1.)
+    parser.add_argument("--solve", action="store_true", help="Also time the ipopt solves (requires ipopt)")
+    parser.add_argument("--no-isolate", dest="isolate", action="store_false",
+                        help="Run all cases in this process (memory figures become cumulative)")
+    parser.add_argument("--keep-dirs", action="store_true", help="Keep the working directory of each case")
+    parser.add_argument("-o", "--output", default=None, help="json file for the results (default stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None,
+                        help="Compare two result files and report the slower timings")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], "r") as f:
+            old = json.load(f)
+        with open(args.compare[1], "r") as f:
+            new = json.load(f)
+        regressions = compare(old, new, threshold=args.threshold)
+        for case, k, vo, v in regressions:
+            print("W[[bench]] {}\t{}\t{:.4f}s -> {:.4f}s".format(case, k, vo, v))
+        return 1 if regressions else 0
+
+    cases = expand_grid(args.models, args.nfe_t, args.ncp_t, args.nfe_tmhe, args.nfe_tnmpc, args.hi_t,
+                        ncp_tnmpc=args.ncp_tnmpc)
+    out = {"environment": environment_info(),
+           "results": run_suite(cases, solve=args.solve, keep_dirs=args.keep_dirs, isolate=args.isolate)}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+    else:
+        json.dump(out, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
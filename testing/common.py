@@ -0,0 +1,66 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fixtures shared by the test modules: a working directory per test, the cstr_rodrigo controller and a solver
+stand-in for the machines without ipopt."""
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from sample_mods.cstr_rodrigo.cstr_c_nmpc import cstr_rodrigo_dae
+from nmpc_mhe.pyomo_dae.NMPCGen_pyDAE import NmpcGen_DAE
+from nmpc_mhe.aux.parallel import isolated_workdir
+from nmpc_mhe.aux.derivatives import evaluate_jacobian, evaluate_residuals
+from nmpc_mhe.aux.utils import load_iguess
+from scipy.sparse.linalg import spsolve
+import numpy as np
+import unittest
+
+STATES = ["Ca", "T", "Tj"]
+X_SS = {("Ca", (0,)): 0.019, ("T", (0,)): 384.0, ("Tj", (0,)): 371.2}
+
+
+class WorkdirTestCase(unittest.TestCase):
+    """Each test runs in a temporary directory of its own, the framework writes its files in the working directory"""
+    def setUp(self):
+        workdir = isolated_workdir(prefix="cappresse_test_", remove=True)
+        self.wd = workdir.__enter__()
+        self.addCleanup(workdir.__exit__, None, None, None)
+
+
+def cstr_nmpc(nfe_t=3, ncp_t=2, **kwargs):
+    """NmpcGen_DAE of the cstr_rodrigo reactor, 2 s sampling time, get_state_vars already called"""
+    e = NmpcGen_DAE(cstr_rodrigo_dae(2, ncp_t), 2, STATES, ["u1"], u_bounds={"u1": (200., 1000.)},
+                    nfe_t=nfe_t, ncp_t=ncp_t, **kwargs)
+    e.get_state_vars()
+    return e
+
+
+def tracking_nmpc(e):
+    """Builds the olnmpc of e, initialized with the PlantSample and tracking a point close to X_SS"""
+    e.create_nmpc()
+    for i in range(0, e.nfe_tnmpc):
+        load_iguess(e.PlantSample, e.olnmpc, 0, i)
+    e.curr_estate = dict(X_SS)
+    e.load_init_state_nmpc(src_kind="dict", state_dict="estimated")
+    e.set_weights_nmpc(Q=1. / np.array([0.0195, 380., 368.]) ** 2, R=np.array([1. / 500. ** 2]))
+    e.set_references_nmpc(x_ref=np.array([0.0195, 380., 368.]), u_ref=np.array([500.]))
+    e.new_weights_olnmpc(1., 1.)
+    return e
+
+
+def newton(m):
+    """The collocation plant is square, Newton gives what ipopt would"""
+    for i in range(0, 20):
+        r, _ = evaluate_residuals(m)
+        if np.linalg.norm(r, np.inf) < 1e-09:
+            break
+        jac, _, cols = evaluate_jacobian(m)
+        dz = spsolve(jac.tocsc(), -r)
+        for ((name, idx), d) in zip(cols, dz):
+            v = getattr(m, name)[idx]
+            v.set_value(value(v) + d)
+
+
+def newton_solve(mod, **kwargs):
+    """Stands for solve_dyn on square models"""
+    newton(mod)
+    return 0
@@ -0,0 +1,92 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from nmpc_mhe.aux.utils import t_ij
+from testing.common import WorkdirTestCase, cstr_nmpc, tracking_nmpc
+import unittest, time
+
+
+class TestDeadline(WorkdirTestCase):
+    def setUp(self):
+        super(TestDeadline, self).setUp()
+        self.nmpc = tracking_nmpc(cstr_nmpc(deadline=30.))
+
+    def _fake_solve(self, delay, u=None):
+        """Takes delay seconds, sets the first control (in the child process)"""
+        def solve_dyn(mod, **kwargs):
+            time.sleep(delay)
+            if u is not None:
+                mod.u1[0].set_value(u)
+            self.nmpc.solve_log.append({"model": mod.name, "termination": "optimal"})
+            return 0
+        return solve_dyn
+
+    def test_met_and_missed(self):
+        e = self.nmpc
+        e.rti_preparation_nmpc(shift=False, iterations=25)  #: a converged plan
+        u_plan = value(e.olnmpc.u1[1])
+        e.solve_dyn = self._fake_solve(0.)
+        self.assertEqual(e.solve_nmpc_deadline(), 0)
+        self.assertEqual(e.missed_deadlines, {})
+        self.assertEqual(e.solve_log[-1]["termination"], "optimal")
+        #: the fallback is the shifted plan corrected for the new state
+        e.solve_dyn = self._fake_solve(60.)
+        t1 = t_ij(e.olnmpc.t, 0, e.ncp_tnmpc)
+        for x in e.states:  #: where the plan goes, with a disturbance
+            e.curr_estate[(x, (0,))] = value(getattr(e.olnmpc, x)[t1, 0])
+        e.curr_estate[("T", (0,))] += 0.1
+        self.assertEqual(e.solve_nmpc_deadline(deadline=0.2), 2)
+        self.assertEqual(e.missed_deadlines[e.olnmpc.name], 1)
+        u_fb = e.curr_u["u1"]
+        e.rti_preparation_nmpc(shift=False, iterations=10)  #: what the solve would have given
+        u_new = value(e.olnmpc.u1[0])
+        self.assertLess(abs(u_fb - u_new), 0.5 * abs(u_plan - u_new))
+        self.assertIn(e.olnmpc.name, e._background)
+        #: the late solve is cancelled by the next one
+        e.solve_dyn = self._fake_solve(0., u=321.)
+        self.assertEqual(e.solve_nmpc_deadline(), 0)
+        self.assertEqual(e._background, {})
+        self.assertEqual(e.curr_u["u1"], 321.)
+
+    def test_late_result(self):
+        e = self.nmpc
+        e.solve_dyn = self._fake_solve(0.5, u=432.)
+        self.assertEqual(e.solve_dyn_deadline(e.olnmpc, deadline=0.01), 2)
+        self.assertNotEqual(value(e.olnmpc.u1[0]), 432.)
+        self.assertEqual(e.collect_background(e.olnmpc, wait=True), 0)
+        self.assertEqual(value(e.olnmpc.u1[0]), 432.)
+
+
+class TestRetryLadder(WorkdirTestCase):
+    def setUp(self):
+        super(TestRetryLadder, self).setUp()
+        self.nmpc = cstr_nmpc()
+
+    def test_first_optimal_wins(self):
+        e = self.nmpc
+
+        def solve_dyn(mod, **kwargs):
+            """bound_push converges, ma57_pivtol alone hangs, the rest fails right away"""
+            if "bound_push" in kwargs:
+                time.sleep(0.2)
+                mod.Tjinb[2].set_value(kwargs["bound_push"])
+                return 0
+            if "ma57_pivtol" in kwargs:
+                time.sleep(60.)
+            return 1
+
+        e.solve_dyn = solve_dyn
+        ladder = [{"tol": 1e-03}, {"ma57_pivtol": 1e-12}, {"bound_push": 0.1}]
+        self.assertEqual(e.solve_dyn_retry(e.PlantSample, ladder=ladder), 0)
+        self.assertEqual(value(e.PlantSample.Tjinb[2]), 0.1)
+        self.assertEqual(e.retry_log[-1]["rung"], 2)
+        self.assertEqual(e.retry_log[-1]["failed"], 1)
+        self.assertLess(e.retry_log[-1]["time"], 30.)
+        self.assertEqual(e.solve_dyn_retry(e.PlantSample, ladder=ladder[:1]), 1)
+        self.assertIsNone(e.retry_log[-1]["rung"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.environ import ConcreteModel, Var, Param, Constraint, Objective, exp
+from nmpc_mhe.aux.derivatives import evaluate_jacobian, evaluate_hessian, evaluate_residuals, evaluate_param_jacobian, \
+    evaluate_gradient
+import numpy as np
+import unittest
+
+
+class TestDerivatives(unittest.TestCase):
+    def setUp(self):
+        m = ConcreteModel()
+        m.x = Var([0, 1], initialize={0: 2., 1: 3.})
+        m.y = Var(initialize=0.5)
+        m.z = Var(initialize=7.)
+        m.z.fix()
+        m.c = Constraint([0, 1], rule=lambda m, i: m.x[i] ** 2 * m.y + m.z * m.x[i] == 1.)
+        m.d = Constraint(expr=exp(m.y) - m.x[0] * m.x[1] <= 0.)
+        m.o = Objective(expr=m.y ** 2)
+        self.m = m
+
+    def test_jacobian(self):
+        m = self.m
+        jac, rows, cols = evaluate_jacobian(m)
+        self.assertEqual(rows, [("c", (0,)), ("c", (1,)), ("d", ())])
+        self.assertEqual(cols, [("x", (0,)), ("x", (1,)), ("y", ())])  #: z is fixed
+        expected = np.array([[2 * 2. * 0.5 + 7., 0., 4.],
+                             [0., 2 * 3. * 0.5 + 7., 9.],
+                             [-3., -2., np.exp(0.5)]])
+        self.assertTrue(np.allclose(jac.toarray(), expected))
+        #: given order, by label
+        jac, rows, cols = evaluate_jacobian(m, variables=[("y", ()), ("x", (1,))], constraints=[m.d])
+        self.assertTrue(np.allclose(jac.toarray(), [[np.exp(0.5), -2.]]))
+
+    def test_hessian(self):
+        m = self.m
+        y = {("c", (0,)): 2., ("d", ()): -1.}
+        h, lbl = evaluate_hessian(m, multipliers=y)
+        expected = np.array([[2. * 2 * 0.5, 1., 2. * 2 * 2.],
+                             [1., 0., 0.],
+                             [2. * 2 * 2., 0., 2. - np.exp(0.5)]])
+        self.assertTrue(np.allclose(h.toarray(), expected))
+
+    def test_gradient(self):
+        g, lbl = evaluate_gradient(self.m)
+        self.assertTrue(np.allclose(g, [0., 0., 1.]))
+
+    def test_param_jacobian(self):
+        m = self.m
+        m.p = Param([0, 1], initialize=2., mutable=True)
+        m.e = Constraint(expr=m.y * m.p[0] ** 2 == m.p[1] / m.p[0])  #: p[1] / p[0] goes to the bounds
+        jac, rows, cols = evaluate_param_jacobian(m, [m.p[0], m.p[1]], constraints=[m.e, m.d])
+        self.assertEqual(cols, [("p", (0,)), ("p", (1,))])
+        self.assertTrue(np.allclose(jac.toarray(), [[2 * 0.5 * 2. + 0.5, -0.5], [0., 0.]]))
+
+    def test_residuals(self):
+        res, rows = evaluate_residuals(self.m)
+        self.assertTrue(np.allclose(res, [2. + 14. - 1., 4.5 + 21. - 1., 0.]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from sample_mods.cstr_rodrigo.cstr_c_nmpc import cstr_rodrigo_dae
+from nmpc_mhe.pyomo_dae.NMPCGen_pyDAE import NmpcGen_DAE
+from nmpc_mhe.pyomo_dae.MHEGen_pyDAE import MheGen_DAE
+from nmpc_mhe.aux.utils import load_iguess, t_ij, clone_the_model, augment_model, aug_discretization
+from nmpc_mhe.aux.derivatives import evaluate_residuals, active_constraints
+from testing.common import WorkdirTestCase, STATES, X_SS, cstr_nmpc, tracking_nmpc, newton_solve
+import numpy as np
+import unittest
+
+
+class TestGradedGrid(WorkdirTestCase):
+    def test_nmpc(self):
+        e = tracking_nmpc(cstr_nmpc(fe_lengths_nmpc=[2., 2., 4.]))
+        m = e.olnmpc
+        self.assertEqual(m.t.get_finite_elements(), [0, 2, 4, 8])
+        self.assertEqual(t_ij(m.t, 2, 1), round(4. + 4. * m.t.get_discretization_info()["tau_points"][1], 6))
+        e.rti_preparation_nmpc(shift=False, iterations=25)
+        cons = [c for c in active_constraints(m) if c.equality]
+        self.assertLess(np.abs(evaluate_residuals(m, constraints=cons)[0]).max(), 1e-06)
+        #: the shift moves the profiles by the sampling time, not by one element
+        T = dict((t, value(m.T[t, 0])) for t in m.t)
+        u = [value(m.u1[i]) for i in range(0, 3)]
+        e.shift_olnmpc()
+        self.assertAlmostEqual(value(m.T[0, 0]), T[2])
+        pts = sorted(T)
+        self.assertAlmostEqual(value(m.T[4, 0]), np.interp(6., pts, [T[t] for t in pts]))
+        self.assertEqual([value(m.u1[i]) for i in range(0, 3)], [u[1], u[2], u[2]])
+        self.assertRaises(ValueError, NmpcGen_DAE, cstr_rodrigo_dae(2, 2), 2, STATES, ["u1"],
+                          u_bounds={"u1": (200., 1000.)}, nfe_t=3, ncp_t=2, fe_lengths_nmpc=[4., 2., 2.])
+
+    def test_initialize(self):
+        """initialize_olnmpc switches to a dummy model of the length of the coarse element"""
+        e = cstr_nmpc(fe_lengths_nmpc=[2., 2., 4.])
+        e.create_nmpc()
+        dummies = []  #: (length, initial T, final T)
+
+        def solve_dyn(mod, **kwargs):
+            stat = newton_solve(mod)
+            dummies.append((max(mod.t) - min(mod.t), value(mod.T_ic[0]), value(mod.T[max(mod.t), 0])))
+            return stat
+
+        e.solve_dyn = solve_dyn
+        e.curr_estate = dict(X_SS)
+        e.initialize_olnmpc(e.PlantSample, "estimated")
+        m = e.olnmpc
+        self.assertEqual([d[0] for d in dummies], [2., 2., 4.])
+        for (fe, t) in enumerate((2, 4, 8)):  #: each dummy starts where the previous one ended
+            self.assertAlmostEqual(dummies[fe][1], 384.0 if fe == 0 else dummies[fe - 1][2])
+            self.assertAlmostEqual(value(m.T[t, 0]), dummies[fe][2])
+        #: the coarse element weighs as the two sampling times it covers
+        e.new_weights_olnmpc(1e-04, {0: 1., 1: 1., 2: 3.})
+        self.assertEqual([value(m.Q_w_nmpc[i]) for i in range(0, 3)], [1e-04, 1e-04, 2e-04])
+        self.assertEqual([value(m.R_w_nmpc[i]) for i in range(0, 3)], [1., 1., 6.])
+
+    def test_mhe(self):
+        e = MheGen_DAE(cstr_rodrigo_dae(1, 1), 2, STATES, ["u1"], STATES, ["T"],
+                       nfe_t=3, ncp_t=2, fe_lengths_mhe=[6., 2., 2.])
+        m = e.lsmhe
+        self.assertEqual(m.t.get_finite_elements(), [0, 6, 8, 10])
+        for (k, t) in enumerate(sorted(m.t)):
+            m.T[t, 0].set_value(float(k))
+        e.shift_mhe()
+        self.assertEqual([value(m.T[t, 0]) for t in sorted(m.t)], [1., 1.5, 4., 5., 6., 6., 6.])
+
+
+class TestInterpolatedGuess(WorkdirTestCase):
+    def _model(self, ncp):
+        m = clone_the_model(cstr_rodrigo_dae(1, 1))
+        augment_model(m, 2, ncp, new_timeset_bounds=(0, 4))
+        aug_discretization(m, 2, ncp)
+        return m
+
+    def test_polynomial_is_exact(self):
+        for (ncp_src, ncp_tgt) in ((3, 2), (2, 3), (1, 3)):
+            src, tgt = self._model(ncp_src), self._model(ncp_tgt)
+            for t in src.t:
+                src.T[t, 0].set_value((t - 1.) ** ncp_src)
+                src.k[t, 0].set_value(100. + (t - 1.) ** (ncp_src - 1))
+            src.k[2, 0].set_value(470.7)  #: element start of k, stale (kdef only holds at the collocation points)
+            load_iguess(src, tgt, 1, 0)
+            for j in range(0, ncp_tgt + 1):  #: element 1 of src onto element 0 of tgt
+                t = t_ij(tgt.t, 0, j)
+                self.assertAlmostEqual(value(tgt.T[t, 0]), (t + 1.) ** ncp_src, places=4)
+                self.assertAlmostEqual(value(tgt.k[t, 0]), 100. + (t + 1.) ** (ncp_src - 1), places=4)
+            load_iguess(src, tgt, 1, 0, interpolate=False)
+            self.assertEqual(value(tgt.T[t_ij(tgt.t, 0, 1), 0]), 3. ** ncp_src)  #: last value
@@ -0,0 +1,92 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from sample_mods.cstr_rodrigo.cstr_c_nmpc import cstr_rodrigo_dae
+from nmpc_mhe.pyomo_dae.MHEGen_pyDAE import MheGen_DAE
+from nmpc_mhe.aux.utils import factor_weight
+import numpy as np
+import unittest, tempfile, shutil, os
+
+
+class TestFactorizedArrival(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.wd = tempfile.mkdtemp()
+        os.chdir(cls.wd)
+        states = ["Ca", "T", "Tj"]
+        cls.mhe = MheGen_DAE(cstr_rodrigo_dae(1, 1), 2, states, ["u1"], states, ["T"],
+                             nfe_t=3, ncp_t=2, arrival_cost="factorized")
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.wd)
+
+    def _arrival(self, P):
+        e = self.mhe
+        n = len(e.xkN_l)
+        e.set_arrival_weight_mhe(P)
+        e.regen_objective_fun()
+        dx = np.array([value(e.xkN_l[j] - e.lsmhe.x_0_mhe[j]) for j in range(0, n)])
+        for j in range(0, n):  #: Satisfy the factor constraints
+            zk = e.lsmhe.zk_arrival_mhe[j]
+            zk.set_value(value(zk) - value(e.lsmhe.arrival_c_mhe[j].body))
+            self.assertAlmostEqual(value(e.lsmhe.arrival_c_mhe[j].body), 0.0)
+        return dx, value(e.lsmhe.Arrival_e_mhe)
+
+    def test_factor_weight(self):
+        A = np.random.rand(4, 4)
+        W = A.dot(A.T) + np.eye(4)
+        U = factor_weight(W)
+        self.assertTrue(np.allclose(U.T.dot(U), W))
+        self.assertTrue(np.allclose(np.tril(U, -1), 0.))
+        S = np.ones((3, 3))  #: singular
+        U = factor_weight(S)
+        self.assertTrue(np.allclose(U.T.dot(U), S, atol=1e-5))
+
+    def test_same_value_as_dense(self):
+        n = len(self.mhe.xkN_l)
+        for j in range(0, n):
+            self.mhe.lsmhe.x_0_mhe[j] = value(self.mhe.xkN_l[j]) * 0.9
+        A = np.random.rand(n, n)
+        P = A.dot(A.T) + np.eye(n)
+        dx, arr = self._arrival(P)
+        self.assertAlmostEqual(arr, 0.5 * dx.dot(P).dot(dx), places=6)
+        #: excluded states drop out
+        self.mhe.xkN_nexcl[1] = 0
+        idx = [0] + list(range(2, n))
+        dx, arr = self._arrival(P)
+        self.assertAlmostEqual(arr, 0.5 * dx[idx].dot(P[np.ix_(idx, idx)]).dot(dx[idx]), places=6)
+        self.mhe.xkN_nexcl[1] = 1
+
+    def test_set_state_covariance(self):
+        e = self.mhe
+        e.create_rh_sfx()
+        n = len(e.xkN_l)
+        with open("inv_.in", "w") as f:  #: what k_aug leaves behind, rows in rh_name order
+            for i in range(0, n):
+                f.write("\t".join(str(10. * i + j) for j in range(0, n)) + "\n")
+        e._PI = np.loadtxt("inv_.in", ndmin=2)
+        perm = list(reversed(range(0, n)))
+        t_prior = e.lsmhe.t.get_finite_elements()[1]
+        for x in e.x_noisy:
+            v = getattr(e.lsmhe, x)
+            for j in e.x_vars[x]:
+                q = e.xkN_key[(x,) + j]
+                v[(t_prior,) + j].set_suffix_value(e.lsmhe.rh_name, perm[q])
+        e.set_arrival_weight_mhe(-np.ones((n, n)))
+        x0 = e.x_noisy[0]  #: xkN_key = 0, at its bound
+        getattr(e.lsmhe, x0)[(t_prior,) + e.x_vars[x0][0]].set_suffix_value(e.lsmhe.dof_v, 0)
+        e.set_state_covariance()
+        for j in range(0, n):
+            for k in range(0, n):
+                expected = -1. if 0 in (j, k) else e._PI[perm[j], perm[k]]
+                self.assertEqual(value(e.lsmhe.PikN_mhe[j, k]), expected)
+        e.set_arrival_weight_mhe(np.eye(n))
+
+
+if __name__ == '__main__':
+    unittest.main()
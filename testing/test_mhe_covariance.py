@@ -0,0 +1,65 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from sample_mods.cstr_rodrigo.cstr_c_nmpc import cstr_rodrigo_dae
+from nmpc_mhe.pyomo_dae.MHEGen_pyDAE import MheGen_DAE
+import numpy as np
+import unittest, tempfile, shutil, os
+
+
+def _satisfy(z, con):
+    for k in con.keys():
+        z[k].set_value(value(z[k]) - value(con[k].body))
+
+
+class TestFullCovariance(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.wd = tempfile.mkdtemp()
+        os.chdir(cls.wd)
+        states = ["Ca", "T", "Tj"]
+        cls.mhe = MheGen_DAE(cstr_rodrigo_dae(1, 1), 2, states, ["u1"], states, ["Ca", "T"],
+                             nfe_t=3, ncp_t=2, diag_QR=False, Q_blocks=[[0, 1]])
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.wd)
+
+    def test_disturbance(self):
+        e = self.mhe
+        C = np.array([[2., 0.5, 0.], [0.5, 1., 0.], [0., 0., 4.]])
+        e.set_covariance_disturb(C)
+        w = np.random.rand(e.nfe_tmhe, 3)  #: the last one is not weighted
+        for (i, k) in e.lsmhe.wk_mhe.keys():
+            e.lsmhe.wk_mhe[i, k].set_value(w[i, k])
+        _satisfy(e.lsmhe.wk_z_mhe, e.lsmhe.wk_z_c_mhe)
+        W = np.linalg.inv(C)
+        expected = 0.5 * sum(w[i].dot(W).dot(w[i]) for i in range(0, e.nfe_tmhe - 1))
+        self.assertAlmostEqual(value(e.lsmhe.Q_e_mhe), expected)
+        self.assertNotIn((0, 2), e.lsmhe.xkNk_Q_mhe)  #: outside of the block
+
+    def test_measurement(self):
+        e = self.mhe
+        C = np.array([[[1., 0.3], [0.3, 2.]]] * e.nfe_tmhe)
+        C[-1] *= 2.
+        e.set_covariance_meas(C)
+        nu = np.random.rand(e.nfe_tmhe, 2)
+        for (i, k) in e.lsmhe.nuk_mhe.keys():
+            e.lsmhe.nuk_mhe[i, k].set_value(nu[i, k])
+        _satisfy(e.lsmhe.nuk_z_mhe, e.lsmhe.nuk_z_c_mhe)
+        expected = 0.5 * sum(nu[i].dot(np.linalg.inv(C[i])).dot(nu[i]) for i in range(0, e.nfe_tmhe))
+        self.assertAlmostEqual(value(e.lsmhe.R_e_mhe), expected)
+        #: same thing from a dictionary
+        cov = {(("Ca", (0,)), ("Ca", (0,))): 1., (("Ca", (0,)), ("T", (0,))): 0.3, (("T", (0,)), ("T", (0,))): 2.}
+        e.set_covariance_meas(cov)
+        _satisfy(e.lsmhe.nuk_z_mhe, e.lsmhe.nuk_z_c_mhe)
+        expected = 0.5 * sum(nu[i].dot(np.linalg.inv(C[0])).dot(nu[i]) for i in range(0, e.nfe_tmhe))
+        self.assertAlmostEqual(value(e.lsmhe.R_e_mhe), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from testing.common import WorkdirTestCase, cstr_nmpc
+import numpy as np
+import unittest
+
+
+class TestNmpcObjective(WorkdirTestCase):
+    def setUp(self):
+        super(TestNmpcObjective, self).setUp()
+        self.nmpc = cstr_nmpc()
+        self.nmpc.create_nmpc()
+
+    def test_lazy_profile_objective(self):
+        e = self.nmpc
+        self.assertFalse(hasattr(e.olnmpc, "objfun_nmpc2"))
+        self.assertFalse(hasattr(e.olnmpc, "xmpc_ref_nmpc2"))
+        self.assertIn("objfun_nmpc", e.objective_build_time)
+        e.build_profile_objective_nmpc()
+        e.build_profile_objective_nmpc()  #: only once
+        self.assertFalse(e.olnmpc.objfun_nmpc2.active)
+        self.assertTrue(e.olnmpc.objfun_nmpc.active)
+        self.assertEqual(len(e.olnmpc.xmpc_ref_nmpc2), e.nfe_tnmpc * e.num_flatten_var)
+        self.assertIn("objfun_nmpc2", e.objective_build_time)
+
+    def test_bulk_weights(self):
+        e = self.nmpc
+        e.update_targets_nmpc = lambda: None  #: targets are set by hand
+        e.curr_state_target = {("Ca", (0,)): 0.02, ("T", (0,)): 380., ("Tj", (0,)): 370.}
+        e.curr_u_target = {"u1": 500.}
+        e.curr_rstate = {("Ca", (0,)): 0.02, ("T", (0,)): 382., ("Tj", (0,)): 369.5}
+        e.curr_u = {"u1": 504.}
+        e.compute_QR_nmpc(src="plant", n=-1)
+        k = e.xmpc_key
+        self.assertEqual(value(e.olnmpc.Q_nmpc[k[("Ca", (0,))]]), 1e+06)
+        self.assertAlmostEqual(value(e.olnmpc.Q_nmpc[k[("T", (0,))]]), 0.5)
+        self.assertAlmostEqual(value(e.olnmpc.Q_nmpc[k[("Tj", (0,))]]), 2.)
+        self.assertAlmostEqual(value(e.olnmpc.R_nmpc[0]), 0.25)
+        self.assertEqual(value(e.olnmpc.xmpc_ref_nmpc[k[("T", (0,))]]), 380.)
+        e.curr_u = {"u1": 500.}  #: control on target, capped like the states
+        e.compute_QR_nmpc(src="plant", n=-1, max_w_value=1e+04)
+        self.assertEqual(value(e.olnmpc.R_nmpc[0]), 1e+04)
+        e.compute_QR_nmpc(define_by_user=True, Q_nmpc=3., R_nmpc={"u1": 4.})
+        self.assertEqual(value(e.olnmpc.Q_nmpc[1]), 3.)
+        self.assertEqual(value(e.olnmpc.R_nmpc[0]), 4.)
+        self.assertRaises(ValueError, e.set_weights_nmpc, Q=np.ones(2))
+        e.new_weights_olnmpc(1., dict((fe, fe + 1.) for fe in range(0, 10)))
+        self.assertEqual(value(e.olnmpc.R_w_nmpc[2]), 3.)
+
+    def test_profile(self):
+        e = self.nmpc
+        e.update_targets_nmpc = lambda: None
+        e.curr_state_target = {("Ca", (0,)): 0.02, ("T", (0,)): 380., ("Tj", (0,)): 370.}
+        e.curr_u_target = {"u1": 500.}
+        for (s, T) in ((0, 380.), (2, 390.), (10, 400.)):
+            e.profile_state_target[s] = dict(e.curr_state_target)
+            e.profile_state_target[s][("T", (0,))] = T
+            e.profile_u_target[s] = {"u1": T + 100.}
+        e.profile_target = True
+        e.compute_QR_nmpc(define_by_user=True, Q_nmpc=1., R_nmpc=1., target_step=1)
+        self.assertTrue(e.olnmpc.objfun_nmpc2.active)
+        kT = e.xmpc_key[("T", (0,))]
+        self.assertEqual([value(e.olnmpc.xmpc_ref_nmpc2[i, kT]) for i in range(0, 3)], [380., 390., 390.])
+        self.assertEqual(value(e.olnmpc.umpc_ref_nmpc2[1, 0]), 490.)
+
+
+if __name__ == '__main__':
+    unittest.main()
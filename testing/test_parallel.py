@@ -0,0 +1,56 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from nmpc_mhe.aux.parallel import BackgroundTask
+from testing.common import WorkdirTestCase
+import subprocess
+import unittest, os, time
+
+
+def _alive(pid):
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except IOError:
+        return False
+
+
+class TestBackgroundTask(WorkdirTestCase):
+    def test_result(self):
+        bg = BackgroundTask(lambda: os.getcwd())
+        self.assertTrue(bg.wait(30.))
+        self.assertEqual((bg.status, bg.value), ("ok", bg.workdir))
+        self.assertFalse(os.path.exists(bg.workdir))
+
+    @unittest.skipUnless(os.path.isdir("/proc") and hasattr(os, "killpg"), "needs /proc and process groups")
+    def test_cancel_reaches_solver(self):
+        """The external program started by the task (ipopt, k_aug) is terminated with it"""
+        pid_file = os.path.join(self.wd, "pid")
+
+        def task():
+            p = subprocess.Popen(["sleep", "60"])
+            with open(pid_file, "w") as f:
+                f.write(str(p.pid))
+            return p.wait()
+
+        bg = BackgroundTask(task)
+        for i in range(0, 100):
+            if os.path.exists(pid_file) and os.path.getsize(pid_file):
+                break
+            time.sleep(0.05)
+        with open(pid_file) as f:
+            pid = int(f.read())
+        self.assertTrue(_alive(pid))
+        bg.cancel()
+        for i in range(0, 100):
+            if not _alive(pid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(_alive(pid))
+        self.assertFalse(os.path.exists(bg.workdir))
+        self.assertEqual(bg.status, "error")
+
+
+if __name__ == '__main__':
+    unittest.main()
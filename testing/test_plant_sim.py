@@ -0,0 +1,205 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base import Constraint
+from pyomo.core.base.numvalue import value
+from sample_mods.cstr_rodrigo.cstr_c_nmpc import cstr_rodrigo_dae
+from nmpc_mhe.pyomo_dae.NMPCGen_pyDAE import NmpcGen_DAE
+from nmpc_mhe.pyomo_dae.DynGen_pyDAE import DynSolWeAreDone
+from nmpc_mhe.aux.derivatives import evaluate_residuals
+from testing.common import WorkdirTestCase, cstr_nmpc, newton, newton_solve
+import numpy as np
+import unittest
+
+
+class TestPlantSim(WorkdirTestCase):
+    def setUp(self):
+        super(TestPlantSim, self).setUp()
+        self.nmpc = cstr_nmpc(ncp_t=3, plant_backend="radau")
+
+    def _final_state(self):
+        m = self.nmpc.PlantSample
+        return np.array([value(getattr(m, x)[2, 0]) for x in self.nmpc.states])
+
+    def _collocation(self):
+        newton(self.nmpc.PlantSample)
+        return self._final_state()
+
+    def test_equivalence(self):
+        e = self.nmpc
+        e.curr_u["u1"] = 260.
+        e.plant_uinject(e.PlantSample, src_kind="dict")  #: no homotopy solves
+        self.assertEqual(len(e.solve_log), 0)
+        self.assertEqual(e.solve_dyn(e.PlantSample, stop_if_nopt=True), 0)
+        self.assertEqual(e.solve_log[-1]["termination"], "optimal")
+        x_radau = self._final_state()
+        res, rows = evaluate_residuals(e.PlantSample)
+        model_eqs = [i for (i, (name, idx)) in enumerate(rows) if not name.endswith("_disc_eq")]
+        self.assertLess(np.abs(res[model_eqs]).max(), 1e-06)
+        e.simulate_plant(method="bdf")
+        x_bdf = self._final_state()
+        x_coll = self._collocation()
+        self.assertTrue(np.allclose(x_radau, x_bdf, rtol=1e-05))
+        self.assertTrue(np.allclose(x_radau, x_coll, rtol=1e-03))
+        self.assertRaises(ValueError, NmpcGen_DAE, cstr_rodrigo_dae(2, 3), 2, e.states, ["u1"],
+                          u_bounds={"u1": (200., 1000.)}, nfe_t=3, ncp_t=3, plant_backend="euler")
+
+    def test_singular_slice(self):
+        """T pinned by an algebraic equation instead of k (index 2), the failure is a status not a crash"""
+        e = self.nmpc
+        m = e.PlantSample
+        m.kdef.deactivate()
+        m.T_pin = Constraint(m.t, rule=lambda m, t: m.T[t, 0] == 390. if t > 0 else Constraint.Skip)
+        self.assertEqual(e.solve_dyn(m), 1)
+        self.assertEqual(e.solve_log[-1]["termination"], "failure")
+        self.assertRaises(DynSolWeAreDone, e.simulate_plant, stop_if_nopt=True)
+
+
+class TestAdaptiveContinuation(WorkdirTestCase):
+    def setUp(self):
+        super(TestAdaptiveContinuation, self).setUp()
+        self.nmpc = cstr_nmpc()
+        self.u_solved = []
+
+    def _fake_solve(self, reach):
+        """Converges if the control moved less than reach from the last converged point"""
+        m = self.nmpc.PlantSample
+        last = [value(m.u1[0])]
+
+        def solve_dyn(mod, **kwargs):
+            u = value(mod.u1[2])
+            self.u_solved.append(u)
+            if abs(u - last[0]) <= reach:
+                last[0] = u
+                mod.Tjinb[2].set_value(u)
+                return 0
+            mod.Tjinb[2].set_value(-1.)  #: garbage from the failed solve
+            return 1
+        return solve_dyn
+
+    def test_single_solve(self):
+        e = self.nmpc
+        e.solve_dyn = self._fake_solve(1e+03)
+        e.curr_u["u1"] = value(e.PlantSample.u1[0]) + 50.
+        self.assertEqual(e.plant_uinject(e.PlantSample, src_kind="dict"), 1)
+        self.assertEqual(e.uinject_log[-1]["solves"], 1)
+        self.assertEqual(e.uinject_log[-1]["status"], 0)
+
+    def test_grow_shrink(self):
+        e = self.nmpc
+        e.solve_dyn = self._fake_solve(25.)
+        u0 = value(e.PlantSample.u1[0])
+        e.curr_u["u1"] = u0 + 100.
+        n = e.plant_uinject(e.PlantSample, src_kind="dict", nsteps=5)
+        self.assertEqual(n, len(self.u_solved))
+        #: full step fails, 1/5 of it converges and the step doubles, failures halve it
+        self.assertTrue(np.allclose(np.array(self.u_solved) - u0, [100., 20., 60., 40., 80., 60., 100., 80., 100.]))
+        self.assertEqual(value(e.PlantSample.Tjinb[2]), u0 + 100.)
+        self.assertEqual(value(e.PlantSample.u1[0]), u0 + 100.)
+        self.assertEqual(e.uinject_log[-1]["status"], 0)
+
+    def test_failed_continuation(self):
+        """The status of the last resort is logged, only the rungs that finished count as solves"""
+        e = self.nmpc
+        e.solve_dyn = self._fake_solve(0.)
+        e.retry_ladder = [{"tol": 1e-03}, {"bound_push": 0.1}, {"ma57_pivtol": 1e-12}]
+
+        def solve_dyn_retry(mod, **kwargs):
+            e.retry_log.append({"model": mod.name, "time": 0., "rung": None, "failed": 2})
+            return 1
+
+        e.solve_dyn_retry = solve_dyn_retry
+        e.curr_u["u1"] = value(e.PlantSample.u1[0]) + 100.
+        n = e.plant_uinject(e.PlantSample, src_kind="dict", min_step=0.5)
+        self.assertEqual(n, len(self.u_solved) + 2)
+        self.assertEqual(e.uinject_log[-1]["status"], 1)
+
+
+class TestSensPredictor(WorkdirTestCase):
+    def setUp(self):
+        super(TestSensPredictor, self).setUp()
+        self.nmpc = cstr_nmpc(predictor="sens")
+
+    def test_prediction(self):
+        e = self.nmpc
+        m = e.PlantSample
+        newton(m)
+        for x in e.states:
+            e.curr_estate[(x, (0,))] = value(getattr(m, x + "_ic")[0]) * 1.005
+        e.curr_u["u1"] = value(m.u1[0]) + 2.
+        self.assertTrue(e.sens_predictor_step())
+        self.assertEqual(e.pred_stats["linearizations"], 1)
+        #: the nonlinear prediction
+        e.load_init_state_gen(m, src_kind="dict", state_dict="estimated")
+        for key in m.u1.keys():
+            m.u1[key] = e.curr_u["u1"]
+        newton(m)
+        for x in e.states:
+            self.assertAlmostEqual(e.curr_pstate[(x, (0,))] / value(getattr(m, x)[2, 0]), 1., places=3)
+        #: reused inside the trust region, refused outside
+        self.assertTrue(e.sens_predictor_step())
+        self.assertEqual(e.pred_stats["linearizations"], 1)
+        e.curr_u["u1"] *= 1.5
+        self.assertFalse(e.sens_predictor_step())
+
+
+class TestAmsPredictor(WorkdirTestCase):
+    def setUp(self):
+        super(TestAmsPredictor, self).setUp()
+        self.nmpc = e = cstr_nmpc(Ns_amsnmpc=2, ams_predictor="march")
+        e.solve_dyn = newton_solve
+        m = e.PlantSample
+        newton(m)
+        for x in e.states:
+            e.curr_estate[(x, (0,))] = value(getattr(m, x + "_ic")[0]) * 1.002
+        u0 = value(m.u1[0])
+        e.u_for_pred = {0: {"u1": u0 + 1.}, 1: {"u1": u0 + 2.}}
+
+    def _pstate(self):
+        return np.array([self.nmpc.curr_pstate[(x, (0,))] for x in self.nmpc.states])
+
+    def test_march_sens_background(self):
+        e = self.nmpc
+        e.predictor_amsNMPC()
+        x_march = self._pstate()
+        self.assertEqual(e.pred_stats["nlp"], 2)
+        e.ams_predictor = "sens"
+        e.predictor_amsNMPC()
+        self.assertEqual(e.pred_stats["sens"], 2)
+        self.assertTrue(np.allclose(self._pstate(), x_march, rtol=1e-04))
+        #: overlapped with something else, collected by the next call
+        e.ams_predictor = "march"
+        e.curr_pstate = {}
+        e.predictor_amsNMPC(background=True)
+        e.predictor_amsNMPC()
+        self.assertTrue(np.allclose(self._pstate(), x_march))
+        self.assertEqual(e.pred_stats["nlp"], 4)
+        self.assertRaises(ValueError, NmpcGen_DAE, cstr_rodrigo_dae(2, 2), 2, e.states, ["u1"],
+                          u_bounds={"u1": (200., 1000.)}, nfe_t=3, ncp_t=2, Ns_amsnmpc=2, ams_predictor="rk4")
+
+    def test_background_built_in_parent(self):
+        """The child only solves, what it builds or logs is not lost with it"""
+        e = self.nmpc
+
+        def solve_dyn(mod, **kwargs):
+            e.solve_log.append({"model": mod.name, "termination": "optimal"})
+            return newton_solve(mod)
+
+        e.solve_dyn = solve_dyn
+        e.ams_predictor = "sens"
+        e.curr_u["u1"] = e.u_for_pred[0]["u1"]
+        e.predictor_amsNMPC(background=True)
+        self.assertIsNotNone(e.PlantPred)
+        self.assertEqual(e.pred_stats["linearizations"], 1)
+        e.predictor_amsNMPC()
+        self.assertEqual(e.pred_stats["linearizations"], 1)
+        self.assertEqual(e.pred_stats["sens"], 2)
+        e.ams_predictor = "march"
+        e.predictor_amsNMPC(background=True)
+        e.predictor_amsNMPC()
+        self.assertEqual([entry["model"] for entry in e.solve_log], [e.PlantPred.name] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
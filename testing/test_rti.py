@@ -0,0 +1,81 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from nmpc_mhe.aux.derivatives import evaluate_residuals, active_constraints
+from testing.common import WorkdirTestCase, cstr_nmpc, tracking_nmpc
+import numpy as np
+import unittest, time
+
+
+class TestRealTimeIteration(WorkdirTestCase):
+    def setUp(self):
+        super(TestRealTimeIteration, self).setUp()
+        self.nmpc = tracking_nmpc(cstr_nmpc())
+
+    def _infeasibility(self):
+        cons = [c for c in active_constraints(self.nmpc.olnmpc) if c.equality]
+        return np.abs(evaluate_residuals(self.nmpc.olnmpc, constraints=cons)[0]).max()
+
+    def test_converge_and_feedback(self):
+        e = self.nmpc
+        self.assertEqual(e.rti_preparation_nmpc(shift=False, iterations=25), 25)
+        self.assertLess(self._infeasibility(), 1e-06)
+        e.rti_hessian = "exact"  #: close to the solution
+        e.rti_preparation_nmpc(shift=False, iterations=3)
+        u_old = value(e.olnmpc.u1[0])
+        #: the feedback is a first order approximation of the solution at the new state
+        e.curr_estate[("T", (0,))] += 0.5
+        e.rti_feedback_nmpc(src="estimated")
+        u_fb = e.curr_u["u1"]
+        e.rti_preparation_nmpc(shift=False, iterations=5)
+        u_new = value(e.olnmpc.u1[0])
+        self.assertLess(abs(u_fb - u_new), 0.05 * abs(u_new - u_old))
+        self.assertLess(self._infeasibility(), 1e-06)
+        self.assertLess(e.rti_log[1]["feedback"], e.rti_log[1]["preparation"])
+        #: bounded phase
+        self.assertEqual(e.rti_preparation_nmpc(iterations=100, time_budget=0.), 0)
+
+    def test_time_budget(self):
+        """A step is skipped when the previous one says it would not fit"""
+        e = self.nmpc
+        e.rti_linearize_nmpc = lambda: time.sleep(0.1)
+        e.rti_step_nmpc = lambda: None
+        self.assertEqual(e.rti_preparation_nmpc(shift=False, iterations=100, time_budget=0.25), 1)
+        self.assertLess(e.rti_log[-1]["preparation"], 0.25)
+        self.assertEqual(e.rti_preparation_nmpc(shift=False, iterations=100, time_budget=0.15), 0)
+
+    def test_shift(self):
+        e = self.nmpc
+        for i in range(0, e.nfe_tnmpc):
+            e.olnmpc.u1[i].set_value(300. + i)
+        e.shift_olnmpc()
+        self.assertEqual([value(e.olnmpc.u1[i]) for i in range(0, e.nfe_tnmpc)], [301., 302., 302.])
+
+
+class TestMoveBlocking(WorkdirTestCase):
+    def _nmpc(self, **kwargs):
+        e = tracking_nmpc(cstr_nmpc(nfe_t=4, Ns_amsnmpc=2, **kwargs))
+        e.rti_preparation_nmpc(shift=False, iterations=25)
+        cons = [c for c in active_constraints(e.olnmpc) if c.equality]
+        self.assertLess(np.abs(evaluate_residuals(e.olnmpc, constraints=cons)[0]).max(), 1e-06)
+        return e, [value(e.olnmpc.u1[i]) for i in range(0, e.nfe_tnmpc)], len(e.rti["w"])
+
+    def test_blocks_and_linear(self):
+        _, _, n_full = self._nmpc()
+        e, u, n = self._nmpc(u_blocks=[1, 3])
+        self.assertEqual(n, n_full - 2)
+        self.assertEqual(u[1], u[3])
+        e.create_suffixes_amsnmpc()
+        self.assertEqual(e.record_suffix_u, {0: {"u1": 1}, 1: {"u1": 2}})
+        e, u, n = self._nmpc(u_blocks=[2, 2], u_parametrization="linear")
+        self.assertEqual(n, n_full - 2)
+        self.assertAlmostEqual(u[1], 0.5 * (u[0] + u[2]))
+        self.assertEqual(u[2], u[3])
+        self.assertRaises(ValueError, e.create_suffixes_amsnmpc)
+        self.assertRaises(ValueError, self._nmpc, u_blocks=[1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from nmpc_mhe.aux.scenario_sweep import expand_scenarios, run_sweep, closed_loop_kpis
+import numpy as np
+import unittest, tempfile, shutil, os
+
+
+class _FakeLoop(object):
+    """Stands for a finished controller, only the journals used for the KPIs"""
+    def __init__(self, sc):
+        self.hi_t = 2.
+        self._iteration_count = 3
+        self.soi_dict = {("T", (0,)): [1., 2., 3.]}
+        self.sp_dict = {("T", (0,)): [2., 2., 2.]}
+        self.s_estimate = {"T": [[1.], [np.random.normal(0, sc["sigma"])]]}
+        self.s_real = {"T": [[1.], [0.]]}
+        self.solve_log = [{"model": "olnmpc", "time": 1., "termination": "optimal"},
+                          {"model": "olnmpc", "time": 3., "termination": "maxIterations"}]
+
+
+def closed_loop(sc):
+    with open("ipopt.opt", "w") as f:  #: all the scenarios write the same file
+        f.write(sc["name"])
+    if sc["sigma"] < 0:
+        raise RuntimeError("bad scenario")
+    return _FakeLoop(sc)
+
+
+class TestScenarioSweep(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_expand(self):
+        sc = expand_scenarios({"sigma": [0.1, 0.2], "Ns": [1, 2, 3]}, base={"steps": 5}, seed=10)
+        self.assertEqual(len(sc), 6)
+        self.assertEqual(sc[0]["steps"], 5)
+        self.assertEqual([i["seed"] for i in sc], list(range(10, 16)))
+
+    def test_sweep(self):
+        sc = expand_scenarios({"sigma": [0.1, 0.2, -1.]})
+        summary = run_sweep(closed_loop, sc, root=self.root, processes=2)
+        self.assertTrue(os.path.exists(os.path.join(self.root, "summary.json")))
+        status = dict((r["scenario"]["name"], r["status"]) for r in summary["results"])
+        self.assertEqual(status, {"sc_0000": "ok", "sc_0001": "ok", "sc_0002": "error"})
+        for i in sc:
+            with open(os.path.join(self.root, i["name"], "ipopt.opt")) as f:
+                self.assertEqual(f.read(), i["name"])
+        kpis = summary["results"][0]["kpis"]
+        self.assertAlmostEqual(kpis["iae_total"], 4.)
+        self.assertAlmostEqual(kpis["iae_off_soi"][str(("T", (0,)))], 200.)
+        self.assertEqual(kpis["solve_time"]["olnmpc"]["not_optimal"], 1)
+        self.assertAlmostEqual(kpis["solve_time"]["olnmpc"]["mean"], 2.)
+        #: same seed, same noise
+        again = run_sweep(closed_loop, sc[:1], root=os.path.join(self.root, "again"), processes=1)
+        self.assertAlmostEqual(again["results"][0]["kpis"]["estimation_rmse"], kpis["estimation_rmse"])
+
+    def test_zero_setpoint(self):
+        e = _FakeLoop({"sigma": 0.1})
+        e.soi_dict[("Ca", (0,))] = [1., 1., 1.]
+        e.sp_dict[("Ca", (0,))] = [0., 0., 0.]
+        e.sp_dict[("T", (0,))] = [2., 0., 2.]  #: the zero sample only counts in the absolute IAE
+        kpis = closed_loop_kpis(e)
+        self.assertAlmostEqual(kpis["iae"][str(("Ca", (0,)))], 6.)
+        self.assertNotIn(str(("Ca", (0,))), kpis["iae_off_soi"])
+        self.assertAlmostEqual(kpis["iae_off_soi"][str(("T", (0,)))], 200.)
+        self.assertAlmostEqual(kpis["iae_total"], 14.)
+
+
+if __name__ == '__main__':
+    unittest.main()
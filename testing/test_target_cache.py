@@ -0,0 +1,53 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base import Var
+from pyomo.core.base.numvalue import value
+from testing.common import WorkdirTestCase, cstr_nmpc
+import unittest, os
+
+
+class TestTargetCache(WorkdirTestCase):
+    def setUp(self):
+        super(TestTargetCache, self).setUp()
+        self.nmpc = cstr_nmpc(ref_state={("T", (0,)): 380.})
+
+    def _entry(self, ref, T):
+        values = dict((v.getname(), dict((k, v[k].value) for k in v.keys()))
+                      for v in self.nmpc.SteadyRef.component_objects(Var))
+        values["T"] = dict((k, T) for k in values["T"])
+        return {"ref": ref, "values": values}
+
+    def test_hit_and_warm_start(self):
+        e = self.nmpc
+        self.assertEqual(e.target_cache_key(), e.target_cache_key(None))
+        self.assertNotEqual(e.target_cache_key(), e.target_cache_key({("T", (0,)): 1.}))
+        e.target_cache[e.target_cache_key()] = self._entry({("T", (0,)): 380.}, 380.5)
+        e.find_target_ss()  #: from the cache, no solve
+        self.assertEqual(e.curr_state_target[("T", (0,))], 380.5)
+        self.assertEqual(len(e.solve_log), 0)
+        #: the closest target initializes the next one
+        e.ref_state = {("T", (0,)): 401.}
+        e.target_cache["other"] = self._entry({("T", (0,)): 400.}, 399.)
+        e.warm_start_target_nmpc()
+        self.assertEqual(value(e.SteadyRef2.T[1, 0]), 399.)
+
+    def test_hit_writes_files(self):
+        e = self.nmpc
+        ref = {("T", (0,)): 380.}
+        e.target_cache[e.target_cache_key()] = self._entry(ref, 380.5)
+        e.find_target_ss()  #: builds SteadyRef2
+        solves = []
+        e.solve_dyn = lambda mod, **kwargs: solves.append(kwargs) or 0
+        e.change_setpoint(ref_state=ref, wantparams=True, tag="sp")
+        self.assertEqual(solves, [])
+        self.assertTrue(os.path.exists("sp_{}_{}.json".format(e.res_file_suf, e._iteration_count)))
+        e.change_setpoint(ref_state=ref, keepsolve=True, wantparams=True, tag="sp")  #: the .sol needs a solve
+        self.assertEqual(len(solves), 1)
+        self.assertTrue(solves[0]["keepsolve"] and solves[0]["wantparams"])
+        self.assertEqual(e.curr_state_target[("T", (0,))], 380.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
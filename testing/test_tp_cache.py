@@ -0,0 +1,109 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from pyomo.core.base.numvalue import value
+from pyomo.core.base import Block
+from testing.common import WorkdirTestCase, X_SS, cstr_nmpc
+import numpy as np
+import unittest
+
+
+class TestTerminalPropertyCache(WorkdirTestCase):
+    def setUp(self):
+        super(TestTerminalPropertyCache, self).setUp()
+        self.nmpc = e = cstr_nmpc(tp_cache_file="tp_cache.json")
+        e.create_nmpc()
+        e.curr_state_target = dict(X_SS)
+        e.curr_u_target = {"u1": 554.}
+
+    def _entry(self):
+        n = self.nmpc.num_flatten_var
+        P = np.eye(n) * 3.
+        state_ss = [[x, list(j), v] for ((x, j), v) in self.nmpc.curr_state_target.items()]
+        return {"A": np.eye(n), "B": np.ones((n, 1)), "Ad": np.eye(n), "Bd": np.ones((n, 1)), "K": np.ones((1, n)),
+                "P": P, "cf": 0.5, "area": np.pi * 0.25, "q": 2., "lnM": 1., "state_ss": state_ss,
+                "u_ss": {"u1": 554.}}
+
+    def test_key(self):
+        e = self.nmpc
+        k0 = e.tp_cache_key(0.1, 0.1, simulate_points=10)
+        e.curr_state_target[("T", (0,))] += 1e-12  #: rounding
+        self.assertEqual(k0, e.tp_cache_key(0.1, 0.1, simulate_points=10))
+        self.assertNotEqual(k0, e.tp_cache_key(0.2, 0.1, simulate_points=10))
+        e.olnmpc.Q_nmpc[0] = 10.
+        self.assertNotEqual(k0, e.tp_cache_key(0.1, 0.1, simulate_points=10))
+
+    def test_hit(self):
+        e = self.nmpc
+        key = e.tp_cache_key(0.1, 0.1, simulate_points=10, state_norm=0.005, safety_factor_on_M=False, seed=None)
+        e.tp_cache[key] = self._entry()
+        e.save_tp_cache(e.tp_cache_file)
+        e.tp_cache = {}
+        e.load_tp_cache(e.tp_cache_file)
+        e.add_terminal_property_nmpc(0.1, 0.1, simulate_points=10)  #: nothing to solve
+        self.assertTrue(e.tp_exist)
+        self.assertEqual(value(e.olnmpc.term_cf), 0.5)
+        self.assertEqual(value(e.olnmpc.term_P[1, 1]), 3.)
+        self.assertEqual(e.tp_state_ss[("T", (0,))], 384.0)
+
+
+class TestFactorizedTerminalCost(WorkdirTestCase):
+    def _terminal_cost(self, P, **kwargs):
+        e = cstr_nmpc(**kwargs)
+        e.create_nmpc()
+        e.tp_state_ss = dict(X_SS)
+        for k in e.olnmpc.xmpc_ref_nmpc.keys():
+            e.olnmpc.xmpc_ref_nmpc[k] = 0.9 * value(e.xmpc_l[e.nfe_tnmpc - 1][k])
+        e.tp_P, e.tp_cf = P, 0.5
+        e.add_terminal_cost_region()
+        if e.terminal_cost == "factorized":
+            for i in e.olnmpc.term_z_c.keys():  #: satisfy z = U dx
+                z = e.olnmpc.term_z[i]
+                z.set_value(value(z) - value(e.olnmpc.term_z_c[i].body))
+        return value(e.olnmpc.terminal_cost_x)
+
+    def test_same_value(self):
+        A = np.random.rand(3, 3)
+        P = A.dot(A.T) + np.eye(3)
+        dense = self._terminal_cost(P)
+        self.assertAlmostEqual(self._terminal_cost(P, terminal_cost="factorized") / dense, 1.)
+        self.assertRaises(ValueError, self._terminal_cost, P, terminal_cost="cholesky")
+
+
+class TestTerminalRegionSampler(WorkdirTestCase):
+    def setUp(self):
+        super(TestTerminalRegionSampler, self).setUp()
+        self.nmpc = e = cstr_nmpc()
+        e.create_nmpc()
+        e.tp_state_ss = dict(X_SS)
+        e.tp_u_ss = {"u1": 554.}
+        e.solve_dyn = self._fake_solve
+
+    def _fake_solve(self, sim, **kwargs):
+        """x(hi_t) = ss + dx/2 + 10 dx^2 for every scenario, fails if a scenario starts with T above 384.004"""
+        blocks = [b for b in sim.component_objects(Block, descend_into=False)] or [sim]
+        for blk in blocks:
+            t = max(blk.t)
+            for x in self.nmpc.states:
+                dx = value(getattr(blk, x + "_ic")[0]) - self.nmpc.tp_state_ss[(x, (0,))]
+                getattr(blk, x)[t, 0].set_value(self.nmpc.tp_state_ss[(x, (0,))] + 0.5 * dx + 10. * dx ** 2)
+        return 1 if any(value(blk.T_ic[0]) > 384.004 for blk in blocks) else 0
+
+    def test_serial_and_pool(self):
+        e = self.nmpc
+        Ad, Bd, K = np.eye(3) * 0.9, np.ones((3, 1)), np.ones((1, 3)) * 0.1
+        kw = {"seed": 42, "batch_size": 2, "chunk_size": 6}
+        ln_x, ln_phi = e.tp_sample_many_pts(30, 0.005, Ad, Bd, K, **kw)
+        rejected = e.tp_rejected
+        self.assertGreater(rejected, 0)
+        self.assertEqual(len(ln_x), 30 - rejected)
+        px, pphi = e.tp_sample_many_pts(30, 0.005, Ad, Bd, K, n_workers=2, **kw)
+        self.assertEqual(e.tp_rejected, rejected)
+        np.testing.assert_array_equal(px, ln_x)
+        np.testing.assert_array_equal(pphi, ln_phi)
+        self.assertFalse(np.array_equal(e.tp_sample_many_pts(30, 0.005, Ad, Bd, K, seed=7)[0][:5], ln_x[:5]))
+
+
+if __name__ == '__main__':
+    unittest.main()
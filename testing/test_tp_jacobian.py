@@ -0,0 +1,97 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from nmpc_mhe.pyomo_dae.NMPCGen_pyDAE import NmpcGen_DAE
+from nmpc_mhe.aux.utils import get_jacobian_k_aug, clone_the_model, augment_steady
+from testing.common import WorkdirTestCase, cstr_nmpc
+import numpy as np
+import unittest
+
+
+class TestTerminalJacobian(WorkdirTestCase):
+    """Reordering and reduction of the k_aug Jacobian, against the dense permutation matrices."""
+    def setUp(self):
+        super(TestTerminalJacobian, self).setUp()
+        rng = np.random.RandomState(0)
+        self.nx, self.nu, self.ny = 3, 2, 2
+        n = self.nx + self.nu + self.ny
+        m = self.nx + self.ny
+        jac = rng.rand(m, n) * (rng.rand(m, n) > 0.3)
+        jac[:, self.nx + self.nu:] += 5. * np.vstack([np.zeros((self.nx, self.ny)), np.eye(self.ny)])
+        self.varorder = rng.permutation(n) + 1
+        self.conorder = rng.permutation(m) + 1
+        self.jac = np.zeros((m, n))
+        self.jac[np.argsort(self.conorder)[:, None], np.argsort(self.varorder)] = jac  #: scrambled
+        self.ordered = jac
+        np.savetxt("varorder.txt", self.varorder, fmt="%d")
+        np.savetxt("conorder.txt", self.conorder, fmt="%d")
+        r, c = np.nonzero(self.jac)
+        with open("jacobi_debug.in", "w") as f:
+            f.write("{}\t{}\t{}\n".format(m, n, r.size))
+            for i, j in zip(r, c):
+                f.write("{}\t{}\t{!r}\n".format(i + 1, j + 1, self.jac[i, j]))
+        self.nmpc = object.__new__(NmpcGen_DAE)
+        self.nmpc.num_flatten_var = self.nx
+        self.nmpc.n_controls = self.nu
+        self.nmpc.n_flatten_othervars = self.ny
+        self.nmpc.n_DE = self.nx
+        self.nmpc.n_AE = self.ny
+
+    def test_rearrange(self):
+        n, m = self.varorder.size, self.conorder.size
+        col_perm = np.zeros((n, n))
+        for i, idx in enumerate(self.varorder):
+            col_perm[i, idx - 1] = 1
+        row_perm = np.zeros((m, m))
+        for i, idx in enumerate(self.conorder):
+            row_perm[idx - 1, i] = 1
+        old = np.dot(row_perm, np.dot(self.jac, col_perm))
+        self.assertTrue(np.allclose(old, self.ordered))
+        dense, _ = get_jacobian_k_aug()
+        sparse, size = get_jacobian_k_aug(sparse=True)
+        self.assertEqual(size, (m, n))
+        self.assertTrue(np.allclose(self.nmpc.tp_rearrange_jac(dense), old))
+        self.assertTrue(np.allclose(self.nmpc.tp_rearrange_jac(sparse).toarray(), old))
+
+    def test_A_B(self):
+        nx, nu = self.nx, self.nu
+        J = self.ordered
+        dfdy, dgdy = J[:nx, nx + nu:], J[nx:, nx + nu:]
+        A = -(J[:nx, :nx] - dfdy.dot(np.linalg.inv(dgdy)).dot(J[nx:, :nx]))
+        B = -(J[:nx, nx:nx + nu] - dfdy.dot(np.linalg.inv(dgdy)).dot(J[nx:, nx:nx + nu]))
+        sparse, _ = get_jacobian_k_aug(sparse=True)
+        reordered = self.nmpc.tp_rearrange_jac(sparse)
+        self.assertTrue(np.allclose(self.nmpc.tp_calculate_A(reordered), A))
+        self.assertTrue(np.allclose(self.nmpc.tp_calculate_B(reordered), B))
+        self.assertTrue(np.allclose(self.nmpc.tp_calculate_A(J), A))
+        tp_A, tp_B = self.nmpc.tp_calculate_A_B(reordered)
+        self.assertTrue(np.allclose(tp_A, A) and np.allclose(tp_B, B))
+        #: ODE model, no algebraic block
+        self.nmpc.n_AE = self.nmpc.n_flatten_othervars = 0
+        tp_A, tp_B = self.nmpc.tp_calculate_A_B(reordered[:nx, :nx + nu])
+        self.assertTrue(np.allclose(tp_A, -J[:nx, :nx]) and np.allclose(tp_B, -J[:nx, nx:nx + nu]))
+
+
+class TestTerminalIncidence(WorkdirTestCase):
+    def test_catagorize(self):
+        e = cstr_nmpc()
+        e.tp_get_true_control_name()
+        e.tp_get_differential_var()
+        e.tp_model = clone_the_model(e.d_mod)
+        augment_steady(e.tp_model)
+        for u in e.u:
+            e.tp_model.del_component(u + "_cdummy")
+            e.tp_model.del_component(u)
+        e.catagorize_equations_vars()
+        self.assertEqual(e.diff_equ, [("de_ca", (1, 0)), ("de_T", (1, 0)), ("de_Tj", (1, 0))])
+        self.assertEqual(e.alge_equ, [("kdef", (1, 0))])
+        self.assertEqual(e.diff_var_con, {"Ca": "de_ca", "T": "de_T", "Tj": "de_Tj"})
+        self.assertEqual(sorted(e.tp_incidence[e.tp_model.k[1, 0]]), [("de_T", (1, 0)), ("de_ca", (1, 0)), ("kdef", (1, 0))])
+        e.tp_k_aug_suffix_locate_cons_vars()
+        self.assertEqual(e.tp_cons_suffix[("de_T", (1, 0))], 2)
+        self.assertEqual(e.tp_cons_suffix[("kdef", (1, 0))], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()